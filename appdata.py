@@ -1,9 +1,18 @@
 from collections import namedtuple
-from multiprocessing import Queue
+from contextlib import nullcontext
+from multiprocessing import Queue, Value, Event, Lock
 from pathlib import Path
 import queue
 import os
+import time
+import threading
 import datetime
+import pickle
+import struct
+import tempfile
+import logfile
+from eventdata import RAWOUTPUT_POLICIES
+from dumpsinks import SINKS, DumpFiles
 
 PROGRAM_NAME = "fdbtracer"
 _overridenDumpDbPath = None
@@ -27,16 +36,29 @@ class TracerError:
         self.iserror = True
 
 
+class TracerMetrics:
+    '''Current metrics of a process (see metrics.ProcessMetrics), collected by the main process.'''
+    def __init__(self, source, counters, gauges, histograms):
+        self.text = ''
+        self.source = source
+        self.counters = counters
+        self.gauges = gauges
+        self.histograms = histograms
+        self.iserror = False
+
+
 # ************************* System Parameters *************************
-_SysParameters = namedtuple('SysParameters', 'testMode logPath logLevel consoleDebug maxErrors')
+_SysParameters = namedtuple('SysParameters', 'testMode logPath logLevel consoleDebug maxErrors chunkSize chunkTimeout '
+    'queueSize spillDir')
 _sysParams = None
 
 
-def initCommonParams(testMode, logPath, logLevel, consoleDebug, maxErrors):
+def initCommonParams(testMode, logPath, logLevel, consoleDebug, maxErrors, chunkSize, chunkTimeout, queueSize, spillDir):
     global _sysParams
     if _sysParams:
         raise Exception('sysParams cannot be initialized twice')
-    _sysParams = _SysParameters(testMode, logPath, logLevel, consoleDebug, maxErrors)
+    _sysParams = _SysParameters(testMode, logPath, logLevel, consoleDebug, maxErrors, chunkSize, chunkTimeout,
+        queueSize, spillDir)
 
 
 def common():
@@ -44,37 +66,52 @@ def common():
 
 
 # ************************* Traced DB Parameters *************************
-_TraceParameters = namedtuple('_TraceParameters', 'host login password traceConf')
-_traceParameters = None
+_TraceParameters = namedtuple('_TraceParameters', 'host login password traceConf readTimeout')
+_traceParameters = list()
 
 
-def initTraceParams(host, login, password, traceConf):
-    global _traceParameters
-    if _traceParameters:
-        raise Exception('traceParams cannot be initialized twice')
+def addTraceParams(host, login, password, traceConf, readTimeout):
+    '''Adds one traced host; every host is traced by its own TraceEngine process.'''
+    if any(params.host == host for params in _traceParameters):
+        raise Exception('traced host {} is listed twice'.format(host))
+    if readTimeout < 1:
+        raise Exception('readTimeout should be 1 or more')
     conf = ''
     traceConfFile = Path(os.getcwd()) / traceConf
     with traceConfFile.open() as f:
         conf = f.read()
-    _traceParameters = _TraceParameters(host, login, password, conf)
+    _traceParameters.append(_TraceParameters(host, login, password, conf, readTimeout))
 
 
-def trace():
+def traces():
     return _traceParameters
 
 
 # ************************* Dump DB Parameters *************************
 _DB_SUBDIR = 'db'
 _CREATEDB_SCRIPT = 'create_db.sql'
-_DumpParameters = namedtuple('_DumpParameters', 'databasePath databaseName addDateToName')
+_DumpParameters = namedtuple('_DumpParameters', 'sink databasePath databaseName addDateToName batchSize batchTimeout statementCacheSize '
+    'rawOutput rawOutputPrefix workers pairEvents pairIndexSize pairMaxAge maxDatabaseSize')
 _dumpParameters = None
 
 
-def initDumpParams(databasePath, databaseName, addDateToName):
+def initDumpParams(sink, databasePath, databaseName, addDateToName, batchSize, batchTimeout, statementCacheSize,
+        rawOutput, rawOutputPrefix, workers, pairEvents, pairIndexSize, pairMaxAge, maxDatabaseSize):
     global _dumpParameters
     if _dumpParameters:
         raise Exception('dumpParams cannot be initialized twice')
-    _dumpParameters = _DumpParameters(databasePath, databaseName, addDateToName)
+    if sink not in SINKS:
+        raise Exception('sink should be one of: {}'.format(', '.join(SINKS)))
+    if rawOutput not in RAWOUTPUT_POLICIES:
+        raise Exception('rawOutput should be one of: {}'.format(', '.join(RAWOUTPUT_POLICIES)))
+    if workers < 1:
+        raise Exception('workers should be 1 or more')
+    if pairIndexSize < 1:
+        raise Exception('pairIndexSize should be 1 or more')
+    if maxDatabaseSize < 0:
+        raise Exception('maxDatabaseSize should be 0 or more')
+    _dumpParameters = _DumpParameters(sink, databasePath, databaseName, addDateToName, batchSize, batchTimeout, statementCacheSize,
+        rawOutput, rawOutputPrefix, workers, pairEvents, pairIndexSize, pairMaxAge, maxDatabaseSize)
 
 
 def dump():
@@ -87,15 +124,34 @@ def overrideDumpDbPath(dbpath):
 
 
 def absDumpDbPath():
+    '''Path of the file the dump starts with: the latest one of today, if the files are rotated.'''
+    dbFiles = dumpDbFiles()
+    if dbFiles:
+        today = datetime.date.today()
+        return dbFiles.path(today, dbFiles.lastPart(today))
     if _overridenDumpDbPath:
         dbPath = _overridenDumpDbPath
     else:
-        dbFilename = ''
-        if dump().addDateToName:
-            dbFilename = '{}-{}.fdb'.format(dump().databaseName, datetime.date.today().isoformat())
-        else:
-            dbFilename = '{}.fdb'.format(dump().databaseName)
-        dbPath = os.path.join(dump().databasePath, dbFilename)
+        dbPath = os.path.join(dump().databasePath, '{}{}'.format(dump().databaseName, SINKS[dump().sink].EXTENSION))
+    return _absDbPath(dbPath)
+
+
+def dumpDbFiles():
+    '''DumpFiles the dump switches between: a file a day if the date is added to the name, and the next file of the day
+    when maxDatabaseSize is exceeded. None if the dump writes to one file all the time.'''
+    daily = dump().addDateToName and not _overridenDumpDbPath
+    maxSize = dump().maxDatabaseSize * 2**20
+    if not daily and not maxSize:
+        return None
+    if _overridenDumpDbPath:
+        (root, extension) = os.path.splitext(_absDbPath(_overridenDumpDbPath))
+    else:
+        root = _absDbPath(os.path.join(dump().databasePath, dump().databaseName))
+        extension = SINKS[dump().sink].EXTENSION
+    return DumpFiles(root, extension, daily, maxSize)
+
+
+def _absDbPath(dbPath):
     if not os.path.isabs(dbPath):
         dbPath = os.path.join(os.getcwd(), _DB_SUBDIR, dbPath)
     return dbPath
@@ -105,56 +161,422 @@ def absDumpDbScriptPath():
     return os.path.join(os.getcwd(), _DB_SUBDIR, _CREATEDB_SCRIPT)
 
 
+# ************************* Live Stats Parameters *************************
+_STATS_FILE_SUFFIX = '.stats.json'
+_LiveStatsParameters = namedtuple('_LiveStatsParameters', 'enabled interval statsFile topSize maxKeys')
+_liveStatsParameters = None
+
+
+def initLiveStatsParams(enabled, interval, statsFile, topSize, maxKeys):
+    global _liveStatsParameters
+    if _liveStatsParameters:
+        raise Exception('liveStatsParams cannot be initialized twice')
+    _liveStatsParameters = _LiveStatsParameters(enabled, interval, statsFile, topSize, maxKeys)
+
+
+def liveStats():
+    return _liveStatsParameters
+
+
+# ************************* Filters Parameters *************************
+_FiltersParameters = namedtuple('_FiltersParameters', 'excludeEvents excludeUsers excludeAddresses excludeModules minDuration '
+    'sampleBacklog minSampleRate')
+_filtersParameters = None
+
+
+def initFiltersParams(excludeEvents, excludeUsers, excludeAddresses, excludeModules, minDuration, sampleBacklog, minSampleRate):
+    global _filtersParameters
+    if _filtersParameters:
+        raise Exception('filtersParams cannot be initialized twice')
+    if not 0 < minSampleRate <= 1:
+        raise Exception('minSampleRate should be more than 0 and not more than 1')
+    _filtersParameters = _FiltersParameters(tuple(excludeEvents), tuple(excludeUsers), tuple(excludeAddresses), tuple(excludeModules),
+        minDuration, sampleBacklog, minSampleRate)
+
+
+def filters():
+    return _filtersParameters
+
+
+# ************************* Throttle Parameters *************************
+_ThrottleParameters = namedtuple('_ThrottleParameters', 'enabled checkInterval maxBacklog resumeBacklog holdTime levels')
+_throttleParameters = None
+
+
+def initThrottleParams(enabled, checkInterval, maxBacklog, resumeBacklog, holdTime, levels):
+    '''levels are the trace config options of every level, as tuples of (name, value) pairs.'''
+    global _throttleParameters
+    if _throttleParameters:
+        raise Exception('throttleParams cannot be initialized twice')
+    if enabled and not levels:
+        raise Exception('throttle is enabled, but there are no [throttle.N] sections')
+    if resumeBacklog >= maxBacklog:
+        raise Exception('resumeBacklog should be less than maxBacklog')
+    _throttleParameters = _ThrottleParameters(enabled, checkInterval, maxBacklog, resumeBacklog, holdTime,
+        tuple(tuple(options) for options in levels))
+
+
+def throttle():
+    return _throttleParameters
+
+
+# ************************* Metrics Parameters *************************
+_METRICS_FILE_SUFFIX = '.prom'
+_MetricsParameters = namedtuple('_MetricsParameters', 'enabled interval metricsFile')
+_metricsParameters = None
+
+
+def initMetricsParams(enabled, interval, metricsFile):
+    global _metricsParameters
+    if _metricsParameters:
+        raise Exception('metricsParams cannot be initialized twice')
+    _metricsParameters = _MetricsParameters(enabled, interval, metricsFile)
+
+
+def metrics():
+    return _metricsParameters
+
+
+def metricsInterval():
+    '''Interval of metrics sending by the processes, 0 if metrics are disabled.'''
+    return metrics().interval if metrics().enabled else 0
+
+
+def absMetricsFilePath():
+    metricsPath = metrics().metricsFile or PROGRAM_NAME + _METRICS_FILE_SUFFIX
+    if not os.path.isabs(metricsPath):
+        metricsPath = os.path.join(os.getcwd(), metricsPath)
+    return metricsPath
+
+
+def absStatsFilePath():
+    '''Stats file is put next to the dump database, if its path is not set.'''
+    statsPath = liveStats().statsFile
+    if not statsPath:
+        statsPath = os.path.splitext(absDumpDbPath())[0] + _STATS_FILE_SUFFIX
+    if not os.path.isabs(statsPath):
+        statsPath = os.path.join(os.getcwd(), statsPath)
+    return statsPath
+
+
 # ************************* Communicator *************************
+_END_OF_DATA = None
+_MISSING = object()
+_SPILL_RECORD_HEADER = struct.Struct('<qI')
+
+
+class _SpillFile:
+    '''Append-only file of the blocks that did not fit into the datastore queue. Records are
+    (sequence number, length, pickled (sent time, source, block)); size is the shared count of bytes written.
+    append() and truncateIfRead() are called with the spill lock held, read() by the consumer only.'''
+    def __init__(self, path, size):
+        self.path = path
+        self._size = size
+        self._writer = None
+        self._reader = None
+        self._readOffset = 0
+
+    def size(self):
+        return self._size.value
+
+    def append(self, sequence, block):
+        if not self._writer:
+            self._writer = open(self.path, 'ab', buffering=0)
+        data = pickle.dumps(block, pickle.HIGHEST_PROTOCOL)
+        self._writer.write(_SPILL_RECORD_HEADER.pack(sequence, len(data)) + data)
+        self._size.value += _SPILL_RECORD_HEADER.size + len(data)
+
+    def read(self, sequence):
+        '''Returns the next unread block if it has the sequence number, _MISSING otherwise.'''
+        if self._readOffset >= self._size.value:
+            return _MISSING
+        if not self._reader:
+            self._reader = open(self.path, 'r+b')
+        self._reader.seek(self._readOffset)
+        (recordSequence, length) = _SPILL_RECORD_HEADER.unpack(self._reader.read(_SPILL_RECORD_HEADER.size))
+        if recordSequence != sequence:
+            return _MISSING
+        block = pickle.loads(self._reader.read(length))
+        self._readOffset += _SPILL_RECORD_HEADER.size + length
+        return block
+
+    def caughtUp(self):
+        return self._readOffset and self._readOffset >= self._size.value
+
+    def truncateIfRead(self):
+        '''Everything written is read: the file starts over, so it does not grow beyond the biggest burst.'''
+        if self.caughtUp():
+            self._reader.truncate(0)
+            self._size.value = 0
+            self._readOffset = 0
+
+    def close(self):
+        for f in (self._writer, self._reader):
+            if f:
+                f.close()
+        self._writer = self._reader = None
+
+
 class Communicator:
-    def __init__(self, *, datastore=None, stop=None, messages=None):
-        self._stop = stop if stop else Queue()
-        self._datastore = datastore if datastore else Queue()
+    '''Transport between processes. Trace lines travel through the datastore queue in blocks
+    (lists of lines): the producer collects up to chunkSize lines or waits up to chunkTimeout
+    seconds before sending a block, and the consumer hands the lines of a block out one by one.
+    Stop is a shared event: reading it does not reset it, so every process sees the same state.
+    The queue holds at most queueSize blocks (0 - unlimited). Blocks that do not fit are appended
+    to the spill file in spillDir, so that the producer never blocks and memory stays flat;
+    blocks are numbered, and the consumer takes them from the queue and from the spill file in order.
+    Several producers may share the channels: every block carries the source of its producer (see clone()),
+    so the consumer can tell the lines of different traced hosts apart (see lineSource()).'''
+    def __init__(self, *, datastore=None, stop=None, messages=None, backlog=None, chunkSize=1, chunkTimeout=0.0,
+            queueSize=0, spillDir=None, spillPath=None, spillSize=None, spillLock=None, sequence=None, source=None, follow=False):
+        self._stop = stop if stop else Event()
+        self._datastore = datastore if datastore else Queue(queueSize)
         self._datastoreInitialized = self._datastore and not isinstance(self._datastore, str)
         self._messages = messages if messages else Queue()
+        self._backlog = backlog if backlog else Value('q', 0)
+        self._chunkSize = max(1, chunkSize)
+        self._chunkTimeout = chunkTimeout
+        self._queueSize = queueSize
+        self._spillDir = spillDir
+        self._outBlock = list()
+        self._outBlockStarted = 0
+        # set by autoFlush(): the block being collected is shared with the flushing thread
+        self._outLock = nullcontext()
+        self._inBlock = list()
+        self._inBlockPos = 0
+        self._inBlockSent = time.time()
+        self._inBlockSource = None
+        self._inBlockFile = (None, 0)
+        self._fileStart = 0
+        self._follow = follow
+        self._source = source
+        self._sequence = sequence if sequence is not None else Value('q', 0, lock=False)
+        self._spillLock = spillLock if spillLock is not None else Lock()
+        self._spillSize = spillSize if spillSize is not None else Value('q', 0, lock=False)
+        self._ownsSpill = not datastore and queueSize > 0
+        if self._ownsSpill:
+            (fd, spillPath) = tempfile.mkstemp(prefix=PROGRAM_NAME + '-', suffix='.spill', dir=spillDir or None)
+            os.close(fd)
+        self._spill = _SpillFile(spillPath, self._spillSize) if spillPath else None
+        self._nextSequence = 0
+        self._heldBlocks = dict()
+
+    def clone(self, source=None):
+        '''Returns new Communicator using the same channels, to be used inside child process.
+        Lines pushed by the clone are tagged with source (the traced host).'''
+        return Communicator(datastore=self._datastore, stop=self._stop, messages=self._messages, backlog=self._backlog,
+            chunkSize=self._chunkSize, chunkTimeout=self._chunkTimeout, queueSize=self._queueSize, spillDir=self._spillDir,
+            spillPath=self._spill.path if self._spill else None, spillSize=self._spillSize, spillLock=self._spillLock,
+            sequence=self._sequence, source=source, follow=self._follow)
+
+    def newChannel(self):
+        '''Returns new Communicator with its own datastore queue and spill file (of the same size and chunking), sharing stop
+        and messages: a consumer passes the lines on to other processes with it. Its creator closes it.
+        The backlog count is shared too, so linesLeft() tells all the lines not parsed yet, wherever they wait.'''
+        return Communicator(stop=self._stop, messages=self._messages, backlog=self._backlog, chunkSize=self._chunkSize,
+            chunkTimeout=self._chunkTimeout, queueSize=self._queueSize, spillDir=self._spillDir)
+
+    def close(self):
+        '''Removes the spill file. Called by the process that created the channels, after the others have finished.'''
+        if self._spill:
+            self._spill.close()
+            if self._ownsSpill and os.path.exists(self._spill.path):
+                os.remove(self._spill.path)
+
+    def following(self):
+        '''File mode: the file is read as it grows (and after it is rotated), until stop is requested.'''
+        return self._follow
+
+    def sourcePath(self):
+        '''Returns log file path in file mode, None otherwise.'''
+        if isinstance(self._datastore, str):
+            return self._datastore
+        return getattr(self._datastore, 'name', None)
 
     def stop(self):
-        self._stop.put(True)
-        self._stop.put(True)
-        self._stop.put(True)
+        self._stop.set()
 
     def stopped(self):
-        try:
-            val = self._stop.get(block=False)
-            return val
-        except queue.Empty:
-            return False
+        return self._stop.is_set()
 
-    def pushLine(self,  line):
+    def waitStopped(self, timeout=None):
+        return self._stop.wait(timeout)
+
+    def endOfData(self):
+        '''Tells the consumer that no more lines will be sent: it gets EOFReached after the queued ones.'''
         if hasattr(self._datastore, 'put'):
-            try:
-                self._datastore.put(line, block=False)
-            except queue.Full:
-                return False
-            else:
+            self._putBlock(_END_OF_DATA)
+
+    def pushLine(self,  line):
+        if not hasattr(self._datastore, 'put'):
+            return False
+        with self._outLock:
+            if not self._outBlock:
+                self._outBlockStarted = time.monotonic()
+            self._outBlock.append(line)
+            if len(self._outBlock) >= self._chunkSize or time.monotonic() - self._outBlockStarted >= self._chunkTimeout:
+                self.flushLines()
+        return True
+
+    def pushLines(self, lines):
+        '''Lines go to the same block, so blocks may be kept from ending in the middle of an event.'''
+        if not hasattr(self._datastore, 'put'):
+            return False
+        with self._outLock:
+            if not self._outBlock:
+                self._outBlockStarted = time.monotonic()
+            self._outBlock.extend(lines)
+            if len(self._outBlock) >= self._chunkSize or time.monotonic() - self._outBlockStarted >= self._chunkTimeout:
+                self.flushLines()
+        return True
+
+    def flushLines(self):
+        with self._outLock:
+            if not self._outBlock:
                 return True
-        return False
+            if not self._putBlock(self._outBlock):
+                return False
+            with self._backlog.get_lock():
+                self._backlog.value += len(self._outBlock)
+            self._outBlock = list()
+            return True
 
-    def popLine(self):
+    def autoFlush(self):
+        '''Producer that may wait long for its next line (like the trace session reader): the block being collected
+        is sent when chunkTimeout has passed, without waiting for the next push. Starts a thread of the calling process,
+        so it is called on the producer's clone.'''
+        if self._chunkTimeout <= 0:
+            # every push sends its block
+            return
+        self._outLock = threading.RLock()
+        threading.Thread(target=self._flushExpired, daemon=True).start()
+
+    def _flushExpired(self):
+        while True:
+            time.sleep(self._chunkTimeout)
+            with self._outLock:
+                if self._outBlock and time.monotonic() - self._outBlockStarted >= self._chunkTimeout:
+                    self.flushLines()
+
+    def _putBlock(self, block):
+        '''Numbering and sending are done under the lock, so sequence numbers grow both in the queue and in the spill file.
+        While the spill file is not read to the end, new blocks go there too. Blocks are sent with the time of sending
+        and the source.'''
+        block = (time.time(), self._source, block)
+        with self._spillLock:
+            sequence = self._sequence.value
+            if self._spill and self._spill.size():
+                self._spill.append(sequence, block)
+            else:
+                try:
+                    self._datastore.put((sequence, block), block=False)
+                except queue.Full:
+                    if not self._spill:
+                        return False
+                    self._spill.append(sequence, block)
+            self._sequence.value = sequence + 1
+        return True
+
+    def popLine(self, timeout=0):
+        '''Returns next line, or None if nothing arrived during timeout seconds (None means wait forever).
+        Raises EOFReached when the file is read to the end (or stop is requested), or when the producer
+        has sent endOfData() and all lines before it have been returned. The followed file has no end.'''
         if not self._datastoreInitialized and isinstance(self._datastore, str):
-            self._datastore = open(self._datastore, encoding='utf8')
-        if hasattr(self._datastore, 'readline'):
-            line = self._datastore.readline()
-            if line:
-                return line
+            if self._follow:
+                self._datastore = logfile.FollowSource(self._datastore, self._fileStart, sleep=self._stop.wait)
             else:
-                raise EOFReached()
+                self._datastore = logfile.FileSource(self._datastore, self._fileStart)
+            self._datastoreInitialized = True
+        if hasattr(self._datastore, 'readBlock'):
+            if self._inBlockPos >= len(self._inBlock):
+                self._inBlock = self._datastore.readBlock(timeout)
+                self._inBlockPos = 0
+                if self._inBlock is None or self.stopped():
+                    self._inBlock = list()
+                    raise EOFReached()
+                if not self._inBlock:
+                    return None
+                self._inBlockFile = (self._datastore.identity(), self._datastore.blockStart)
+            line = self._inBlock[self._inBlockPos]
+            self._inBlockPos += 1
+            return line
         elif hasattr(self._datastore, 'get'):
+            if self._inBlockPos >= len(self._inBlock) and not self._popBlock(timeout):
+                return None
+            line = self._inBlock[self._inBlockPos]
+            self._inBlockPos += 1
+            return line
+        return None
+
+    def _popBlock(self, timeout):
+        block = self._takeBlock()
+        while block is _MISSING:
             try:
-                val = self._datastore.get(block=False)
-                return val
+                (sequence, block) = self._datastore.get(timeout=timeout)
             except queue.Empty:
-                return None
+                return False
+            if sequence != self._nextSequence:
+                # the blocks before it are in the spill file
+                self._heldBlocks[sequence] = block
+                block = self._takeBlock()
+        self._nextSequence += 1
+        (sent, source, block) = block
+        if block is _END_OF_DATA:
+            raise EOFReached()
+        with self._backlog.get_lock():
+            self._backlog.value -= len(block)
+        self._inBlock = block
+        self._inBlockPos = 0
+        self._inBlockSent = sent
+        self._inBlockSource = source
+        return True
+
+    def _takeBlock(self):
+        '''Returns the next block if it has already arrived out of order or is in the spill file, _MISSING otherwise.'''
+        block = self._heldBlocks.pop(self._nextSequence, _MISSING)
+        if block is _MISSING and self._spill:
+            block = self._spill.read(self._nextSequence)
+            if self._spill.caughtUp():
+                with self._spillLock:
+                    self._spill.truncateIfRead()
+        return block
+
+    def seekFile(self, offset):
+        '''File mode: the file is read from offset (start of an event header line), to be called before popLine().'''
+        self._fileStart = offset
+
+    def filePosition(self):
+        '''File mode: (identity of the file, offset of the block being read, index in the block of the line popLine()
+        returned last). Blocks start with event header lines. Identity is None while followed file is too short for it.'''
+        return self._inBlockFile + (self._inBlockPos - 1,)
+
+    def endOfBlock(self):
+        '''True if the line popLine() returned last is the last one of its block.'''
+        return self._inBlockPos >= len(self._inBlock)
+
+    def lineSource(self):
+        '''Source of the line popLine() returned last: the traced host that sent it, None in file mode.'''
+        return self._inBlockSource
+
+    def oldestLineAge(self):
+        '''Seconds since the block being read now was sent: its rest are the oldest lines not processed yet.
+        0 if nothing is waiting (or in file mode).'''
+        if hasattr(self._datastore, 'get') and self.linesLeft() > 0:
+            return max(0.0, time.time() - self._inBlockSent)
+        return 0.0
+
+    def spilledBytes(self):
+        return self._spill.size() if self._spill else 0
+
+    def progress(self):
+        '''Returns (bytes read, file size) in file mode, None otherwise.'''
+        if hasattr(self._datastore, 'readBlock'):
+            return (self._datastore.offset(), self._datastore.size())
         return None
 
     def linesLeft(self):
-        if hasattr(self._datastore, 'qsize'):
-            return self._datastore.qsize()
+        if hasattr(self._datastore, 'get'):
+            return self._backlog.value + len(self._inBlock) - self._inBlockPos
         return -1
 
     def pushMessage(self, message):
@@ -165,9 +587,9 @@ class Communicator:
         else:
             return True
 
-    def popMessage(self):
+    def popMessage(self, timeout=0):
         try:
-            val = self._messages.get(block=False)
+            val = self._messages.get(timeout=timeout)
             return val
         except queue.Empty:
             return None
@@ -0,0 +1,237 @@
+'''Throughput benchmarks, no Firebird server needed.
+
+    python bench/benchmark.py parse [logfile] [--events N] [--repeat R] [--baseline REV ...]
+        EventParser only: the log is read to memory and parsed line by line in this process. With --baseline the
+        EventParser of eventdata.py at git revision REV is run on the same lines first, e.g.
+        --baseline 0a347fa~1 --baseline 0a347fa compares the parser before and after the single pass line
+        classification (later revisions parse more fields, so they are not comparable with these two).
+    python bench/benchmark.py transport [logfile] [--events N] [--chunk-size C] [--queue-size Q] [--repeat R]
+        Communicator only: lines of the log are sent from a producer process (as TraceEngine does) and received here.
+    python bench/benchmark.py dump [logfile] [--events N] [--jobs J] [--sink bench|sqlite] [--batch-size B] [--repeat R]
+        End-to-end --file mode: DumpEngine process reads, parses and dumps the log. The default 'bench' sink is
+        a local stand-in that only counts the rows, so that DB write costs are not measured; 'sqlite' writes a real
+        SQLite database to the temp dir.
+
+Without logfile a trace log of N events is generated with tracegen (Firebird 3.0 format, default mix).'''
+import os
+import sys
+import time
+import types
+import argparse
+import tempfile
+import subprocess
+from multiprocessing import Process
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import tracegen  # noqa: E402
+import appdata  # noqa: E402
+import eventdata  # noqa: E402
+import dumpengine  # noqa: E402
+from appdata import Communicator, TracerMetrics  # noqa: E402
+from dumpsinks import SINKS, DbScript, DumpSink  # noqa: E402
+
+_SCRIPT = os.path.join(ROOT, 'db', 'create_db.sql')
+_BENCH_SINK = 'bench'
+# DumpEngine sends its totals once, at the end
+_METRICS_INTERVAL = 10**6
+
+
+class BenchSink(DumpSink):
+    '''Stand-in for the dump database: keeps counts only.'''
+    def __init__(self, dbPath, dbScriptPath):
+        super().__init__(dbPath, dbScriptPath)
+        self._connected = False
+        self._lastId = 0
+        self.rows = 0
+
+    def exists(self):
+        return True
+
+    def create(self, deferred=True):
+        pass
+
+    def createDeferred(self):
+        pass
+
+    def connect(self):
+        self._connected = True
+
+    def connected(self):
+        return self._connected
+
+    def disconnect(self):
+        self._connected = False
+
+    def reserveIds(self, count):
+        self._lastId += count
+        return self._lastId - count + 1
+
+    def writeStatements(self, statements):
+        pass
+
+    def writeEvents(self, rows):
+        self.rows += len(rows)
+
+    def writeTableStats(self, rows):
+        pass
+
+    def readCheckpoint(self, fileId):
+        return None
+
+    def writeCheckpoint(self, fileId, filePath, checkpoint):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+SINKS[_BENCH_SINK] = BenchSink
+
+
+def loadFields(module=eventdata, script=_SCRIPT):
+    module.EventData.setFields(['ID'] + DbScript(script).parsedFields())
+
+
+def _gitShow(revision, path):
+    return subprocess.check_output(['git', 'show', '{}:{}'.format(revision, path)], cwd=ROOT)
+
+
+def loadRevision(revision):
+    '''eventdata module as it was at the git revision, its fields set from db/create_db.sql of the revision.'''
+    module = types.ModuleType('eventdata_{}'.format(revision))
+    exec(compile(_gitShow(revision, 'eventdata.py'), '{}:eventdata.py'.format(revision), 'exec'), module.__dict__)
+    with tempfile.NamedTemporaryFile(suffix='.sql', delete=False) as f:
+        f.write(_gitShow(revision, 'db/create_db.sql'))
+    try:
+        loadFields(module, f.name)
+    finally:
+        os.remove(f.name)
+    return module
+
+
+def readLines(path):
+    with open(path, encoding='utf8') as f:
+        return f.read().splitlines()
+
+
+def benchParse(path, repeat, module=eventdata):
+    '''module - eventdata module with the fields of EventData set.'''
+    lines = readLines(path)
+    best = None
+    for _ in range(repeat):
+        parser = module.EventParser()
+        events = 0
+        started = time.perf_counter()
+        for line in lines:
+            parser.parse(line)
+            if parser.popEvent():
+                events += 1
+        parser.finish()
+        if parser.popEvent():
+            events += 1
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return (len(lines), events, best)
+
+
+def _produce(communicator, path):
+    communicator = communicator.clone()
+    for line in readLines(path):
+        communicator.pushLine(line)
+    communicator.flushLines()
+    communicator.endOfData()
+
+
+def benchTransport(path, chunkSize, queueSize):
+    communicator = Communicator(chunkSize=chunkSize, chunkTimeout=0.1, queueSize=queueSize)
+    producer = Process(target=_produce, args=(communicator, path))
+    started = time.perf_counter()
+    producer.start()
+    lines = 0
+    try:
+        while True:
+            if communicator.popLine(timeout=None) is not None:
+                lines += 1
+    except appdata.EOFReached:
+        pass
+    elapsed = time.perf_counter() - started
+    producer.join()
+    communicator.close()
+    return (lines, elapsed)
+
+
+def benchDump(path, jobs, sink, batchSize):
+    '''Runs DumpEngine process the way FDBTracer does in --file mode, returns (rows written, seconds, errors).'''
+    dbPath = os.path.join(tempfile.gettempdir(), 'fdbtracer-bench' + SINKS[sink].EXTENSION)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(dbPath + suffix):
+            os.remove(dbPath + suffix)
+    params = appdata._DumpParameters(sink, '', '', False, batchSize, 1.0, 10000, 'full', 1024, 1, False, 100000, 0, 0)
+    communicator = Communicator(datastore=path)
+    started = time.perf_counter()
+    dumpHandler = Process(target=dumpengine.run, args=(params, dbPath, _SCRIPT, communicator, jobs, None, None, _METRICS_INTERVAL))
+    dumpHandler.start()
+    rows = 0
+    errors = list()
+    while dumpHandler.is_alive() or rows == 0:
+        message = communicator.popMessage(timeout=0.1)
+        if isinstance(message, TracerMetrics):
+            rows = message.counters.get('dump_rows_written_total', 0)
+        elif message and message.iserror:
+            errors.append(message.text)
+        elif not message and not dumpHandler.is_alive():
+            break
+    elapsed = time.perf_counter() - started
+    dumpHandler.join()
+    return (rows, elapsed, errors)
+
+
+if __name__ == '__main__':
+    argsp = argparse.ArgumentParser()
+    argsp.add_argument('mode', choices=('parse', 'transport', 'dump'))
+    argsp.add_argument('logfile', nargs='?', help='Trace log (generated if omitted)')
+    argsp.add_argument('--events', type=int, default=50000, help='Number of events to generate')
+    argsp.add_argument('--repeat', type=int, default=3, help='Number of runs, the best one is reported')
+    argsp.add_argument('--baseline', metavar='REV', action='append', default=[],
+        help='parse: git revision of eventdata.py to compare with, may be repeated')
+    argsp.add_argument('--chunk-size', type=int, default=256, help='transport: lines per block')
+    argsp.add_argument('--queue-size', type=int, default=256, help='transport: blocks kept in memory')
+    argsp.add_argument('--jobs', type=int, default=1, help='dump: number of parsing processes')
+    argsp.add_argument('--sink', default=_BENCH_SINK, choices=(_BENCH_SINK, 'sqlite'), help='dump: dump database backend')
+    argsp.add_argument('--batch-size', type=int, default=500, help='dump: rows per batch')
+    args = argsp.parse_args()
+
+    path = args.logfile
+    if not path:
+        path = os.path.join(tempfile.gettempdir(), 'fdbtracer-bench-{}.log'.format(args.events))
+        if not os.path.exists(path):
+            (events, written) = tracegen.write(path, args.events)
+            print('Generated {} events, {:.1f} MB: {}'.format(events, written / 2**20, path))
+    size = os.path.getsize(path) / 2**20
+
+    if args.mode == 'parse':
+        loadFields()
+        runs = [('parse {}'.format(revision), loadRevision(revision)) for revision in args.baseline]
+        runs.append(('parse', eventdata))
+        for (name, module) in runs:
+            (lines, events, best) = benchParse(path, args.repeat, module)
+            print('{}: {} lines, {} events: best of {} runs {:.3f} s, {:,.0f} lines/s, {:,.0f} events/s, {:.1f} MB/s'.format(
+                name, lines, events, args.repeat, best, lines / best, events / best, size / best))
+    elif args.mode == 'transport':
+        (lines, best) = min((benchTransport(path, args.chunk_size, args.queue_size) for _ in range(args.repeat)),
+            key=lambda result: result[1])
+        print('transport: {} lines, chunk {}, queue {}: best of {} runs {:.3f} s, {:,.0f} lines/s, {:.1f} MB/s'.format(
+            lines, args.chunk_size, args.queue_size, args.repeat, best, lines / best, size / best))
+    else:
+        results = [benchDump(path, args.jobs, args.sink, args.batch_size) for _ in range(args.repeat)]
+        for (_, _, errors) in results:
+            for error in errors[:5]:
+                print('error: {}'.format(error))
+        (rows, best, _) = min(results, key=lambda result: result[1])
+        print('dump: {} rows, sink {}, {} jobs, batch {}: best of {} runs {:.3f} s, {:,.0f} rows/s, {:.1f} MB/s'.format(
+            rows, args.sink, args.jobs, args.batch_size, args.repeat, best, rows / best, size / best))
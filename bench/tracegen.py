@@ -0,0 +1,261 @@
+'''Synthetic trace log generator: Firebird 2.5/3.0 trace session output of chosen volume and mix.
+
+    python bench/tracegen.py output.log [--events N | --size MB] [--version 3.0] [--mix attach=2,statement=70] [--seed S]
+
+Mix weights (event kinds not listed get weight 0 if --mix is given):
+    attach      - ATTACH_DATABASE/DETACH_DATABASE
+    transaction - START_TRANSACTION/COMMIT_TRANSACTION/ROLLBACK_TRANSACTION with performance info
+    statement   - PREPARE_STATEMENT, EXECUTE_STATEMENT_START/FINISH and FREE_STATEMENT: __SUPSQL__ module comments,
+                  plans, parameters, records fetched, performance info and table stats. EXECUTE_STATEMENT_FINISH
+                  finishes the statement started in its attachment, if there is one
+    procedure   - EXECUTE_PROCEDURE_FINISH with parameters and performance info
+    huge        - EXECUTE_STATEMENT_FINISH of a statement with thousands of lines of text'''
+import sys
+import random
+import argparse
+import datetime
+
+VERSIONS = ('2.5', '3.0')
+DEFAULT_MIX = {'attach': 2, 'transaction': 20, 'statement': 70, 'procedure': 7, 'huge': 0.1}
+
+_DATABASE = 'D:\\DB\\PROD.FDB'
+_CLIENTS = ('C:\\APP\\SUPCLIENT.EXE', 'C:\\APP\\SUPREPORTS.EXE', 'C:\\Program Files\\Firebird\\bin\\isql.exe')
+_USERS = ('SUPUSER', 'REPORTER', 'SYSDBA', 'BATCH')
+_MODULES = ('UDOCUMENTS.pas', 'UCLIENTS.pas', 'UORDERS.pas', 'UREPORTS.pas', 'UMAIN.pas', 'USTOCK.pas')
+_TABLES = ('DOCUMENTS', 'CLIENTS', 'ORDERS', 'ORDER_LINES', 'GOODS', 'STOCK', 'PAYMENTS', 'USERS_LOG')
+_PROCEDURES = ('SP_RECALC_STOCK', 'SP_CLOSE_DAY', 'SP_GET_CLIENT_DEBT', 'SP_LOG_ACTION')
+_ISOLATIONS = ('READ_COMMITTED | REC_VERSION | WAIT | READ_WRITE', 'READ_COMMITTED | REC_VERSION | NOWAIT | READ_ONLY',
+    'CONCURRENCY | WAIT | READ_WRITE', 'READ_COMMITTED | NO_REC_VERSION | WAIT | READ_WRITE')
+_STATEMENTSTART = '-' * 79
+_STATEMENTEND = '^' * 79
+_TABLESTATSHEADER = 'Table                             Natural     Index    Update    Insert    Delete   Backout     Purge   Expunge'
+_TABLESTATSSEPARATOR = '*' * 111
+_STATEMENTS = (
+    ('select d.id, d.doc_date, d.doc_number, d.amount, c.name\nfrom documents d\n  join clients c on c.id = d.client_id\n'
+        'where d.doc_date between ? and ?\n  and d.state = {int}\norder by d.doc_date',
+        'PLAN SORT (JOIN (D INDEX (IDX_DOCUMENTS_DATE), C INDEX (PK_CLIENTS)))', ('DOCUMENTS', 'CLIENTS')),
+    ('select c.id, c.name, c.phone from clients c where c.name like \'{str}%\'',
+        'PLAN (C INDEX (IDX_CLIENTS_NAME))', ('CLIENTS',)),
+    ('update orders set state = {int}, changed = current_timestamp where id = {int}',
+        'PLAN (ORDERS INDEX (PK_ORDERS))', ('ORDERS',)),
+    ('insert into users_log (user_name, action, action_time, comment)\nvalues (\'{str}\', {int}, current_timestamp, \'{str}\')',
+        None, ('USERS_LOG',)),
+    ('select g.id, g.name, s.quantity\nfrom goods g\n  left join stock s on s.goods_id = g.id\nwhere g.id in ({intList})',
+        'PLAN JOIN (G INDEX (PK_GOODS, PK_GOODS, PK_GOODS), S INDEX (FK_STOCK_GOODS))', ('GOODS', 'STOCK')),
+    ('delete from order_lines where order_id = {int}', 'PLAN (ORDER_LINES INDEX (FK_ORDER_LINES_ORDERS))', ('ORDER_LINES',)),
+    ('select sum(p.amount) from payments p where p.client_id = ? and p.pay_date >= \'{date}\'',
+        'PLAN (P INDEX (FK_PAYMENTS_CLIENTS))', ('PAYMENTS',)),
+)
+
+
+class _Attachment:
+    def __init__(self, attachmentId, rnd, version):
+        self.id = attachmentId
+        self.user = rnd.choice(_USERS)
+        self.client = '{}:{}'.format(rnd.choice(_CLIENTS), rnd.randint(1000, 9999))
+        address = '10.1.{}.{}'.format(rnd.randint(0, 3), rnd.randint(2, 250))
+        if version == '2.5':
+            self.line = '\t{} (ATT_{}, {}:NONE, WIN1251, TCPv4:{})'.format(_DATABASE, attachmentId, self.user, address)
+        else:
+            self.line = '\t{} (ATT_{}, {}:NONE, UTF8, TCPv4:{}/{})'.format(_DATABASE, attachmentId, self.user, address,
+                rnd.randint(49152, 65535))
+        self.transaction = None
+        # (lines after the context, tables) of the statement started
+        self.statement = None
+
+
+class TraceGenerator:
+    '''Yields the text of trace events. Timestamps grow, attachments and transactions live for a while,
+    so the output looks like a real trace session of a busy client-server application.'''
+    def __init__(self, version='3.0', mix=None, seed=1, attachments=40):
+        if version not in VERSIONS:
+            raise ValueError('Unknown Firebird version: {}'.format(version))
+        self._version = version
+        self._rnd = random.Random(seed)
+        weights = mix if mix is not None else DEFAULT_MIX
+        self._kinds = [kind for kind in weights if weights[kind] > 0]
+        self._weights = [weights[kind] for kind in self._kinds]
+        if not self._kinds:
+            raise ValueError('Event mix is empty')
+        self._moment = datetime.datetime(2020, 6, 1, 9, 0)
+        self._nextAttachment = 1000
+        self._nextTransaction = 50000
+        self._nextStatement = 9000
+        self._attachments = [self._newAttachment() for _ in range(attachments)]
+        self._generators = {'attach': self._attach, 'transaction': self._transaction, 'statement': self._statement,
+            'procedure': self._procedure, 'huge': self._hugeStatement}
+
+    def events(self, count):
+        for _ in range(count):
+            yield self.event()
+
+    def event(self):
+        self._moment += datetime.timedelta(microseconds=self._rnd.randint(0, 200) * 100)
+        kind = self._rnd.choices(self._kinds, self._weights)[0]
+        return '\n'.join(self._generators[kind]()) + '\n\n'
+
+    def _header(self, event):
+        if self._version == '2.5':
+            process = '(1420:02C6C5D8)'
+        else:
+            process = '(4076:000000000220B040)'
+        return '{}.{:04} {} {}'.format(self._moment.strftime('%Y-%m-%dT%H:%M:%S'), self._moment.microsecond // 100,
+            process, event)
+
+    def _newAttachment(self):
+        self._nextAttachment += 1
+        return _Attachment(self._nextAttachment, self._rnd, self._version)
+
+    def _context(self, event, attachment, withTransaction=True):
+        lines = [self._header(event), attachment.line, '\t' + attachment.client]
+        if withTransaction:
+            if attachment.transaction is None:
+                self._nextTransaction += 1
+                attachment.transaction = (self._nextTransaction, self._rnd.choice(_ISOLATIONS))
+            lines.append('\t\t(TRA_{}, {})'.format(*attachment.transaction))
+        return lines
+
+    def _performance(self, ms, reads=0, writes=0, fetches=0, marks=0):
+        '''Zero counters are omitted, as Firebird does.'''
+        counters = ['{:7} ms'.format(ms)]
+        for (value, name) in ((reads, 'read(s)'), (writes, 'write(s)'), (fetches, 'fetch(es)'), (marks, 'mark(s)')):
+            if value:
+                counters.append('{} {}'.format(value, name))
+        return ', '.join(counters)
+
+    def _tableStats(self, tables):
+        lines = ['', _TABLESTATSHEADER, _TABLESTATSSEPARATOR]
+        for table in tables:
+            counters = [self._rnd.choice((0, 0, self._rnd.randint(1, 5000))) for _ in range(2)] + \
+                [self._rnd.choice((0, 0, 0, self._rnd.randint(1, 50))) for _ in range(3)]
+            lines.append('{:<31}'.format(table) + ''.join('{:>10}'.format(value or '') for value in counters).rstrip())
+        return lines
+
+    def _attach(self):
+        index = self._rnd.randrange(len(self._attachments))
+        if self._rnd.random() < 0.5:
+            attachment = self._attachments[index]
+            self._attachments[index] = self._newAttachment()
+            return self._context('DETACH_DATABASE', attachment, withTransaction=False)
+        self._attachments[index] = attachment = self._newAttachment()
+        return self._context('ATTACH_DATABASE', attachment, withTransaction=False)
+
+    def _transaction(self):
+        attachment = self._rnd.choice(self._attachments)
+        if attachment.transaction is None:
+            return self._context('START_TRANSACTION', attachment)
+        event = 'COMMIT_TRANSACTION' if self._rnd.random() < 0.9 else 'ROLLBACK_TRANSACTION'
+        lines = self._context(event, attachment)
+        lines.append(self._performance(self._rnd.randint(0, 30), writes=self._rnd.randint(0, 5),
+            fetches=self._rnd.randint(0, 300), marks=self._rnd.randint(0, 20)))
+        attachment.transaction = None
+        return lines
+
+    def _sqlText(self, template):
+        rnd = self._rnd
+        return template.format(int=rnd.randint(1, 100000), str='x{}'.format(rnd.randint(1, 10**6)),
+            date='2020-{:02}-01'.format(rnd.randint(1, 12)),
+            intList=', '.join(str(rnd.randint(1, 10**5)) for _ in range(rnd.randint(1, 12))))
+
+    def _statementBlock(self, event, sqlText, plan, withModule=True):
+        lines = self._context(event, self._rnd.choice(self._attachments))
+        return lines + self._statementText(sqlText, plan, withModule)
+
+    def _statementText(self, sqlText, plan, withModule):
+        self._nextStatement += 1
+        lines = ['', 'Statement {}:'.format(self._nextStatement), _STATEMENTSTART]
+        if withModule:
+            lines.append('/*__SUPSQL__/{}/{}*/'.format(self._rnd.choice(_MODULES), self._rnd.randint(1, 3000)))
+        lines += sqlText.split('\n')
+        lines.append(_STATEMENTEND)
+        if plan:
+            lines.append(plan)
+        return lines
+
+    def _statement(self):
+        attachment = self._rnd.choice(self._attachments)
+        event = self._rnd.choices(('EXECUTE_STATEMENT_START', 'EXECUTE_STATEMENT_FINISH', 'PREPARE_STATEMENT', 'FREE_STATEMENT'),
+            (45, 45, 5, 5))[0]
+        if event == 'EXECUTE_STATEMENT_FINISH' and attachment.statement:
+            (text, tables) = attachment.statement
+            attachment.statement = None
+            lines = self._context(event, attachment) + text
+        else:
+            (template, plan, tables) = self._rnd.choice(_STATEMENTS)
+            text = self._statementText(self._sqlText(template), plan, withModule=self._rnd.random() < 0.9)
+            if '?' in template and event.startswith('EXECUTE'):
+                text += ['', 'param0 = integer, "{}"'.format(self._rnd.randint(1, 10**5)), 'param1 = varchar(30), "<NULL>"']
+            lines = self._context(event, attachment) + text
+            if event == 'EXECUTE_STATEMENT_START':
+                attachment.statement = (text, tables)
+        if event == 'PREPARE_STATEMENT':
+            lines += ['', self._performance(self._rnd.randint(0, 5))]
+        elif event == 'EXECUTE_STATEMENT_FINISH':
+            fetched = self._rnd.randint(0, 500)
+            lines += ['', '{} records fetched'.format(fetched), self._performance(int(self._rnd.lognormvariate(2, 1.5)),
+                reads=self._rnd.randint(0, 100), writes=self._rnd.randint(0, 3), fetches=self._rnd.randint(0, 10 * fetched + 5),
+                marks=self._rnd.randint(0, 3))]
+            lines += self._tableStats(tables)
+        return lines
+
+    def _procedure(self):
+        attachment = self._rnd.choice(self._attachments)
+        lines = self._context('EXECUTE_PROCEDURE_FINISH', attachment)
+        lines += ['', 'Procedure {}:'.format(self._rnd.choice(_PROCEDURES)),
+            'param0 = integer, "{}"'.format(self._rnd.randint(1, 10**5)), '',
+            self._performance(int(self._rnd.lognormvariate(3, 1.5)), reads=self._rnd.randint(0, 500),
+                writes=self._rnd.randint(0, 50), fetches=self._rnd.randint(0, 20000), marks=self._rnd.randint(0, 500))]
+        lines += self._tableStats(self._rnd.sample(_TABLES, 3))
+        return lines
+
+    def _hugeStatement(self):
+        rows = self._rnd.randint(1000, 5000)
+        sqlText = 'execute block as\nbegin\n' + '\n'.join(
+            "  insert into users_log (user_name, action, action_time) values ('{}', {}, current_timestamp);".format(
+                self._rnd.choice(_USERS), self._rnd.randint(1, 100)) for _ in range(rows)) + '\nend'
+        lines = self._statementBlock('EXECUTE_STATEMENT_FINISH', sqlText, None)
+        lines += ['', '0 records fetched', self._performance(rows // 3 + self._rnd.randint(0, 100),
+            writes=rows // 50, fetches=rows * 5, marks=rows)]
+        lines += self._tableStats(('USERS_LOG',))
+        return lines
+
+
+def parseMix(text):
+    '''"attach=2,statement=70" -> {'attach': 2, 'statement': 70}'''
+    mix = dict()
+    for item in text.split(','):
+        (kind, _, weight) = item.partition('=')
+        if kind.strip() not in DEFAULT_MIX:
+            raise ValueError('Unknown event kind: {}'.format(kind))
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def write(path, events=None, size=None, version='3.0', mix=None, seed=1):
+    '''Writes events events (or about size bytes) of trace output to path, returns (events, bytes) written.'''
+    generator = TraceGenerator(version, mix, seed)
+    written = count = 0
+    with open(path, 'w', encoding='utf8', newline='\n') as f:
+        while (events is None or count < events) and (size is None or written < size):
+            text = generator.event()
+            f.write(text)
+            written += len(text.encode('utf8'))
+            count += 1
+    return (count, written)
+
+
+if __name__ == '__main__':
+    argsp = argparse.ArgumentParser()
+    argsp.add_argument('output', help='Trace log file to write')
+    argsp.add_argument('--events', type=int, help='Number of events')
+    argsp.add_argument('--size', type=float, help='Approximate size of the log, MB')
+    argsp.add_argument('--version', default='3.0', choices=VERSIONS, help='Firebird version of the output format')
+    argsp.add_argument('--mix', help='Event kind weights, like attach=2,transaction=20,statement=70,procedure=7,huge=1')
+    argsp.add_argument('--seed', type=int, default=1, help='Random seed; the same seed gives the same log')
+    args = argsp.parse_args()
+
+    if args.events is None and args.size is None:
+        args.events = 100000
+    (events, written) = write(args.output, args.events, args.size * 2**20 if args.size else None, args.version,
+        parseMix(args.mix) if args.mix else None, args.seed)
+    print('{} events, {:.1f} MB written to {}'.format(events, written / 2**20, args.output), file=sys.stderr)
@@ -4,6 +4,25 @@
     * '__DATABASENAME__' is a placeholder for absolute DB path, filled automatically from program .conf file. Not for manual modification!
     * Operations are delimited with 'At' symbol, used by Python str.split() mechanism.
     * Mark fields that should be parsed with '__PARSEDFIELD__' comment, and then add them to parse() method of event parser class.
+    * TRACE_DATA_PARSED.ID values are reserved from GEN_TRACE_DATA_PARSED by the dump process, so that child rows
+      (TRACE_TABLE_STATS) can be written in the same batch. The trigger only fills ID for rows inserted by hand.
+    * TRACE_DATA_PARSED.SQL_ID is the fingerprint of the statement (see eventdata.sqlFingerprint()), its text is
+      stored once in SQL_STATEMENTS: the normalized text and the full text of the first execution seen.
+    * Raw event text goes to RAW_OUTPUT or, with rawOutput = zlib in program .conf file, to RAW_OUTPUT_ZLIB
+      (read it back with eventdata.decompressRawOutput()).
+    * TRACE_DATA_PARSED.SOURCE_HOST is the traced host (traced_db section of program .conf file) the event comes from,
+      NULL for events parsed from a log file.
+    * With pairEvents in program .conf file, an opening event (EXECUTE_STATEMENT_START, START_TRANSACTION, ATTACH_DATABASE)
+      is not written as a row of its own: its closing event (EXECUTE_STATEMENT_FINISH, COMMIT/ROLLBACK_TRANSACTION,
+      DETACH_DATABASE) row gets START_TIME (DATE_TIME of the opening event) and ELAPSED_MS. Opening events without
+      the closing one (and closing ones without the opening one) are written as they are, with START_TIME NULL.
+    * FILE_CHECKPOINTS keeps how far each log file (FILE_ID is the hash of its head, see logfile.fileIdentity()) is dumped:
+      the events from byte FILE_OFFSET on, except the first SKIP_EVENTS of them. It is written in the same transaction
+      as the events, and the next --file run over the same file goes on from there. With pairing, the next REPLAY_EVENTS
+      events are parsed again only to restore the PAIRS_HELD opening events that were waiting for their pairs.
+    * Operations marked with '__DEFERRED__' comment (indices for report queries) slow the inserts down. When the dump
+      database files are rotated (daily or by size), they are run on the file the dump has switched from, in the background,
+      and on the last file when the dump ends; otherwise they are run with the others when the database is created.
 */
 
 CREATE DATABASE '__DATABASENAME__'
@@ -15,6 +34,7 @@ DEFAULT CHARACTER SET WIN1251 COLLATION WIN1251
 CREATE TABLE TRACE_DATA_PARSED (
     ID              INTEGER NOT NULL,
     CREATED         TIMESTAMP DEFAULT current_timestamp,
+    SOURCE_HOST     VARCHAR(255),                           /*__PARSEDFIELD__*/
     DATE_TIME       TIMESTAMP,                              /*__PARSEDFIELD__*/
     EVENT_NAME      VARCHAR(31),                            /*__PARSEDFIELD__*/
     TRANSACTIONID   INTEGER,                                /*__PARSEDFIELD__*/
@@ -23,12 +43,78 @@ CREATE TABLE TRACE_DATA_PARSED (
     LOCK_MODE       VARCHAR(15),                            /*__PARSEDFIELD__*/
     READ_MODE       VARCHAR(15),                            /*__PARSEDFIELD__*/
     ATTACHMENTID    BIGINT,                                 /*__PARSEDFIELD__*/
+    STATEMENT_ID    BIGINT,                                 /*__PARSEDFIELD__*/
     USER_NAME       VARCHAR(128),                           /*__PARSEDFIELD__*/
     REMOTE_ADDRESS  VARCHAR(255),                           /*__PARSEDFIELD__*/
     MODULE_NAME     VARCHAR(120),                           /*__PARSEDFIELD__*/
     MODULE_LINE     INTEGER,                                /*__PARSEDFIELD__*/
-    SQL_TEXT        BLOB SUB_TYPE 1 SEGMENT SIZE 80,        /*__PARSEDFIELD__*/
-    RAW_OUTPUT      BLOB SUB_TYPE 1 SEGMENT SIZE 80         /*__PARSEDFIELD__*/
+    DURATION_MS     INTEGER,                                /*__PARSEDFIELD__*/
+    RECORDS_FETCHED INTEGER,                                /*__PARSEDFIELD__*/
+    READS           INTEGER,                                /*__PARSEDFIELD__*/
+    WRITES          INTEGER,                                /*__PARSEDFIELD__*/
+    FETCHES         INTEGER,                                /*__PARSEDFIELD__*/
+    MARKS           INTEGER,                                /*__PARSEDFIELD__*/
+    SQL_ID          BIGINT,                                 /*__PARSEDFIELD__*/
+    START_TIME      TIMESTAMP,                              /*__PARSEDFIELD__*/
+    ELAPSED_MS      INTEGER,                                /*__PARSEDFIELD__*/
+    RAW_OUTPUT      BLOB SUB_TYPE 1 SEGMENT SIZE 80,        /*__PARSEDFIELD__*/
+    RAW_OUTPUT_ZLIB BLOB SUB_TYPE 0 SEGMENT SIZE 80         /*__PARSEDFIELD__*/
+)
+
+@
+/*__DEFERRED__*/
+CREATE DESCENDING INDEX TRACE_DATA_PARSED_DURATION ON TRACE_DATA_PARSED (DURATION_MS)
+
+@
+CREATE TABLE SQL_STATEMENTS (
+    ID              BIGINT NOT NULL PRIMARY KEY,
+    SQL_NORMALIZED  BLOB SUB_TYPE 1 SEGMENT SIZE 80,
+    SQL_TEXT        BLOB SUB_TYPE 1 SEGMENT SIZE 80
+)
+
+@
+CREATE TABLE TRACE_TABLE_STATS (
+    TRACE_DATA_ID   INTEGER NOT NULL,
+    TABLE_NAME      VARCHAR(255),
+    NATURAL_READS   INTEGER,
+    INDEX_READS     INTEGER,
+    UPDATES         INTEGER,
+    INSERTS         INTEGER,
+    DELETES         INTEGER,
+    BACKOUTS        INTEGER,
+    PURGES          INTEGER,
+    EXPUNGES        INTEGER
+)
+
+@
+/*__DEFERRED__*/
+CREATE INDEX TRACE_DATA_PARSED_DATE_TIME ON TRACE_DATA_PARSED (DATE_TIME)
+
+@
+/*__DEFERRED__*/
+CREATE INDEX TRACE_DATA_PARSED_MODULE ON TRACE_DATA_PARSED (MODULE_NAME, MODULE_LINE)
+
+@
+/*__DEFERRED__*/
+CREATE INDEX TRACE_DATA_PARSED_ATTACHMENT ON TRACE_DATA_PARSED (ATTACHMENTID)
+
+@
+/*__DEFERRED__*/
+CREATE INDEX TRACE_DATA_PARSED_TRANSACTION ON TRACE_DATA_PARSED (TRANSACTIONID)
+
+@
+/*__DEFERRED__*/
+CREATE INDEX TRACE_TABLE_STATS_DATA_ID ON TRACE_TABLE_STATS (TRACE_DATA_ID)
+
+@
+CREATE TABLE FILE_CHECKPOINTS (
+    FILE_ID         VARCHAR(40) NOT NULL PRIMARY KEY,
+    FILE_PATH       VARCHAR(1024),
+    FILE_OFFSET     BIGINT,
+    SKIP_EVENTS     INTEGER,
+    REPLAY_EVENTS   INTEGER,
+    PAIRS_HELD      INTEGER,
+    UPDATED         TIMESTAMP
 )
 
 @
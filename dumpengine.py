@@ -1,135 +1,886 @@
 import os
-from pathlib import Path
-import fdb
+import time
+import queue
+import pickle
+import datetime
+import threading
+from collections import deque, OrderedDict
+from itertools import count
+from multiprocessing import Pool, Process, Queue, Array
+import logfile
+import livestats
+import eventpairs
+from metrics import ProcessMetrics, PARSE_BUCKETS
 
-from appdata import Communicator, TracerMessage, TracerError, EOFReached
-from eventdata import EventData, EventParser
+from appdata import TracerMessage, TracerError, EOFReached
+from eventdata import EventData, EventParser, EventFilter, normalizeSql, isEventHeader, eventAttachment
+from dumpsinks import SINKS, DbScript
 
-_DB_NAME_PLACEHOLDER = '__DATABASENAME__'
-_PARSEDFIELD_MARK = '/*__PARSEDFIELD__*/'
+_ID_FIELD = 'ID'
+_IDLE_WAIT = 1.0
+_FILE_RANGE_SIZE = 8 * 1024 * 1024
+# sharded dump: how often the router sends the collected events to the workers
+_ROUTE_FLUSH = 0.1
+# adaptive sampling: how often the queue backlog is checked
+_SAMPLING_CHECK_LINES = 10000
+# rotated dump database: the next file is created this many seconds before midnight, or when the current one reaches
+# this part of maxDatabaseSize
+_PREPARE_AHEAD = 600
+_PREPARE_AT = 0.9
+# sharded dump: how often a worker checks whether the first one has created the file it switches to
+_CREATED_WAIT = 0.1
 _dumpEngine = None
 
 
-def run(dbPath, dbScriptPath, communicator):
+def _fileKey(day, part):
+    '''Rotated dump database file as a number, growing with the files: the sharded dump workers share the keys
+    of their current files.'''
+    return day.toordinal() * 10000 + part
+
+
+def _keyFile(key):
+    '''(day, part) of the file key.'''
+    return (datetime.date.fromordinal(key // 10000), key % 10000)
+
+
+def run(params, dbPath, dbScriptPath, communicator, jobs=1, statsParams=None, statsPath=None, metricsInterval=0, filtersParams=None,
+        dbFiles=None):
     global _dumpEngine
     if not _dumpEngine:
-        _dumpEngine = DumpEngine(dbPath, dbScriptPath, communicator)
-    _dumpEngine.createDb()
+        _dumpEngine = DumpEngine(params, dbPath, dbScriptPath, communicator, statsParams, statsPath, metricsInterval, filtersParams,
+            dbFiles=dbFiles)
+    if not _dumpEngine.createDb():
+        communicator.stop()
+        return
+    if params.workers > 1 and not communicator.sourcePath():
+        _dumpEngine.runShardedDump(params.workers)
+        return
+    _dumpEngine.connect()
+    if communicator.sourcePath():
+        _dumpEngine.loadCheckpoint()
+    if jobs > 1 and communicator.sourcePath() and not communicator.following():
+        _dumpEngine.runParallelDump(jobs)
+    else:
+        _dumpEngine.runDump()
+
+
+def runWorker(params, dbPath, dbScriptPath, communicator, worker, statsParams=None, statsQueue=None, metricsInterval=0,
+        filtersParams=None, dbFiles=None, fileKeys=None):
+    '''Worker process of the sharded dump. The engine is always created anew: the forked process inherits the router's one.'''
+    global _dumpEngine
+    _dumpEngine = DumpEngine(params, dbPath, dbScriptPath, communicator, statsParams, None, metricsInterval, filtersParams,
+        worker=worker, statsQueue=statsQueue, dbFiles=dbFiles, fileKeys=fileKeys)
     _dumpEngine.connect()
     _dumpEngine.runDump()
 
 
+class _KnownStatements:
+    '''LRU set of SQL fingerprints already written to SQL_STATEMENTS.'''
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._ids = OrderedDict()
+
+    def __contains__(self, sqlId):
+        if sqlId in self._ids:
+            self._ids.move_to_end(sqlId)
+            return True
+        return False
+
+    def add(self, sqlId):
+        self._ids[sqlId] = None
+        if len(self._ids) > self._capacity:
+            self._ids.popitem(last=False)
+
+
 class DumpEngine:
-    def __init__(self, dbPath, dbScriptPath, communicator):
+    '''worker is the number of the sharded dump worker (None if this is the only dumping process); its live stats are
+    sent to the router through statsQueue. dbFiles (DumpFiles) are set if the dump database is rotated: dbPath is
+    the latest file of today then, and the workers keep the key of their current file in fileKeys (shared Array),
+    negated once they have left the files for good.'''
+    def __init__(self, params, dbPath, dbScriptPath, communicator, statsParams=None, statsPath=None, metricsInterval=0,
+            filtersParams=None, worker=None, statsQueue=None, dbFiles=None, fileKeys=None):
+        self._params = params
+        self._statsParams = statsParams
+        self._filtersParams = filtersParams
+        self._metricsInterval = metricsInterval
+        self._worker = worker
+        self._statsQueue = statsQueue
+        self._routing = False
+        self._linesRouted = 0
         self._linesProcessed = 0
         self._eventsDumped = 0
-        self._connection = None
+        self._rowsWritten = 0
         self._dbPath = dbPath
         self._dbScriptPath = dbScriptPath
+        self._sink = SINKS[params.sink](dbPath, dbScriptPath)
+        self._batchSize = max(1, params.batchSize)
+        self._batchTimeout = params.batchTimeout
+        self._batch = list()
+        self._batchStarted = 0
+        self._knownStatements = _KnownStatements(params.statementCacheSize)
+        # rotated dump database: day and number of the current file, files created ahead of time,
+        # background threads creating the next file and building indices of the files left
+        self._dbFiles = dbFiles
+        self._fileKeys = fileKeys
+        self._fileDay = datetime.date.today()
+        self._filePart = dbFiles.lastPart(self._fileDay) if dbFiles else 1
+        self._preparedFiles = set()
+        self._creating = None
+        self._indexing = list()
+        self._filesRotated = 0
+        self._startTime = time.monotonic()
+        self._reportTime = self._startTime
+        self._reportRows = 0
+        self._rangesProgress = None
+        self._parseTime = 0.0
+        # file mode: position after the last parsed event as (file identity, offset, events from the offset),
+        # the one before it, and the number of events parsed; on resume the events to skip, then the events
+        # to replay to the pair index (see _checkpoint()) and the number of them it held
+        self._checkpoints = False
+        self._fileId = None
+        self._position = None
+        self._previousPosition = None
+        self._eventOrdinal = 0
+        self._skipEvents = 0
+        self._replayEvents = 0
+        self._pairsHeld = 0
+        self._replayPairs = None
+        self._resumedFrom = None
+        self._metrics = ProcessMetrics(type(self).__name__ if worker is None else '{}[{}]'.format(type(self).__name__, worker),
+            metricsInterval)
+        self._liveStats = None
+        if statsParams and statsParams.enabled:
+            self._liveStats = livestats.LiveStats(statsParams.topSize, statsParams.maxKeys)
+            self._statsInterval = statsParams.interval
+            self._statsPath = statsPath
+            self._statsTime = self._startTime
+        self._fieldNames = list()
         self._initEventDataFields()
-        self._parser = EventParser()
-        self._comm = Communicator(datastore=communicator._datastore, stop=communicator._stop, messages=communicator._messages) 
+        self._rawOutput = params.rawOutput
+        self._rawOutputPrefix = params.rawOutputPrefix
+        self._pairs = eventpairs.EventPairs(params.pairIndexSize, params.pairMaxAge) if params.pairEvents else None
+        self._parserFilter = None
+        self._rowFilter = None
+        self._eventsFiltered = 0
+        self._sampleBacklog = 0
+        self._minSampleRate = 1.0
+        self._sampleRate = 1.0
+        if filtersParams:
+            self._initFilters(filtersParams)
+        # trace mode: lines of every traced host are parsed separately, as they arrive interleaved
+        self._parsers = dict()
+        self._comm = communicator.clone()
 
     def createDb(self):
-        if os.path.exists(self._dbPath):
-            self._comm.pushMessage(TracerMessage('Dump database file already exists.'))
-            return
+        '''Returns False if the dump cannot go on: the existing database has been created by an earlier version
+        of the tracer and the files are not rotated. Rotated files go on with a new file of the day then.'''
+        if self._sink.exists():
+            if not self._outdated(self._dbPath):
+                self._comm.pushMessage(TracerMessage('Dump database file already exists.'))
+                return True
+            if not self._dbFiles:
+                return False
+            self._filePart += 1
+            self._dbPath = self._dbFiles.path(self._fileDay, self._filePart)
+            self._sink = SINKS[self._params.sink](self._dbPath, self._dbScriptPath)
         try:
-            self._createDb()
+            self._sink.create(deferred=self._dbFiles is None)
         except Exception as e:
             self._comm.pushMessage(TracerError(type(self), e))
         else:    
             self._comm.pushMessage(TracerMessage('Dump database file created: {}.'.format(self._dbPath)))
+        return True
+
+    def _outdated(self, path):
+        '''True if the existing dump database file lacks tables or columns of the script: batches written to it would fail.'''
+        try:
+            missing = SINKS[self._params.sink](path, self._dbScriptPath).missingSchema()
+        except Exception as e:
+            self._comm.pushMessage(TracerError(type(self), e))
+            return False
+        if missing and self._worker in (None, 0):
+            self._comm.pushMessage(TracerError(type(self), 'Dump database file {} schema is outdated, it has no {}: {}.'.format(
+                path, ', '.join(missing), 'a new file is started' if self._dbFiles else 'move it away or set another databaseName')))
+        return bool(missing)
 
     def connect(self):
-        if self._connected():
+        if self._sink.connected():
             self._comm.pushMessage(TracerError(type(self), 'Dump database is already connected.'))
         try:
-            self._connect()
+            self._sink.connect()
         except Exception as e:
             self._comm.pushMessage(TracerError(type(self), e))
         self._comm.pushMessage(TracerMessage('Connected to dump database.'))
 
     def runDump(self):
+        '''Runs until the input ends: EOF of the file (or stop request) in file mode, endOfData() from
+        the main process in trace mode. Lines already queued when stop is requested are still dumped.
+        Events are tagged with the traced host they come from (SOURCE_HOST).
+        Worker gets whole events from the router, so the last event of a block is complete and is dumped at once.'''
         while True:
             try:
-                line = self._comm.popLine()
-                if line:
-                    self._parser.parse(line)
+                line = self._comm.popLine(timeout=self._waitTimeout())
+                if line is not None:
+                    source = self._comm.lineSource()
+                    parser = self._parsers.get(source) or self._newParser(source)
+                    started = time.perf_counter()
+                    parser.parse(line)
+                    self._parseTime += time.perf_counter() - started
                     self._linesProcessed += 1
-                    event = self._parser.popEvent()
+                    if self._sampleBacklog and self._linesProcessed % _SAMPLING_CHECK_LINES == 0:
+                        self._adjustSampling()
+                    event = parser.popEvent()
                     if event:
-                        self._dump(event)
-                        self._eventsDumped += 1
-                        if self._eventsDumped % 10000 == 0:
-                            self._comm.pushMessage(TracerMessage('Dumped {} events, {} lines processed, {} lines left.'.format(
-                                self._eventsDumped, self._linesProcessed, self._comm.linesLeft())
-                                )
-                            )
+                        self._parsedEvent(event, source)
+                        if self._checkpoints:
+                            (identity, blockOffset, lineIndex) = self._comm.filePosition()
+                            self._trackPosition(identity, blockOffset, lineIndex == 0)
+                    self._dumpEvent(event)
+                    if self._worker is not None and self._comm.endOfBlock():
+                        parser.finish()
+                        event = parser.popEvent()
+                        if event:
+                            self._parsedEvent(event, source)
+                        self._dumpEvent(event)
+                else:
+                    self._reportStats()
+                    if self._metrics.due():
+                        self._sendMetrics()
+                    if not self._batch:
+                        self._rotateIfDue()
+                if self._batchExpired():
+                    self._flush()
             except EOFReached:
-                print('\nAll data has been processed. Exiting...')
-                self._comm.stop()
+                for (source, parser) in self._parsers.items():
+                    parser.finish()
+                    event = parser.popEvent()
+                    if event:
+                        event.SOURCE_HOST = source
+                        if self._checkpoints:
+                            self._trackPosition(*self._comm.filePosition()[:2], False)
+                    self._dumpEvent(event)
+                self._dumpOpenEvents()
+                self._flush()
+                if not self._comm.stopped():
+                    print('\nAll data has been processed. Exiting...')
+                    self._comm.stop()
                 break
             except Exception as e:
                 self._comm.pushMessage(TracerError(type(self), e))        
-            if self._comm.stopped():
-                break
+        self._flush()
+        self._reportStats(force=True)
+        self._sendMetrics()
+        self._waitFiles()
+        self.disconnect()
+        self._indexLastFiles()
+
+    def runParallelDump(self, jobs):
+        '''File mode only: the file is split into ranges of whole events, which are parsed by a pool of jobs processes.
+        Parsed events are dumped in file order.'''
+        path = self._comm.sourcePath()
+        try:
+            ranges = logfile.splitByEvents(path, _FILE_RANGE_SIZE, self._position[1] if self._position else 0)
+        except Exception as e:
+            self._comm.pushMessage(TracerError(type(self), e))
+            ranges = list()
+        self._comm.pushMessage(TracerMessage('Parsing {} in {} ranges with {} processes.'.format(path, len(ranges), jobs)))
+        self._rangesProgress = (0, ranges[-1][1] if ranges else 0)
+        with Pool(jobs, initializer=EventData.setFields, initargs=(self._fieldNames,)) as pool:
+            pending = deque()
+            for (start, end) in ranges:
+                if self._comm.stopped():
+                    break
+                pending.append((start, end, pool.apply_async(logfile.parseRange, (path, start, end, self._rawOutput, self._rawOutputPrefix,
+                    self._parserFilter))))
+                if len(pending) > jobs * 2:
+                    self._dumpParsedRange(pending.popleft())
+            while pending and not self._comm.stopped():
+                self._dumpParsedRange(pending.popleft())
+        self._dumpOpenEvents()
+        self._flush()
+        self._reportStats(force=True)
+        self._sendMetrics()
+        if not self._comm.stopped():
+            print('\nAll data has been processed. Exiting...')
+            self._comm.stop()
+        self._waitFiles()
         self.disconnect()
+        self._indexLastFiles()
+
+    def runShardedDump(self, workers):
+        '''Trace mode: events are parsed and dumped by workers processes, each with its own dump database connection
+        and channel. This process only splits the lines of every traced host into events and routes them by attachment,
+        so all the events of an attachment are dumped by one worker, in their order; events without attachment
+        (service and trace session ones) go to the first worker. Live stats of the workers are merged here.'''
+        self._routing = True
+        channels = [self._comm.newChannel() for _ in range(workers)]
+        statsQueue = Queue() if self._liveStats else None
+        fileKeys = Array('q', [_fileKey(self._fileDay, self._filePart)] * workers) if self._dbFiles else None
+        processes = [Process(target=runWorker, args=(self._params, self._dbPath, self._dbScriptPath, channel, worker,
+            self._statsParams, statsQueue, self._metricsInterval, self._filtersParams, self._dbFiles, fileKeys,))
+            for (worker, channel) in enumerate(channels)]
+        for process in processes:
+            process.start()
+        self._comm.pushMessage(TracerMessage('Dumping with {} worker processes.'.format(workers)))
+        workerStats = dict()
+        outputs = dict()
+        # source -> lines of its event being collected
+        events = dict()
+        flushed = time.monotonic()
+        while True:
+            try:
+                line = self._comm.popLine(timeout=_ROUTE_FLUSH)
+                if line is not None:
+                    source = self._comm.lineSource()
+                    lines = events.get(source)
+                    if lines and isEventHeader(line):
+                        self._routeEvent(source, lines, channels, outputs)
+                        lines = None
+                    if lines is None:
+                        lines = events[source] = list()
+                    lines.append(line)
+                if line is None or time.monotonic() - flushed >= _ROUTE_FLUSH:
+                    for output in outputs.values():
+                        output.flushLines()
+                    flushed = time.monotonic()
+                    self._mergeWorkerStats(statsQueue, workerStats)
+                    self._reportStats()
+                    if self._metrics.due():
+                        self._sendMetrics()
+            except EOFReached:
+                for (source, lines) in events.items():
+                    if lines:
+                        self._routeEvent(source, lines, channels, outputs)
+                break
+            except Exception as e:
+                self._comm.pushMessage(TracerError(type(self), e))
+        for output in outputs.values():
+            output.flushLines()
+        for channel in channels:
+            channel.endOfData()
+        for process in processes:
+            # the workers do not end until their stats are taken from the queue
+            while statsQueue is not None and process.is_alive():
+                self._mergeWorkerStats(statsQueue, workerStats, timeout=_ROUTE_FLUSH)
+            process.join()
+        self._mergeWorkerStats(statsQueue, workerStats)
+        for channel in channels:
+            channel.close()
+        self._reportStats(force=True)
+        self._sendMetrics()
+
+    def _routeEvent(self, source, lines, channels, outputs):
+        attachment = eventAttachment(lines)
+        worker = hash((source, attachment)) % len(channels) if attachment else 0
+        output = outputs.get((worker, source))
+        if output is None:
+            output = outputs[(worker, source)] = channels[worker].clone(source=source)
+        output.pushLines(lines)
+        self._linesRouted += len(lines)
+
+    def _mergeWorkerStats(self, statsQueue, workerStats, timeout=0):
+        '''Router: the latest live stats of every worker are merged into the live stats to report.'''
+        if statsQueue is None:
+            return
+        try:
+            while True:
+                (worker, stats) = statsQueue.get(timeout=timeout) if timeout else statsQueue.get(block=False)
+                workerStats[worker] = pickle.loads(stats)
+                timeout = 0
+        except queue.Empty:
+            pass
+        if workerStats:
+            self._liveStats = livestats.LiveStats(self._statsParams.topSize, self._statsParams.maxKeys)
+            for stats in workerStats.values():
+                self._liveStats.merge(stats)
+
+    def _newParser(self, source):
+        parser = self._parsers[source] = EventParser(self._rawOutput, self._rawOutputPrefix, self._parserFilter)
+        parser.sampleRate = self._sampleRate
+        return parser
+
+    def _initFilters(self, filtersParams):
+        '''Events are filtered by the parsers. Paired events are dropped (or not) together, so with pairEvents
+        the parsers check only the header and attachment, and the rows are checked after pairing.'''
+        eventFilter = EventFilter(filtersParams.excludeEvents, filtersParams.excludeUsers, filtersParams.excludeAddresses,
+            filtersParams.excludeModules, filtersParams.minDuration)
+        if eventFilter and self._pairs:
+            self._parserFilter = eventFilter.early()
+            self._rowFilter = eventFilter
+        elif eventFilter:
+            self._parserFilter = eventFilter
+        self._sampleBacklog = filtersParams.sampleBacklog
+        self._minSampleRate = filtersParams.minSampleRate
+
+    def _adjustSampling(self):
+        '''Trace mode: while more than sampleBacklog lines wait in the queue, only a part of attachments is dumped:
+        sampleBacklog / backlog of them, but not less than minSampleRate. In the sharded dump the backlog counts
+        the lines waiting for the router and for all the workers, so every worker samples at the same rate.'''
+        backlog = self._comm.linesLeft()
+        rate = 1.0 if backlog <= self._sampleBacklog else max(self._minSampleRate, self._sampleBacklog / backlog)
+        if rate < 1.0 and self._sampleRate == 1.0:
+            self._comm.pushMessage(TracerMessage('{} lines are waiting, sampling {:.0%} of attachments.'.format(backlog, rate)))
+        elif rate == 1.0 and self._sampleRate < 1.0:
+            self._comm.pushMessage(TracerMessage('Queue backlog is {} lines, sampling is off.'.format(backlog)))
+        self._sampleRate = rate
+        for parser in self._parsers.values():
+            parser.sampleRate = rate
+
+    def _parsedEvent(self, event, source):
+        event.SOURCE_HOST = source
+        self._metrics.observe('dump_parse_seconds', self._parseTime, PARSE_BUCKETS)
+        self._parseTime = 0.0
+
+    def _dumpParsedRange(self, pendingRange):
+        (start, end, result) = pendingRange
+        try:
+            (events, seconds, filtered) = result.get()
+            self._eventsFiltered += filtered
+            if events:
+                self._metrics.observe('dump_parse_seconds', seconds / len(events), PARSE_BUCKETS, count=len(events))
+            for (index, event) in enumerate(events, 1):
+                if self._checkpoints:
+                    self._previousPosition = (self._fileId, start, index - 1)
+                    self._position = (self._fileId, start, index)
+                self._dumpEvent(event)
+        except Exception as e:
+            self._comm.pushMessage(TracerError(type(self), e))
+        if self._checkpoints:
+            self._position = (self._fileId, end, 0)
+        self._rangesProgress = (end, self._rangesProgress[1])
+
+    def _dumpEvent(self, event):
+        '''The batch is flushed once all the rows of the event are in it, so that its checkpoint does not
+        cover rows that are still to come.'''
+        if event:
+            self._eventOrdinal += 1
+            if self._skipEvents:
+                # dumped by the previous run
+                self._skipEvents -= 1
+                return
+            if self._replayEvents:
+                self._replayEvent(event)
+                return
+            if self._pairs:
+                for row in self._pairs.add(event, self._pairTag()):
+                    self._dumpRow(row)
+            else:
+                self._dumpRow(event)
+            if len(self._batch) >= self._batchSize:
+                self._flush()
+
+    def _pairTag(self):
+        '''Where the event comes from: position before it and its number, for the checkpoint.'''
+        return (self._previousPosition, self._eventOrdinal) if self._checkpoints else None
+
+    def _replayEvent(self, event):
+        '''Resumed run: the events the previous run had parsed from its checkpoint on are dumped already, or were
+        held in the pair index. They go to a pair index again, with no limits, and the rows it gives are not dumped.
+        After the last of them the index is left with the events held before (the newest ones: older are the ones
+        the previous run has dumped unpaired), which go to the pair index, or are dumped if pairing is off now.'''
+        self._replayPairs.add(event, self._pairTag())
+        self._replayEvents -= 1
+        if self._replayEvents:
+            return
+        self._replayPairs.trim(self._pairsHeld)
+        for (held, tag) in self._replayPairs.held():
+            for row in self._pairs.add(held, tag) if self._pairs else (held,):
+                self._dumpRow(row)
+        self._replayPairs = None
+        self._resumedFrom = None
+
+    def _dumpOpenEvents(self):
+        '''Input is over: events still waiting for their pairs are dumped as they are.'''
+        if self._pairs:
+            for row in self._pairs.flush():
+                self._dumpRow(row)
+
+    def _dumpRow(self, event):
+        if self._rowFilter and self._rowFilter.dropsEvent(event):
+            self._eventsFiltered += 1
+            return
+        self._dump(event)
+        self._eventsDumped += 1
+        if self._eventsDumped % 10000 == 0:
+            self._reportProgress()
+        if self._liveStats:
+            self._liveStats.add(event)
+            self._reportStats()
+        if self._metrics.due():
+            self._sendMetrics()
+
+    def _waitTimeout(self):
+        if self._batch:
+            return max(0, self._batchTimeout - (time.monotonic() - self._batchStarted))
+        return _IDLE_WAIT
 
     def _dump(self, event):
+        if not self._batch:
+            self._batchStarted = time.monotonic()
+        self._batch.append(event)
+
+    def _batchExpired(self):
+        return self._batch and time.monotonic() - self._batchStarted >= self._batchTimeout
+
+    def _flush(self):
+        if not self._batch:
+            return
+        rows = self._batch
+        self._batch = list()
+        started = time.perf_counter()
+        try:
+            self._assignIds(rows)
+            self._write(rows)
+        except Exception as e:
+            self._sink.rollback()
+            self._metrics.inc('dump_batch_failures_total')
+            self._comm.pushMessage(TracerError(type(self), 'Batch of {} rows failed ({}), retrying row by row.'.format(len(rows), e)))
+            self._dumpRowByRow(rows)
+        self._metrics.observe('dump_flush_seconds', time.perf_counter() - started)
+        self._rotateIfDue()
+
+    def _rotateIfDue(self):
+        '''Rotated dump database: switches to the next file, when the day is over or the current file has grown
+        over maxSize, between batches. Otherwise creates the next file ahead of time, when it is about to be needed.
+        In the sharded dump only the first worker checks the day and the size, creates files and builds indices:
+        the others switch to the file of the first one, once it is there, so no file is created by two processes.'''
+        if not self._dbFiles:
+            return
         try:
-            self._connection.begin()
-            cur = self._connection.cursor()
-            fields = vars(event)
-            fieldNames = ','.join(tuple(fields.keys()))
-            fieldValues = tuple(fields.values())
-            placeholders = ','.join('?'*len(fields))
-            cur.execute('insert into trace_data_parsed ({}) values ({}) '.format(fieldNames, placeholders), fieldValues)
+            if self._worker not in (None, 0):
+                creatorKey = self._fileKeys[0]
+                if creatorKey > _fileKey(self._fileDay, self._filePart):
+                    self._switchFile(*_keyFile(creatorKey))
+                return
+            today = datetime.date.today()
+            size = os.path.getsize(self._dbPath) if self._dbFiles.maxSize else 0
+            if self._dbFiles.daily and today != self._fileDay:
+                self._switchFile(today, self._dbFiles.lastPart(today))
+            elif self._dbFiles.maxSize and size >= self._dbFiles.maxSize:
+                self._switchFile(self._fileDay, self._filePart + 1)
+            elif self._worker in (None, 0):
+                self._prepareNextFile(size)
         except Exception as e:
-            self._connection.rollback()
             self._comm.pushMessage(TracerError(type(self), e))
-        self._connection.commit()
 
-    def disconnect(self):
-        if not self._connected():
-            self._comm.pushMessage(TracerError(type(self), 'Database is already disconnected.'))        
+    def _prepareNextFile(self, size):
+        nextFiles = list()
+        if self._dbFiles.maxSize and size >= self._dbFiles.maxSize * _PREPARE_AT:
+            nextFiles.append(self._dbFiles.path(self._fileDay, self._filePart + 1))
+        tomorrow = self._fileDay + datetime.timedelta(days=1)
+        if self._dbFiles.daily and (datetime.datetime.combine(tomorrow, datetime.time()) - datetime.datetime.now()).total_seconds() < _PREPARE_AHEAD:
+            nextFiles.append(self._dbFiles.path(tomorrow))
+        for path in nextFiles:
+            if path not in self._preparedFiles and not (self._creating and self._creating.is_alive()):
+                self._preparedFiles.add(path)
+                self._creating = threading.Thread(target=self._createFile, args=(path,))
+                self._creating.start()
+
+    def _createFile(self, path):
+        '''Deferred operations are run when the dump switches from the file. Runs in a background thread, too.'''
+        sink = SINKS[self._params.sink](path, self._dbScriptPath)
         try:
-            self._disconnect()
+            if not sink.exists():
+                sink.create(deferred=False)
+                self._comm.pushMessage(TracerMessage('Dump database file created: {}.'.format(path)))
         except Exception as e:
             self._comm.pushMessage(TracerError(type(self), e))
+
+    def _switchFile(self, day, part):
+        '''The new file is connected before the current one is disconnected, and gets the next batch.
+        Statement texts are written to the new file again, so that every file has the texts of its events.
+        In file mode the checkpoint goes to the new file at once: a resumed run reads it from the latest file.
+        Files are created by one process only: the other workers of the sharded dump wait for the first one
+        to switch to the file (or a later one, if the file was outdated), and go on with its file then.'''
+        if self._worker in (None, 0):
+            if self._creating:
+                self._creating.join()
+            path = self._dbFiles.path(day, part)
+            while os.path.exists(path) and self._outdated(path):
+                part += 1
+                path = self._dbFiles.path(day, part)
+            if not os.path.exists(path):
+                # not created ahead of time
+                self._createFile(path)
         else:
-            self._comm.pushMessage(TracerMessage('Disconnected from Dump database.'))
+            creatorKey = self._creatorKey(_fileKey(day, part))
+            if creatorKey is None:
+                return
+            (day, part) = _keyFile(creatorKey)
+            path = self._dbFiles.path(day, part)
+        sink = SINKS[self._params.sink](path, self._dbScriptPath)
+        sink.connect()
+        checkpoint = self._checkpoint() if self._checkpoints else None
+        if checkpoint:
+            sink.writeCheckpoint(checkpoint[0], self._comm.sourcePath(), checkpoint[1])
+            sink.commit(hard=True)
+        try:
+            # ends the transaction of the file left
+            self._sink.disconnect()
+        except Exception as e:
+            self._comm.pushMessage(TracerError(type(self), e))
+        closedPath = self._dbPath
+        closedKey = _fileKey(self._fileDay, self._filePart)
+        self._sink = sink
+        self._dbPath = path
+        self._fileDay = day
+        self._filePart = part
+        self._knownStatements = _KnownStatements(self._params.statementCacheSize)
+        self._filesRotated += 1
+        if self._fileKeys is not None:
+            self._fileKeys[self._worker] = _fileKey(day, part)
+        self._comm.pushMessage(TracerMessage('{}Switched to dump database file {}.'.format(
+            'Worker {}: '.format(self._worker) if self._worker is not None else '', path)))
+        if self._worker in (None, 0):
+            indexing = threading.Thread(target=self._createDeferred, args=(closedPath, closedKey))
+            indexing.start()
+            self._indexing.append(indexing)
 
-    def _createDb(self):
-        scriptFile = Path(self._dbScriptPath)
-        script = ''
-        with scriptFile.open() as f:
-            script = f.read()
-        script = script.replace(_DB_NAME_PLACEHOLDER, self._dbPath).split('@')
-        for operation in script:
-            if 'CREATE DATABASE' in operation.upper():
-                fdb.create_database(sql=operation)
-            else:
-                if not self._connected():
-                    self._connect()
-                self._connection.cursor().execute(operation)
-        if self._connected():
-            if self._connection.main_transaction.active:
-                self._connection.commit()
-            self._disconnect()
+    def _creatorKey(self, key):
+        '''Sharded dump: waits until the first worker has switched to the file of the key or a later one, so the file
+        is created. Returns the key of its file then, None if the first worker has left the files: this one stays
+        with its file.'''
+        while 0 <= self._fileKeys[0] < key:
+            time.sleep(_CREATED_WAIT)
+        creatorKey = self._fileKeys[0]
+        return creatorKey if creatorKey >= 0 else None
 
-    def _initEventDataFields(self):
-        scriptFile = Path(self._dbScriptPath)
-        fieldNames = list()
-        with scriptFile.open() as f:
-            fieldNames = [line.split(maxsplit=1)[0] for line in f if _PARSEDFIELD_MARK in line]
-            EventData.setFields(fieldNames)
+    def _createDeferred(self, path, key=None):
+        '''Background thread: indices of the file the dump has switched from (key is set).
+        The other workers of the sharded dump go on writing to the file until their next batch or idle check,
+        so the indices are built once every worker has switched to a later file or has left the files.'''
+        while key is not None and self._fileKeys is not None and any(0 <= other <= key for other in self._fileKeys):
+            time.sleep(_IDLE_WAIT)
+        started = time.monotonic()
+        try:
+            SINKS[self._params.sink](path, self._dbScriptPath).createDeferred()
+        except Exception as e:
+            self._comm.pushMessage(TracerError(type(self), e))
+        else:
+            self._comm.pushMessage(TracerMessage('Indices of {} built in {:.1f} s.'.format(path, time.monotonic() - started)))
+
+    def _waitFiles(self):
+        '''Files are not left half-created, nor without their indices.'''
+        if self._creating:
+            self._creating.join()
+        if any(indexing.is_alive() for indexing in self._indexing):
+            self._comm.pushMessage(TracerMessage('Waiting for the indices of the dump database files to be built...'))
+        for indexing in self._indexing:
+            indexing.join()
+
+    def _indexLastFiles(self):
+        '''Rotated dump database: the indices of the file the dump ends with are built once it is disconnected,
+        so that no file is left without them. In the sharded dump every worker tells it has left its file,
+        the first one waits for the others and builds the indices of the last files of them all.'''
+        if not self._dbFiles:
+            return
+        key = _fileKey(self._fileDay, self._filePart)
+        paths = [self._dbPath]
+        if self._fileKeys is not None:
+            self._fileKeys[self._worker] = -key
+            if self._worker != 0:
+                return
+            while any(other >= 0 for other in self._fileKeys):
+                time.sleep(_IDLE_WAIT)
+            paths = [self._dbFiles.path(*_keyFile(last)) for last in sorted({-other for other in self._fileKeys}) if last >= key]
+        for path in paths:
+            self._createDeferred(path)
+
+    def _dumpRowByRow(self, rows):
+        '''Failed rows are skipped. The checkpoint is saved after all rows, so a crash in between
+        makes the next run dump the rows of this batch once more.'''
+        for row in rows:
+            try:
+                if row.ID is None:
+                    self._assignIds((row,))
+                self._write((row,), checkpoint=False)
+            except Exception as e:
+                self._sink.rollback()
+                self._comm.pushMessage(TracerError(type(self), e))
+        checkpoint = self._checkpoint()
+        if checkpoint:
+            try:
+                self._sink.writeCheckpoint(checkpoint[0], self._comm.sourcePath(), checkpoint[1])
+                self._sink.commit()
+            except Exception as e:
+                self._sink.rollback()
+                self._comm.pushMessage(TracerError(type(self), e))
+
+    def _write(self, rows, checkpoint=True):
+        '''Writes the rows, their statements and table stats in one transaction, with the checkpoint in file mode.
+        The rows of the batch are the last events parsed, so the current position follows them.'''
+        statements = self._newStatements(rows)
+        self._sink.writeStatements(statements)
+        self._sink.writeEvents(rows)
+        self._sink.writeTableStats(self._tableStatsRows(rows))
+        checkpoint = self._checkpoint() if checkpoint else None
+        if checkpoint:
+            self._sink.writeCheckpoint(checkpoint[0], self._comm.sourcePath(), checkpoint[1])
+        self._sink.commit()
+        self._rememberStatements(statements)
+        self._rowsWritten += len(rows)
+
+    def _checkpoint(self):
+        '''(file identity, (offset, events to skip, events to replay, events held)) to save with the rows written,
+        None if there is no position. Events held in the pair index are not dumped yet, so with any of them the
+        checkpoint is the position before the oldest one: the resumed run skips the events before it, and replays
+        the events from it on to the pair index (see _replayEvent()). Events held from a followed file that has
+        been rotated since are not kept.'''
+        if self._resumedFrom:
+            # still replaying: the checkpoint loaded holds
+            return self._resumedFrom
+        if not self._position or not self._position[0]:
+            return None
+        (identity, offset, skip) = self._position
+        oldest = self._pairs.oldestTag() if self._pairs else None
+        if oldest and oldest[0] and oldest[0][0] == identity:
+            (position, ordinal) = oldest
+            return (identity, (position[1], position[2], self._eventOrdinal - ordinal + 1, self._pairs.count()))
+        return (identity, (offset, skip, 0, 0))
+
+    def _assignIds(self, rows):
+        '''IDs are reserved for the whole batch at once, so that table stats rows can refer to them.'''
+        for (row, rowId) in zip(rows, count(self._sink.reserveIds(len(rows)))):
+            row.ID = rowId
+
+    def loadCheckpoint(self):
+        '''File mode: if the file has been dumped to this database before (maybe partly), it is read from
+        the checkpoint on, and the events from the checkpoint offset already dumped are skipped.'''
+        path = self._comm.sourcePath()
+        try:
+            identity = logfile.fileIdentity(path, growing=self._comm.following())
+            checkpoint = self._sink.readCheckpoint(identity) if identity else None
+        except Exception as e:
+            self._comm.pushMessage(TracerMessage('File checkpoints are not available, the file will be dumped from the start: {}'.format(e)))
+            return
+        # followed file may have no identity yet, its blocks will get it later
+        self._checkpoints = True
+        self._fileId = identity
+        if not checkpoint:
+            return
+        (offset, skipEvents, replayEvents, pairsHeld) = checkpoint
+        if offset > os.path.getsize(path):
+            self._comm.pushMessage(TracerMessage('Checkpoint of {} is beyond its end, the file will be dumped from the start.'.format(path)))
+            return
+        self._comm.seekFile(offset)
+        # skipped events move the position from the offset again
+        self._position = (identity, offset, 0)
+        self._skipEvents = skipEvents
+        if replayEvents:
+            self._replayEvents = replayEvents
+            self._pairsHeld = pairsHeld
+            self._replayPairs = eventpairs.EventPairs(replayEvents)
+            self._resumedFrom = (identity, checkpoint)
+        self._comm.pushMessage(TracerMessage('Resuming {} from byte {} of {} (checkpoint of the previous run{}).'.format(
+            path, offset, os.path.getsize(path), ', {} events waiting for their pairs'.format(pairsHeld) if replayEvents else '')))
+
+    def _trackPosition(self, identity, blockOffset, completedByBlockStart):
+        '''Position after the event just parsed: (file, offset of a block, number of events parsed from the block start).
+        An event completed by the first line of a block (its event header) is the last one before the block;
+        when followed file is rotated, it is the last event of the old file, and the new file is dumped from its start.'''
+        self._previousPosition = self._position or (identity, 0, 0)
+        if not self._position or blockOffset != self._position[1] or identity != self._position[0]:
+            self._position = (identity, blockOffset, 0)
+        if not completedByBlockStart:
+            self._position = (identity, blockOffset, self._position[2] + 1)
+
+    def _newStatements(self, rows):
+        '''Texts of the statements not known to be in SQL_STATEMENTS yet, as (SQL_ID, SQL_NORMALIZED, SQL_TEXT) rows.'''
+        statements = dict()
+        for row in rows:
+            if row.SQL_ID is not None and row.SQL_ID not in statements and row.SQL_ID not in self._knownStatements:
+                statements[row.SQL_ID] = (row.SQL_ID, normalizeSql(row.sqlText), row.sqlText)
+        return list(statements.values())
+
+    def _rememberStatements(self, statements):
+        for statement in statements:
+            self._knownStatements.add(statement[0])
+
+    def _tableStatsRows(self, rows):
+        return [(row.ID,) + stats for row in rows if row.tableStats for stats in row.tableStats]
+
+    def _reportProgress(self):
+        now = time.monotonic()
+        elapsed = now - self._reportTime
+        rate = (self._rowsWritten - self._reportRows) / elapsed if elapsed > 0 else 0
+        self._reportTime = now
+        self._reportRows = self._rowsWritten
+        progress = self._comm.progress() or self._rangesProgress
+        if self._comm.following():
+            (done, total) = progress
+            self._comm.pushMessage(TracerMessage('Dumped {} events ({:.0f} rows/s), {:.1f} MB of the followed file not read yet.'.format(
+                self._eventsDumped, rate, max(0, total - done) / 2**20)
+                )
+            )
+        elif progress:
+            (done, total) = progress
+            self._comm.pushMessage(TracerMessage('Dumped {} events ({:.0f} rows/s), {:.1f}% of file read, ETA {}.'.format(
+                self._eventsDumped, rate, 100 * done / total if total else 100, self._eta(done, total, now))
+                )
+            )
+        else:
+            self._comm.pushMessage(TracerMessage('{}Dumped {} events ({:.0f} rows/s), {} lines processed, {} lines left ({:.1f} MB spilled).'.format(
+                'Worker {}: '.format(self._worker) if self._worker is not None else '', self._eventsDumped, rate, self._linesProcessed, self._comm.linesLeft(), self._comm.spilledBytes() / 2**20)
+                )
+            )
+
+    def _reportStats(self, force=False):
+        '''Every statsInterval seconds live stats snapshot is written to the stats file, and its summary is logged.'''
+        if not self._liveStats:
+            return
+        now = time.monotonic()
+        if not force and now - self._statsTime < self._statsInterval:
+            return
+        self._statsTime = now
+        if self._statsQueue is not None:
+            # pickled at once: the queue pickles in its own thread, while the stats go on changing
+            self._statsQueue.put((self._worker, pickle.dumps(self._liveStats)))
+            return
+        snapshot = self._liveStats.snapshot()
+        self._comm.pushMessage(TracerMessage(self._liveStats.summaryText(snapshot)))
+        try:
+            livestats.writeSnapshot(self._statsPath, snapshot)
+        except Exception as e:
+            self._comm.pushMessage(TracerError(type(self), e))
 
-    def _connect(self):
-        self._connection = fdb.connect(database=self._dbPath, user='SYSDBA', password='masterke', charset='WIN1251')
+    def _sendMetrics(self):
+        '''The age of the oldest line is sent by the process reading the main channel, not by the workers.'''
+        if self._routing:
+            self._metrics.total('dump_lines_routed_total', self._linesRouted)
+        else:
+            self._metrics.total('dump_lines_processed_total', self._linesProcessed)
+            self._metrics.total('dump_events_total', self._eventsDumped)
+            self._metrics.total('dump_rows_written_total', self._rowsWritten)
+            if self._dbFiles:
+                self._metrics.total('dump_db_files_rotated_total', self._filesRotated)
+            if self._pairs:
+                self._metrics.total('dump_events_paired_total', self._pairs.paired)
+                self._metrics.total('dump_pair_evictions_total', self._pairs.evicted)
+            if self._parserFilter or self._rowFilter or self._sampleBacklog:
+                self._metrics.total('dump_events_filtered_total',
+                    self._eventsFiltered + sum(parser.filtered for parser in self._parsers.values()))
+                self._metrics.total('dump_events_sampled_out_total', sum(parser.sampledOut for parser in self._parsers.values()))
+        if self._worker is None:
+            self._metrics.set('oldest_unprocessed_age_seconds', round(self._comm.oldestLineAge(), 3))
+        self._metrics.send(self._comm)
+
+    def _eta(self, done, total, now):
+        if not done:
+            return 'unknown'
+        seconds = int((now - self._startTime) * (total - done) / done)
+        return '{:02}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
 
-    def _disconnect(self):
-        self._connection.close()
+    def disconnect(self):
+        if not self._sink.connected():
+            self._comm.pushMessage(TracerError(type(self), 'Database is already disconnected.'))        
+        try:
+            self._sink.disconnect()
+        except Exception as e:
+            self._comm.pushMessage(TracerError(type(self), e))
+        else:
+            self._comm.pushMessage(TracerMessage('Disconnected from Dump database.'))
 
-    def _connected(self):
-        return self._connection and not self._connection.closed
+    def _initEventDataFields(self):
+        fieldNames = [_ID_FIELD] + DbScript(self._dbScriptPath).parsedFields()
+        EventData.setFields(fieldNames)
+        self._fieldNames = fieldNames
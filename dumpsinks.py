@@ -0,0 +1,465 @@
+import os
+import re
+import datetime
+import sqlite3
+from pathlib import Path
+import fdb
+
+from eventdata import EventData, TABLESTATS_FIELDS
+
+_DB_NAME_PLACEHOLDER = '__DATABASENAME__'
+_PARSEDFIELD_MARK = '/*__PARSEDFIELD__*/'
+_DEFERRED_MARK = '/*__DEFERRED__*/'
+_OPERATION_DELIMITER = '@'
+
+# SQLite stores datetime values as text, the same way for every python version
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(' '))
+
+
+class DbScript:
+    '''Dump database creation script (db/create_db.sql): operations delimited with '@',
+    fields filled by the parser marked with __PARSEDFIELD__ comment, operations that may be deferred
+    until the database is not written any more (indices) marked with __DEFERRED__ comment.'''
+    def __init__(self, path):
+        with Path(path).open() as f:
+            self._text = f.read()
+
+    def operations(self, dbPath, deferred=True):
+        '''All the operations, without the deferred ones if deferred is not set.'''
+        return [operation for operation in self._text.replace(_DB_NAME_PLACEHOLDER, dbPath).split(_OPERATION_DELIMITER)
+            if operation.strip() and (deferred or _DEFERRED_MARK not in operation)]
+
+    def deferredOperations(self):
+        return [operation for operation in self._text.split(_OPERATION_DELIMITER) if _DEFERRED_MARK in operation]
+
+    def parsedFields(self):
+        return [line.split(maxsplit=1)[0] for line in self._text.splitlines() if _PARSEDFIELD_MARK in line]
+
+    def tables(self):
+        '''Columns of every table the script creates: table name -> column names, upper case.'''
+        tables = dict()
+        for operation in self._text.split(_OPERATION_DELIMITER):
+            table = _CREATE_TABLE_COLUMNS.match(_SQL_COMMENTS.sub('', operation))
+            if table:
+                definitions = [definition.split(maxsplit=1) for definition in _splitDefinitions(table.group(2))]
+                tables[table.group(1).upper()] = [definition[0].upper() for definition in definitions
+                    if definition and definition[0].upper() not in _CONSTRAINT_WORDS]
+        return tables
+
+
+class DumpSink:
+    '''Dump database backend of DumpEngine.
+    Everything written after the last commit() is one transaction, rollback() discards it.
+    Rows are EventData objects (the field list of EventData is the column list of TRACE_DATA_PARSED),
+    table stats rows are (TRACE_DATA_ID,) + TABLESTATS_FIELDS tuples, statements are
+    (ID, SQL_NORMALIZED, SQL_TEXT) tuples, that should be skipped if ID is already in SQL_STATEMENTS.
+    File checkpoint is (file offset, number of events from the offset already dumped, number of the next events to
+    replay to the pair index, number of them it held), kept in FILE_CHECKPOINTS by file identity (see logfile.fileIdentity()).'''
+    EXTENSION = ''
+
+    def __init__(self, dbPath, dbScriptPath):
+        self._dbPath = dbPath
+        self._dbScriptPath = dbScriptPath
+        self._connection = None
+
+    def exists(self):
+        return os.path.exists(self._dbPath)
+
+    def missingSchema(self):
+        '''Tables (as TABLE) and columns (as TABLE.COLUMN) of the script the existing database does not have:
+        it has been created by an earlier version of the tracer.'''
+        existing = self._columns()
+        missing = list()
+        for (table, columns) in DbScript(self._dbScriptPath).tables().items():
+            if table not in existing:
+                missing.append(table)
+            else:
+                missing.extend('{}.{}'.format(table, column) for column in columns if column not in existing[table])
+        return missing
+
+    def create(self, deferred=True):
+        '''Creates the database; without the deferred operations of the script, if deferred is not set.'''
+        raise NotImplementedError
+
+    def createDeferred(self):
+        '''Runs the deferred operations of the script with own connection, while the database is not written any more.
+        Indices the database has already are skipped: the dump may have been restarted on a file indexed before.'''
+        raise NotImplementedError
+
+    def connect(self):
+        raise NotImplementedError
+
+    def connected(self):
+        raise NotImplementedError
+
+    def disconnect(self):
+        raise NotImplementedError
+
+    def reserveIds(self, count):
+        '''Returns the first of count new consecutive TRACE_DATA_PARSED IDs. IDs are not given back on rollback.'''
+        raise NotImplementedError
+
+    def writeStatements(self, statements):
+        raise NotImplementedError
+
+    def writeEvents(self, rows):
+        raise NotImplementedError
+
+    def writeTableStats(self, rows):
+        raise NotImplementedError
+
+    def readCheckpoint(self, fileId):
+        '''Returns the checkpoint of the file, None if there is none.'''
+        raise NotImplementedError
+
+    def writeCheckpoint(self, fileId, filePath, checkpoint):
+        '''Replaces the checkpoint of the file, in the same transaction as the rows written with it.'''
+        raise NotImplementedError
+
+    def commit(self, hard=False):
+        '''Commits what is written. A backend that keeps its transaction context between commits ends it when hard
+        is set (and from time to time by itself).'''
+        raise NotImplementedError
+
+    def rollback(self):
+        raise NotImplementedError
+
+    def _columns(self):
+        '''Columns of the tables the database has, with own connection: table name -> set of column names, upper case.'''
+        raise NotImplementedError
+
+    def _insertEventsSql(self):
+        fields = EventData.fields()
+        return 'insert into trace_data_parsed ({}) values ({})'.format(','.join(fields), ','.join('?'*len(fields)))
+
+    def _insertTableStatsSql(self):
+        return 'insert into trace_table_stats (trace_data_id,{}) values (?,{})'.format(
+            ','.join(TABLESTATS_FIELDS), ','.join('?'*len(TABLESTATS_FIELDS)))
+
+
+class FirebirdSink(DumpSink):
+    '''Embedded Firebird database, created with db/create_db.sql as is.'''
+    EXTENSION = '.fdb'
+    _USER = 'SYSDBA'
+    _PASSWORD = 'masterke'
+    _CHARSET = 'WIN1251'
+    # every this many commits one ends the transaction: commits retaining the transaction context would hold
+    # the OIT/OAT of the dump database, and its garbage collection, for the whole session
+    _HARD_COMMIT_INTERVAL = 100
+
+    def __init__(self, dbPath, dbScriptPath):
+        super().__init__(dbPath, dbScriptPath)
+        self._retainedCommits = 0
+        self._cursor = None
+        self._insertStatement = None
+        self._insertStatsStatement = None
+        self._insertStatementTextStatement = None
+        self._reserveIdsStatement = None
+        self._writeCheckpointStatement = None
+
+    def create(self, deferred=True):
+        for operation in DbScript(self._dbScriptPath).operations(self._dbPath, deferred):
+            if 'CREATE DATABASE' in operation.upper():
+                fdb.create_database(sql=operation)
+            else:
+                if not self.connected():
+                    self._connect()
+                self._connection.cursor().execute(operation)
+        if self.connected():
+            if self._connection.main_transaction.active:
+                self._connection.commit()
+            self.disconnect()
+
+    def createDeferred(self):
+        connection = fdb.connect(database=self._dbPath, user=self._USER, password=self._PASSWORD, charset=self._CHARSET)
+        try:
+            cursor = connection.cursor()
+            for operation in DbScript(self._dbScriptPath).deferredOperations():
+                index = _indexName(operation)
+                if index:
+                    cursor.execute('SELECT 1 FROM RDB$INDICES WHERE RDB$INDEX_NAME = ?', (index,))
+                    if cursor.fetchone():
+                        continue
+                cursor.execute(operation)
+                connection.commit()
+        finally:
+            connection.close()
+
+    def connect(self):
+        self._connect()
+        self._prepareStatements()
+
+    def connected(self):
+        return self._connection and not self._connection.closed
+
+    def disconnect(self):
+        if self._connection.main_transaction.active:
+            self._connection.commit()
+        self._connection.close()
+
+    def reserveIds(self, count):
+        '''One generator call for the whole batch.'''
+        self._cursor.execute(self._reserveIdsStatement, (count,))
+        return self._cursor.fetchone()[0] - count + 1
+
+    def writeStatements(self, statements):
+        self._cursor.executemany(self._insertStatementTextStatement, statements)
+
+    def writeEvents(self, rows):
+        self._cursor.executemany(self._insertStatement, rows)
+
+    def writeTableStats(self, rows):
+        self._cursor.executemany(self._insertStatsStatement, rows)
+
+    def readCheckpoint(self, fileId):
+        self._cursor.execute('select file_offset, skip_events, replay_events, pairs_held from file_checkpoints where file_id = ?',
+            (fileId,))
+        row = self._cursor.fetchone()
+        return tuple(row) if row else None
+
+    def writeCheckpoint(self, fileId, filePath, checkpoint):
+        self._cursor.execute(self._writeCheckpointStatement, (fileId, filePath) + tuple(checkpoint) + (datetime.datetime.now(),))
+
+    def commit(self, hard=False):
+        '''Batches are committed retaining the transaction context, every _HARD_COMMIT_INTERVAL-th commit ends
+        the transaction (the statements stay prepared, the next batch starts a new one).'''
+        self._retainedCommits += 1
+        if hard or self._retainedCommits >= self._HARD_COMMIT_INTERVAL:
+            self._connection.commit()
+            self._retainedCommits = 0
+        else:
+            self._connection.commit(retaining=True)
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def _columns(self):
+        connection = fdb.connect(database=self._dbPath, user=self._USER, password=self._PASSWORD, charset=self._CHARSET)
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT TRIM(RDB$RELATION_NAME), TRIM(RDB$FIELD_NAME) FROM RDB$RELATION_FIELDS')
+            columns = dict()
+            for (table, column) in cursor.fetchall():
+                columns.setdefault(table, set()).add(column)
+            connection.commit()
+            return columns
+        finally:
+            connection.close()
+
+    def _connect(self):
+        self._connection = fdb.connect(database=self._dbPath, user=self._USER, password=self._PASSWORD, charset=self._CHARSET)
+
+    def _prepareStatements(self):
+        '''Prepared statements belong to the cursor they are prepared with, so all of them are run with one cursor.'''
+        self._cursor = self._connection.cursor()
+        self._insertStatement = self._cursor.prep(self._insertEventsSql())
+        self._insertStatsStatement = self._cursor.prep(self._insertTableStatsSql())
+        self._reserveIdsStatement = self._cursor.prep('select gen_id(gen_trace_data_parsed, ?) from rdb$database')
+        self._insertStatementTextStatement = self._cursor.prep('merge into sql_statements s '
+            'using (select cast(? as bigint) id from rdb$database) n on s.id = n.id '
+            'when not matched then insert (id, sql_normalized, sql_text) values (n.id, ?, ?)')
+        self._writeCheckpointStatement = self._cursor.prep('update or insert into file_checkpoints '
+            '(file_id, file_path, file_offset, skip_events, replay_events, pairs_held, updated) values (?, ?, ?, ?, ?, ?, ?) '
+            'matching (file_id)')
+        self._connection.commit()
+
+
+# Firebird -> SQLite translation of create_db.sql
+_SQL_COMMENTS = re.compile(r'/\*.*?\*/', re.DOTALL)
+_SQLITE_TYPES = (
+    (re.compile(r'\bBLOB\s+SUB_TYPE\s+(1|TEXT)\b(\s+SEGMENT\s+SIZE\s+\d+)?', re.IGNORECASE), 'TEXT'),
+    (re.compile(r'\bBLOB(\s+SUB_TYPE\s+\w+)?(\s+SEGMENT\s+SIZE\s+\d+)?', re.IGNORECASE), 'BLOB'),
+    (re.compile(r'\b(VAR)?CHAR\s*\(\s*\d+\s*\)', re.IGNORECASE), 'TEXT'),
+    (re.compile(r'\b(BIGINT|SMALLINT)\b', re.IGNORECASE), 'INTEGER'),
+    (re.compile(r'\bDEFAULT\s+CURRENT_TIMESTAMP\b', re.IGNORECASE), "DEFAULT (datetime('now', 'localtime'))"),
+)
+_CREATE_TABLE = re.compile(r'^\s*CREATE\s+TABLE\b', re.IGNORECASE)
+_CREATE_TABLE_COLUMNS = re.compile(r'^\s*CREATE\s+TABLE\s+(\w+)\s*\((.*)\)\s*$', re.IGNORECASE | re.DOTALL)
+# table definitions that are not columns
+_CONSTRAINT_WORDS = ('CONSTRAINT', 'PRIMARY', 'FOREIGN', 'UNIQUE', 'CHECK')
+_CREATE_INDEX = re.compile(r'^\s*CREATE\s+(UNIQUE\s+)?((ASC|ASCENDING|DESC|DESCENDING)\s+)?INDEX\s+(\w+)\s+ON\s+(\w+)\s*\((.*)\)\s*$',
+    re.IGNORECASE | re.DOTALL)
+_CREATE_SEQUENCE = re.compile(r'^\s*CREATE\s+(SEQUENCE|GENERATOR)\s+(\w+)\s*$', re.IGNORECASE)
+
+
+def _indexName(operation):
+    '''Name of the index the create_db.sql operation creates, None if it is not CREATE INDEX.'''
+    index = _CREATE_INDEX.match(_SQL_COMMENTS.sub('', operation))
+    return index.group(4).upper() if index else None
+
+
+def _splitDefinitions(text):
+    '''Column and constraint definitions of CREATE TABLE: split at the commas outside parentheses.'''
+    definitions = ['']
+    depth = 0
+    for char in text:
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        if char == ',' and not depth:
+            definitions.append('')
+        else:
+            definitions[-1] += char
+    return definitions
+
+
+def _sqliteOperations(operation):
+    '''Returns SQLite statements doing the same as the create_db.sql operation.
+    Database, trigger and other Firebird only operations give nothing.'''
+    operation = _SQL_COMMENTS.sub('', operation)
+    if _CREATE_TABLE.match(operation):
+        for (pattern, sqliteType) in _SQLITE_TYPES:
+            operation = pattern.sub(sqliteType, operation)
+        return [operation]
+    index = _CREATE_INDEX.match(operation)
+    if index:
+        (unique, _, order, name, table, columns) = index.groups()
+        descending = ' DESC' if order and order.upper().startswith('DESC') else ''
+        columns = ', '.join(column.strip() + descending for column in columns.split(','))
+        return ['CREATE {}INDEX {} ON {} ({})'.format('UNIQUE ' if unique else '', name, table, columns)]
+    sequence = _CREATE_SEQUENCE.match(operation)
+    if sequence:
+        return ["INSERT INTO SEQUENCES (NAME, VALUE) VALUES ('{}', 0)".format(sequence.group(2).upper())]
+    return list()
+
+
+class SQLiteSink(DumpSink):
+    '''Local SQLite database in WAL mode, no database server needed.
+    Tables, indices and sequences are translated from db/create_db.sql, so the columns are the same
+    as in Firebird database. Sequences are rows of SEQUENCES table.
+    Every batch is one transaction, so bigger batchSize makes ingest faster.'''
+    EXTENSION = '.sqlite'
+    _SEQUENCE = 'GEN_TRACE_DATA_PARSED'
+    # seconds to wait for the write lock: sharded dump workers write to one database by turns
+    _BUSY_TIMEOUT = 30.0
+
+    def __init__(self, dbPath, dbScriptPath):
+        super().__init__(dbPath, dbScriptPath)
+        self._insertEvents = None
+        self._insertTableStats = None
+
+    def create(self, deferred=True):
+        connection = sqlite3.connect(self._dbPath, isolation_level=None)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('BEGIN')
+            connection.execute('CREATE TABLE SEQUENCES (NAME TEXT NOT NULL PRIMARY KEY, VALUE INTEGER NOT NULL)')
+            for operation in DbScript(self._dbScriptPath).operations(self._dbPath, deferred):
+                for statement in _sqliteOperations(operation):
+                    connection.execute(statement)
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def createDeferred(self):
+        connection = sqlite3.connect(self._dbPath, isolation_level=None, timeout=self._BUSY_TIMEOUT)
+        try:
+            for operation in DbScript(self._dbScriptPath).deferredOperations():
+                index = _indexName(operation)
+                if index and connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND UPPER(name) = ?",
+                        (index,)).fetchone():
+                    continue
+                for statement in _sqliteOperations(operation):
+                    connection.execute(statement)
+        finally:
+            connection.close()
+
+    def connect(self):
+        self._connection = sqlite3.connect(self._dbPath, isolation_level=None, timeout=self._BUSY_TIMEOUT)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._insertEvents = self._insertEventsSql()
+        self._insertTableStats = self._insertTableStatsSql()
+
+    def connected(self):
+        return self._connection is not None
+
+    def disconnect(self):
+        if self._connection.in_transaction:
+            self._connection.execute('COMMIT')
+        self._connection.close()
+        self._connection = None
+
+    def reserveIds(self, count):
+        '''Reservation is committed at once, like a Firebird generator call, unless a transaction is already open.'''
+        ownTransaction = not self._connection.in_transaction
+        if ownTransaction:
+            self._connection.execute('BEGIN IMMEDIATE')
+        self._connection.execute('UPDATE SEQUENCES SET VALUE = VALUE + ? WHERE NAME = ?', (count, self._SEQUENCE))
+        lastId = self._connection.execute('SELECT VALUE FROM SEQUENCES WHERE NAME = ?', (self._SEQUENCE,)).fetchone()[0]
+        if ownTransaction:
+            self._connection.execute('COMMIT')
+        return lastId - count + 1
+
+    def writeStatements(self, statements):
+        self._begin()
+        self._connection.executemany('INSERT OR IGNORE INTO SQL_STATEMENTS (ID, SQL_NORMALIZED, SQL_TEXT) VALUES (?, ?, ?)', statements)
+
+    def writeEvents(self, rows):
+        self._begin()
+        self._connection.executemany(self._insertEvents, rows)
+
+    def writeTableStats(self, rows):
+        self._begin()
+        self._connection.executemany(self._insertTableStats, rows)
+
+    def readCheckpoint(self, fileId):
+        row = self._connection.execute('SELECT FILE_OFFSET, SKIP_EVENTS, REPLAY_EVENTS, PAIRS_HELD FROM FILE_CHECKPOINTS WHERE FILE_ID = ?',
+            (fileId,)).fetchone()
+        return tuple(row) if row else None
+
+    def writeCheckpoint(self, fileId, filePath, checkpoint):
+        self._begin()
+        self._connection.execute('INSERT OR REPLACE INTO FILE_CHECKPOINTS (FILE_ID, FILE_PATH, FILE_OFFSET, SKIP_EVENTS, REPLAY_EVENTS, '
+            'PAIRS_HELD, UPDATED) VALUES (?, ?, ?, ?, ?, ?, ?)', (fileId, filePath) + tuple(checkpoint) + (datetime.datetime.now(),))
+
+    def commit(self, hard=False):
+        if self._connection.in_transaction:
+            self._connection.execute('COMMIT')
+
+    def rollback(self):
+        if self._connection.in_transaction:
+            self._connection.execute('ROLLBACK')
+
+    def _columns(self):
+        connection = sqlite3.connect(self._dbPath, isolation_level=None, timeout=self._BUSY_TIMEOUT)
+        try:
+            tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            return {table.upper(): {row[1].upper() for row in connection.execute('PRAGMA table_info("{}")'.format(table))}
+                for table in tables}
+        finally:
+            connection.close()
+
+    def _begin(self):
+        if not self._connection.in_transaction:
+            self._connection.execute('BEGIN IMMEDIATE')
+
+
+class DumpFiles:
+    '''Names of the dump database files, when the dump switches to a new file every day (daily) and/or
+    when the file gets bigger than maxSize bytes (0 - no limit): <root>-YYYY-MM-DD<extension> for the first file
+    of the day, and <root>-YYYY-MM-DD-2<extension>, -3... for the next ones (no date unless daily).'''
+    def __init__(self, root, extension, daily, maxSize):
+        self.daily = daily
+        self.maxSize = maxSize
+        self._root = root
+        self._extension = extension
+
+    def path(self, day, part=1):
+        name = self._root
+        if self.daily:
+            name += '-' + day.isoformat()
+        if part > 1:
+            name += '-{}'.format(part)
+        return name + self._extension
+
+    def lastPart(self, day):
+        '''Number of the latest existing file of the day (1 if there is none): the dump goes on with it.'''
+        part = 1
+        while os.path.exists(self.path(day, part + 1)):
+            part += 1
+        return part
+
+
+SINKS = {
+    'firebird': FirebirdSink,
+    'sqlite': SQLiteSink,
+}
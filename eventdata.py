@@ -1,77 +1,258 @@
+import re
+import zlib
+import hashlib
 import datetime
 from enum import Enum
+from operator import itemgetter
+
+
+# SQL fingerprints
+_SQL_TOKENS = re.compile(r"'(?:[^']|'')*'|/\*.*?\*/|--[^\n]*|\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b|\s+", re.DOTALL)
+_SQL_PUNCTUATION = re.compile(r'\s*([^\w\s$"?])\s*')
+_SQL_VALUE_LISTS = re.compile(r'\(\?(?:,\?)+\)')
+_SQL_PLACEHOLDER = '?'
+_FINGERPRINT_CACHE_SIZE = 4096
+
+
+def _normalizeToken(match):
+    token = match.group()
+    if token[0] == "'" or token[0].isdigit():
+        return _SQL_PLACEHOLDER
+    return ' '
+
+
+def normalizeSql(sqlText):
+    '''Statement text without literals, comments and extra whitespace: "where id = 5" and "WHERE ID=7" are the same.'''
+    normalized = _SQL_TOKENS.sub(_normalizeToken, sqlText)
+    normalized = _SQL_PUNCTUATION.sub(r'\1', normalized)
+    normalized = _SQL_VALUE_LISTS.sub('(?)', normalized)
+    return normalized.strip().upper()
+
+
+def sqlFingerprint(normalizedSql):
+    '''64-bit signed hash of the normalized statement, fits BIGINT column.'''
+    digest = hashlib.blake2b(normalizedSql.encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+# RAW_OUTPUT retention
+RAWOUTPUT_FULL = 'full'
+RAWOUTPUT_NONE = 'none'
+RAWOUTPUT_PREFIX = 'prefix'
+RAWOUTPUT_ZLIB = 'zlib'
+RAWOUTPUT_POLICIES = (RAWOUTPUT_FULL, RAWOUTPUT_NONE, RAWOUTPUT_PREFIX, RAWOUTPUT_ZLIB)
+_RAWOUTPUT_ENCODING = 'utf8'
+
+
+def decompressRawOutput(data):
+    '''Text of RAW_OUTPUT_ZLIB value, as stored with 'zlib' raw output policy.'''
+    if data is None:
+        return None
+    return zlib.decompress(bytes(data)).decode(_RAWOUTPUT_ENCODING)
 
 
 # Event Data
-class EventData:
-    _fields = list()
+def _fieldSetter(index):
+    def setter(self, value):
+        self[index] = value
+    return setter
+
+
+class EventData(list):
+    '''Row of parsed fields, in the order of /*__PARSEDFIELD__*/ marks of the dump DB script.
+    Fields are accessible by name as attributes, and the object itself is usable as insert parameters.
+    tableStats holds the rows of per-table statistics block (TABLESTATS_FIELDS), if the event has one.
+    sqlText is the full statement text, SQL_ID field is its fingerprint.'''
+    __slots__ = ('tableStats', 'sqlText')
+    _fields = tuple()
 
     @classmethod
     def setFields(cls, fields):
-        cls._fields = fields
+        for field in cls._fields:
+            delattr(cls, field)
+        cls._fields = tuple(fields)
+        for (index, field) in enumerate(cls._fields):
+            setattr(cls, field, property(itemgetter(index), _fieldSetter(index)))
+
+    @classmethod
+    def fields(cls):
+        return cls._fields
 
     def __init__(self):
-        for field in self._fields:
-            setattr(self, field, None)
+        super().__init__((None,) * len(self._fields))
+        self.tableStats = None
+        self.sqlText = None
 
 
 # Event Data Parser
 _DATEPART = slice(0, 10)
 _TIMEPART = slice(11, 24)
-_HHMMSS = slice(0, 8)
-_MSEC = slice(-4, None)
+_YEAR = slice(0, 4)
+_MONTH = slice(5, 7)
+_DAY = slice(8, 10)
+_HOUR = slice(0, 2)
+_MINUTE = slice(3, 5)
+_SECOND = slice(6, 8)
+_MSEC = slice(9, 13)
 _LINEBREAK = '\n'
 _STATEMENTSTART = '-------------------------------------------------------------------------------'
 _STATEMENTEND   = '^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^'
+_TABLESTATSHEADER = 'Table '
+_TABLESTATSCOLUMNS = ('Natural', 'Index', 'Update', 'Insert', 'Delete', 'Backout', 'Purge', 'Expunge')
+_TABLESTATSSEPARATOR = '*'
+TABLESTATS_FIELDS = ('TABLE_NAME', 'NATURAL_READS', 'INDEX_READS', 'UPDATES', 'INSERTS', 'DELETES', 'BACKOUTS', 'PURGES', 'EXPUNGES')
 _TRANSACTIONPREFIX = '(TRA_'
+_STATEMENTPREFIX = 'Statement '
 _TCPV4PREFIX = 'TCPv4:'
 _ATTPREFIX = '(ATT_'
 _SQL_CLIENT_SIGNATURES = ('__SUPSQL__',)
+_INDENTS = ('\t', ' ')
+_COMMENTSTART = '/*'
+_RECORDSFETCHED = 'records fetched'
+# counters of '   12 ms, 3 read(s), 1 write(s), 40 fetch(es), 2 mark(s)' line; zero counters are omitted by Firebird
+_PERFCOUNTERS = {'ms': 0, 'read(s)': 1, 'write(s)': 2, 'fetch(es)': 3, 'mark(s)': 4}
 
 
 class ParseState(Enum):
     SQLTEXT = 1
     OTHER = 2
+    TABLESTATS = 3
+
+
+# attachment sampling (EventParser.sampleRate): an attachment is kept if crc32 of its id modulo _SAMPLE_BUCKETS
+# falls into the first sampleRate part of the buckets
+_SAMPLE_BUCKETS = 10000
+
+
+class EventFilter:
+    '''Events not to be dumped: by event name (known from the header line), by user and remote address (from the
+    attachment line after it), by client module and minimum duration in ms (known when the event is complete).
+    Names are compared case-insensitively. Address matches the IP (port is not compared), or its start ending
+    with a dot, like '10.1.2.'. Events without performance info are not dropped by duration.'''
+    def __init__(self, events=(), users=(), addresses=(), modules=(), minDuration=0):
+        self._events = frozenset(event.upper() for event in events)
+        self._users = frozenset(user.upper() for user in users)
+        self._addresses = frozenset(address for address in addresses if not address.endswith('.'))
+        self._networks = tuple(address for address in addresses if address.endswith('.'))
+        self._modules = frozenset(module.upper() for module in modules)
+        self._minDuration = minDuration
+
+    def __bool__(self):
+        return bool(self._events or self._users or self._addresses or self._networks or self._modules or self._minDuration > 0)
+
+    def early(self):
+        '''Copy that checks only what is known before the event body.'''
+        return EventFilter(self._events, self._users, self._addresses | set(self._networks))
+
+    def dropsName(self, eventName):
+        return eventName.upper() in self._events
+
+    def dropsAttachment(self, userName, remoteAddress):
+        if userName and userName.upper() in self._users:
+            return True
+        if remoteAddress:
+            address = remoteAddress.partition('/')[0]
+            return address in self._addresses or address.startswith(self._networks)
+        return False
+
+    def dropsEvent(self, event):
+        '''Checks of the complete event.'''
+        if event.MODULE_NAME and event.MODULE_NAME.upper() in self._modules:
+            return True
+        return event.DURATION_MS is not None and event.DURATION_MS < self._minDuration
+
+
+def isEventHeader(line):
+    '''Tells the event header line (1234-12-12T12:12:12.1234 <...> EVENT_TYPE) as EventParser does,
+    without parsing the date: used to split the lines into events before they are parsed.'''
+    return (len(line) >= 24 and line[4] == line[7] == '-' and line[10] == 'T' and line[13] == line[16] == ':'
+            and line[:4].isdigit())
+
+
+def eventAttachment(lines):
+    '''Attachment id (ATT_123) of the event lines, None if the event has no attachment (service, trace session events).
+    It is in the line after the header.'''
+    for line in lines[1:3]:
+        index = line.find(_ATTPREFIX)
+        if index != -1:
+            return line[index + len(_ATTPREFIX):line.find(',', index)]
+    return None
 
 
 class EventParser:
-    def __init__(self):
+    '''rawOutput is the RAW_OUTPUT retention policy (one of RAWOUTPUT_POLICIES): keep the full text, nothing,
+    first rawOutputPrefix bytes of it (utf8 encoded, no character is cut), or zlib-compressed text in RAW_OUTPUT_ZLIB
+    field.
+    Events dropped by eventFilter are not returned; they are dropped as soon as the filter can decide, and the rest
+    of their lines is skipped without being kept. With sampleRate below 1 only that part of attachments (chosen by
+    hash of the attachment id, so that all the events of an attachment are kept) is returned.
+    filtered and sampledOut count the dropped events.'''
+    def __init__(self, rawOutput=RAWOUTPUT_FULL, rawOutputPrefix=0, eventFilter=None):
+        if rawOutput not in RAWOUTPUT_POLICIES:
+            raise ValueError('Unknown raw output policy: {}'.format(rawOutput))
+        self._rawOutput = rawOutput
+        self._rawOutputPrefix = rawOutputPrefix
         self._tmp = EventData()
+        self._dates = dict()
+        self._fingerprints = dict()
+        self._rawLines = list()
+        self._sqlLines = list()
         self._parsedEvent = None
         self._state = ParseState.OTHER
+        self._tableStatsColumns = None
+        self._filter = eventFilter or None
+        self.sampleRate = 1.0
+        self.filtered = 0
+        self.sampledOut = 0
 
     def parse(self, line):
+        '''Every line is classified by its first characters and goes to one handler only.'''
         line = line.rstrip('\n ')
 
-        (new_date_time, new_event_name) = self._findEventInfo(line)
-        if new_date_time:
-            self._state = ParseState.OTHER
-            if self._tmp.DATE_TIME:
-                self._pushEvent()
-            self._tmp = EventData()
-            self._tmp.DATE_TIME = new_date_time
-            self._tmp.EVENT_NAME = new_event_name
-            self._tmp.RAW_OUTPUT = line
-            return
-        elif not self._tmp.RAW_OUTPUT:
+        if line[4:5] == '-' and line[10:11] == 'T':
+            (new_date_time, new_event_name) = self._findEventInfo(line)
+            if new_date_time:
+                self._state = ParseState.OTHER
+                if self._tmp.DATE_TIME:
+                    self._pushEvent()
+                if self._filter and self._filter.dropsName(new_event_name):
+                    self.filtered += 1
+                    self._dropEvent()
+                    return
+                self._tmp = EventData()
+                self._tmp.DATE_TIME = new_date_time
+                self._tmp.EVENT_NAME = new_event_name
+                self._rawLines = [line]
+                self._sqlLines = list()
+                return
+        if not self._rawLines:
             return
-        else:
-            self._tmp.RAW_OUTPUT = _LINEBREAK.join([self._tmp.RAW_OUTPUT, line])
+        self._rawLines.append(line)
 
-        if self._isStatementStart(line):
+        first = line[:1]
+        if first == '-' and self._isStatementStart(line):
             self._state = ParseState.SQLTEXT
-            return
-
-        if self._isStatementEnd(line):
+        elif first == '^' and self._isStatementEnd(line):
             self._state = ParseState.OTHER
-            return
+        elif self._state == ParseState.SQLTEXT:
+            self._sqlLines.append(line)
+            # client module comment is the part of statement text
+            if self._tmp.MODULE_NAME is None and _COMMENTSTART in line:
+                self._parseModule(line)
+        elif self._state == ParseState.TABLESTATS:
+            self._parseTableStats(line)
+        elif first == 'T' and self._isTableStatsHeader(line):
+            self._state = ParseState.TABLESTATS
+        elif first:
+            self._parseContext(line, line.lstrip() if first in _INDENTS else line)
 
-        if self._state == ParseState.SQLTEXT:
-            self._tmp.SQL_TEXT = line if not self._tmp.SQL_TEXT else _LINEBREAK.join([self._tmp.SQL_TEXT, line])
+    def _parseContext(self, line, stripped):
+        if stripped[:1].isdigit():
+            self._parsePerformance(stripped)
             return
 
-        (transactionid, isolation_mode, rec_version, lock_mode, read_mode) = self._findTransactionInfo(line)
-        if transactionid:
+        if stripped.startswith(_TRANSACTIONPREFIX):
+            (transactionid, isolation_mode, rec_version, lock_mode, read_mode) = self._findTransactionInfo(stripped)
             self._tmp.TRANSACTIONID = transactionid
             self._tmp.ISOLATION_MODE = isolation_mode
             self._tmp.REC_VERSION = rec_version
@@ -79,20 +260,76 @@ class EventParser:
             self._tmp.READ_MODE = read_mode
             return
 
-        (attachmentid, user_name, remote_address) = self._findConnectionInfo(line)
-        if attachmentid:
-            self._tmp.ATTACHMENTID = attachmentid
-            self._tmp.USER_NAME = user_name
-            self._tmp.REMOTE_ADDRESS = remote_address
+        if stripped.startswith(_STATEMENTPREFIX):
+            self._tmp.STATEMENT_ID = self._findStatementId(stripped)
             return
 
+        if _ATTPREFIX in line:
+            (attachmentid, user_name, remote_address) = self._findConnectionInfo(line)
+            if attachmentid and self._dropsAttachment(attachmentid, user_name, remote_address):
+                self._dropEvent()
+                return
+            if attachmentid:
+                self._tmp.ATTACHMENTID = attachmentid
+                self._tmp.USER_NAME = user_name
+                self._tmp.REMOTE_ADDRESS = remote_address
+                return
+
+        if _COMMENTSTART in line:
+            self._parseModule(line)
+
+    def _parsePerformance(self, line):
+        records_fetched = self._findRecordsFetched(line)
+        if records_fetched is not None:
+            self._tmp.RECORDS_FETCHED = records_fetched
+            return
+
+        (duration, reads, writes, fetches, marks) = self._findPerformanceInfo(line)
+        if duration is not None:
+            self._tmp.DURATION_MS = duration
+            self._tmp.READS = reads
+            self._tmp.WRITES = writes
+            self._tmp.FETCHES = fetches
+            self._tmp.MARKS = marks
+
+    def _parseTableStats(self, line):
+        if not line:
+            self._state = ParseState.OTHER
+        elif not line.startswith(_TABLESTATSSEPARATOR):
+            if self._tmp.tableStats is None:
+                self._tmp.tableStats = list()
+            self._tmp.tableStats.append(self._findTableStats(line))
+
+    def _parseModule(self, line):
         (module_name, module_line) = self._findModuleInfo(line)
         if module_name:
             self._tmp.MODULE_NAME = module_name
             self._tmp.MODULE_LINE = module_line
-            return
 
-        # etc...
+    def finish(self):
+        '''Input is over: the event being accumulated is complete.'''
+        if self._tmp.DATE_TIME:
+            self._pushEvent()
+            self._tmp = EventData()
+            self._rawLines = list()
+            self._sqlLines = list()
+        self._state = ParseState.OTHER
+
+    def _dropsAttachment(self, attachmentid, user_name, remote_address):
+        if self._filter and self._filter.dropsAttachment(user_name, remote_address):
+            self.filtered += 1
+            return True
+        if self.sampleRate < 1.0 and zlib.crc32(attachmentid.encode()) % _SAMPLE_BUCKETS >= self.sampleRate * _SAMPLE_BUCKETS:
+            self.sampledOut += 1
+            return True
+        return False
+
+    def _dropEvent(self):
+        '''Lines up to the next event header are skipped, as there is no event being accumulated.'''
+        self._tmp = EventData()
+        self._rawLines = list()
+        self._sqlLines = list()
+        self._state = ParseState.OTHER
 
     def popEvent(self):
         event = None
@@ -102,17 +339,47 @@ class EventParser:
         return event
 
     def _pushEvent(self):
+        '''Body lines are collected in lists and joined once per event, keeping accumulation linear.'''
+        if self._filter and self._filter.dropsEvent(self._tmp):
+            self.filtered += 1
+            return
+        self._keepRawOutput()
+        if self._sqlLines:
+            self._tmp.sqlText = _LINEBREAK.join(self._sqlLines)
+            self._tmp.SQL_ID = self._fingerprint(self._tmp.sqlText)
         self._parsedEvent = self._tmp
 
+    def _keepRawOutput(self):
+        if self._rawOutput == RAWOUTPUT_FULL:
+            self._tmp.RAW_OUTPUT = _LINEBREAK.join(self._rawLines)
+        elif self._rawOutput == RAWOUTPUT_PREFIX:
+            # a character takes up to 4 bytes, so the text is cut by characters first
+            prefix = _LINEBREAK.join(self._rawLines)[:self._rawOutputPrefix].encode(_RAWOUTPUT_ENCODING)[:self._rawOutputPrefix]
+            self._tmp.RAW_OUTPUT = prefix.decode(_RAWOUTPUT_ENCODING, errors='ignore')
+        elif self._rawOutput == RAWOUTPUT_ZLIB:
+            self._tmp.RAW_OUTPUT_ZLIB = zlib.compress(_LINEBREAK.join(self._rawLines).encode(_RAWOUTPUT_ENCODING))
+
+    def _fingerprint(self, sqlText):
+        '''Parameterized statements are executed with the same text again and again, so fingerprints are cached by text.'''
+        fingerprint = self._fingerprints.get(sqlText)
+        if fingerprint is None:
+            if len(self._fingerprints) >= _FINGERPRINT_CACHE_SIZE:
+                self._fingerprints.clear()
+            fingerprint = self._fingerprints[sqlText] = sqlFingerprint(normalizeSql(sqlText))
+        return fingerprint
+
     def _findEventInfo(self, line):
         '''1234-12-12T12:12:12.1234 <...> EVENT_TYPE'''
         event_name = date_time = None
-        if len(line) > 10 and line[4] == line[7] == '-' and line[10] == 'T':
+        if len(line) >= 24 and line[4] == line[7] == '-' and line[10] == 'T':
             date = self._dateFromStr(line[_DATEPART])
             time = self._timeFromStr(line[_TIMEPART])
             if date and time:
-                event_name = line.rstrip('\n').rpartition(' ')[2]
-                date_time = datetime.datetime.combine(date, time)
+                try:
+                    date_time = datetime.datetime(date.year, date.month, date.day, *time)
+                except ValueError:
+                    return (None, None)
+                event_name = line.rpartition(' ')[2]
         return (date_time, event_name)
 
     def _findModuleInfo(self, line):
@@ -121,15 +388,16 @@ class EventParser:
         for signature in _SQL_CLIENT_SIGNATURES:
             idx = line.find(signature)
             if idx != -1:
-                stripped = slice(idx, line.find('*/'))
-                (_, module_name, module_line) = line[stripped].split('/')
-                module_name = module_name.split('.')[0]
+                stripped = slice(idx, line.find('*/', idx))
+                parts = line[stripped].split('/')
+                if len(parts) == 3:
+                    (_, module_name, module_line) = parts
+                    module_name = module_name.split('.')[0]
         return (module_name, module_line)
 
     def _findTransactionInfo(self, line):
-        '''        (TRA_12345,  PAPAM1 | PARAM2 | PARAM3 |...)'''
+        '''(TRA_12345,  PAPAM1 | PARAM2 | PARAM3 |...), leading whitespace already stripped'''
         transactionid = isolation_mode = rec_version = lock_mode = read_mode = None
-        line = line.strip()
         if line.startswith(_TRANSACTIONPREFIX):
             (transactionid, _, transactionParams) = line.lstrip(_TRANSACTIONPREFIX).rstrip(')').partition(',')
             transactionParams = tuple(a.strip() for a in transactionParams.split('|'))
@@ -139,6 +407,55 @@ class EventParser:
                 (isolation_mode, lock_mode, read_mode) = transactionParams
         return (transactionid, isolation_mode, rec_version, lock_mode, read_mode)
 
+    def _isTableStatsHeader(self, line):
+        '''Table      Natural     Index    Update    Insert    Delete   Backout     Purge   Expunge'''
+        if not line.startswith(_TABLESTATSHEADER):
+            return False
+        columnEnds = list()
+        for column in _TABLESTATSCOLUMNS:
+            idx = line.find(column, columnEnds[-1] if columnEnds else 0)
+            if idx == -1:
+                return False
+            columnEnds.append(idx + len(column))
+        self._tableStatsColumns = columnEnds
+        return True
+
+    def _findTableStats(self, line):
+        '''RDB$DATABASE        1        12      <...>: counters are right-aligned to the header columns, zeros are left blank'''
+        columnEnds = self._tableStatsColumns
+        start = columnEnds[0] - (columnEnds[1] - columnEnds[0])
+        stats = [line[:start].strip()]
+        for end in columnEnds:
+            value = line[start:end].strip()
+            stats.append(int(value) if value.isdigit() else 0)
+            start = end
+        return tuple(stats)
+
+    def _findStatementId(self, line):
+        '''Statement 12345:'''
+        statementId = line[len(_STATEMENTPREFIX):].rstrip(':')
+        return int(statementId) if statementId.isdigit() else None
+
+    def _findRecordsFetched(self, line):
+        '''12 records fetched'''
+        (records, _, text) = line.partition(' ')
+        if text == _RECORDSFETCHED and records.isdigit():
+            return int(records)
+        return None
+
+    def _findPerformanceInfo(self, line):
+        '''12 ms, 3 read(s), 1 write(s), 40 fetch(es), 2 mark(s)'''
+        counters = [0] * len(_PERFCOUNTERS)
+        for item in line.split(','):
+            (value, _, name) = item.strip().partition(' ')
+            index = _PERFCOUNTERS.get(name)
+            if index is None or not value.isdigit():
+                return (None,) * len(_PERFCOUNTERS)
+            counters[index] = int(value)
+        if not line.partition(',')[0].endswith(' ms'):
+            return (None,) * len(_PERFCOUNTERS)
+        return tuple(counters)
+
     def _findConnectionInfo(self, line):
         '''       /path/to/database.fdb (ATT_123, LOGIN:NONE, ENCODING, TCPv4:123.123.123.123)'''
         attachmentid = user_name = remote_address = None
@@ -161,16 +478,21 @@ class EventParser:
         return _STATEMENTEND in line
 
     def _dateFromStr(self, dateStr):
-        try:
-            lst = dateStr.split(sep='-', maxsplit=2)
-            return datetime.date(year=int(lst[0]), month=int(lst[1]), day=int(lst[2]))
-        except:
-            return None
+        '''Dates are cached: all the events of a day share one date object.'''
+        date = self._dates.get(dateStr)
+        if date is None:
+            try:
+                date = datetime.date(int(dateStr[_YEAR]), int(dateStr[_MONTH]), int(dateStr[_DAY]))
+            except ValueError:
+                return None
+            self._dates[dateStr] = date
+        return date
 
     def _timeFromStr(self, timeStr):
+        '''HH:MM:SS.ffff -> (hour, minute, second, microsecond), or None'''
+        if timeStr[2] != ':' or timeStr[5] != ':' or timeStr[8] != '.':
+            return None
         try:
-            msec = timeStr[_MSEC]
-            lst = timeStr[_HHMMSS].split(sep=':', maxsplit=2)
-            return datetime.time(hour=int(lst[0]), minute=int(lst[1]), second=int(lst[2]), microsecond=int(msec)*100)
-        except:
+            return (int(timeStr[_HOUR]), int(timeStr[_MINUTE]), int(timeStr[_SECOND]), int(timeStr[_MSEC]) * 100)
+        except ValueError:
             return None
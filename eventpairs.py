@@ -0,0 +1,121 @@
+from collections import OrderedDict
+
+# event name -> kind of the pair it opens or closes
+_STATEMENT = 'statement'
+_TRANSACTION = 'transaction'
+_ATTACHMENT = 'attachment'
+_OPENING = {
+    'EXECUTE_STATEMENT_START': _STATEMENT,
+    'START_TRANSACTION': _TRANSACTION,
+    'ATTACH_DATABASE': _ATTACHMENT,
+}
+_CLOSING = {
+    'EXECUTE_STATEMENT_FINISH': _STATEMENT,
+    'COMMIT_TRANSACTION': _TRANSACTION,
+    'ROLLBACK_TRANSACTION': _TRANSACTION,
+    'DETACH_DATABASE': _ATTACHMENT,
+}
+
+
+class EventPairs:
+    '''Pairs opening and closing events into one row: EXECUTE_STATEMENT_START with EXECUTE_STATEMENT_FINISH,
+    START_TRANSACTION with COMMIT/ROLLBACK_TRANSACTION, ATTACH_DATABASE with DETACH_DATABASE.
+    Opening events wait in the index of open ones. The closing event becomes the merged row: it gets START_TIME
+    (time of the opening event), ELAPSED_MS (time between them) and the fields it lacks from the opening event.
+    Events are matched by traced host, attachment (and its remote address: ids of different databases may be equal),
+    and statement or transaction id. The index keeps at most capacity events, and (if maxAge > 0) none opened more than
+    maxAge seconds before the latest event: the oldest ones are dumped unpaired, as are closing events without a pair.
+    Opening events may be added with a tag, that tells where they come from (see oldestTag()).'''
+    def __init__(self, capacity, maxAge=0):
+        self._capacity = max(1, capacity)
+        self._maxAge = maxAge
+        self._open = OrderedDict()
+        self._latest = None
+        self.paired = 0
+        self.evicted = 0
+
+    def add(self, event, tag=None):
+        '''Returns the list of rows to dump now.'''
+        rows = list()
+        name = event.EVENT_NAME
+        kind = _OPENING.get(name)
+        if kind:
+            key = self._key(kind, event)
+            if key is None:
+                rows.append(event)
+            else:
+                previous = self._open.pop(key, None)
+                if previous is not None:
+                    # its closing event is lost
+                    rows.append(previous[0])
+                    self.evicted += 1
+                self._open[key] = (event, tag)
+        else:
+            kind = _CLOSING.get(name)
+            opening = self._open.pop(self._key(kind, event), None) if kind else None
+            if opening is not None:
+                self._merge(opening[0], event)
+                self.paired += 1
+            rows.append(event)
+        self._evict(event.DATE_TIME, rows)
+        return rows
+
+    def flush(self):
+        '''Input is over: open events are dumped as they are.'''
+        rows = [event for (event, _) in self._open.values()]
+        self._open.clear()
+        return rows
+
+    def count(self):
+        '''Number of the open events.'''
+        return len(self._open)
+
+    def held(self):
+        '''(event, tag) of the open events, the oldest first.'''
+        return list(self._open.values())
+
+    def oldestTag(self):
+        '''Tag of the oldest open event, None if there is none.'''
+        return next(iter(self._open.values()))[1] if self._open else None
+
+    def trim(self, count):
+        '''Drops the oldest open events (without dumping them), so that count are left.'''
+        while len(self._open) > count:
+            self._open.popitem(last=False)
+
+    def _key(self, kind, event):
+        if event.ATTACHMENTID is None:
+            return None
+        if kind == _STATEMENT:
+            if event.STATEMENT_ID is None:
+                return None
+            return (kind, event.SOURCE_HOST, event.ATTACHMENTID, event.REMOTE_ADDRESS, event.STATEMENT_ID)
+        if kind == _TRANSACTION:
+            if event.TRANSACTIONID is None:
+                return None
+            return (kind, event.SOURCE_HOST, event.ATTACHMENTID, event.REMOTE_ADDRESS, event.TRANSACTIONID)
+        return (kind, event.SOURCE_HOST, event.ATTACHMENTID, event.REMOTE_ADDRESS)
+
+    def _merge(self, opening, closing):
+        closing.START_TIME = opening.DATE_TIME
+        if opening.DATE_TIME and closing.DATE_TIME:
+            closing.ELAPSED_MS = int((closing.DATE_TIME - opening.DATE_TIME).total_seconds() * 1000)
+        for (index, value) in enumerate(opening):
+            if closing[index] is None:
+                closing[index] = value
+
+    def _evict(self, now, rows):
+        '''The index is in the order events were opened, so the oldest ones are at its start.'''
+        while len(self._open) > self._capacity:
+            rows.append(self._open.popitem(last=False)[1][0])
+            self.evicted += 1
+        if self._maxAge <= 0 or now is None:
+            return
+        if self._latest is None or now > self._latest:
+            self._latest = now
+        while self._open:
+            oldest = next(iter(self._open.values()))[0]
+            if oldest.DATE_TIME is not None and (self._latest - oldest.DATE_TIME).total_seconds() <= self._maxAge:
+                break
+            rows.append(self._open.popitem(last=False)[1][0])
+            self.evicted += 1
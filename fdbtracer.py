@@ -1,5 +1,6 @@
 # python3
 import os
+import time
 import argparse
 import configparser
 import threading
@@ -8,7 +9,10 @@ import traceengine
 import dumpengine
 import logger
 import appdata
-from appdata import Communicator
+from appdata import Communicator, TracerMetrics
+from metrics import MetricsCollector
+
+_MESSAGE_WAIT = 0.5
 
 
 class Signal:
@@ -16,17 +20,22 @@ class Signal:
 
 
 class FDBTracer:
-    def __init__(self, signal, filename=None):
+    def __init__(self, signal, filename=None, jobs=1, follow=False):
         self._errorsCount = 0
+        self._metrics = MetricsCollector()
+        self._metricsTime = time.monotonic()
         self._signal = signal
         self._filename = filename
-        self._comm = Communicator(datastore=filename) if filename else Communicator()
+        self._jobs = jobs
+        self._follow = follow
         try:
             self.LoadParametersFromConfFile()
         except Exception as e:
             print("Load parameters from config file error: {}".format(str(e)))
             print("Terminating.")
             exit()
+        self._comm = Communicator(datastore=filename, chunkSize=appdata.common().chunkSize, chunkTimeout=appdata.common().chunkTimeout,
+            queueSize=appdata.common().queueSize, spillDir=appdata.common().spillDir, follow=follow)
         try:
             self._logger = logger.Logger(appdata.common().logPath, 
                 appdata.common().logLevel if not appdata.common().testMode else logger.DEBUG,
@@ -39,22 +48,32 @@ class FDBTracer:
             exit()
 
     def run(self):
-        dataProvider = None
+        dataProviders = list()
         dumpHandler = None
         if self._filename:
-            self._logger.debug('Trying to open file {}...'.format(self._filename))
+            self._logger.debug('Trying to {} file {}...'.format('follow' if self._follow else 'open', self._filename))
         else:
-            self._logger.debug('Trying to start trace...')
-            dataProvider = Process(target=traceengine.run, args=(appdata.trace(), self._comm,))
-        dumpHandler = Process(target=dumpengine.run, args=(appdata.absDumpDbPath(), appdata.absDumpDbScriptPath(), self._comm,))
-        if dataProvider:
+            if not appdata.traces():
+                self._logger.critical('No traced_db section in config file, nothing to trace.')
+                self._comm.close()
+                return
+            self._logger.debug('Trying to start trace on {} host(s)...'.format(len(appdata.traces())))
+            dataProviders = [Process(target=traceengine.run, args=(params, self._comm, appdata.metricsInterval(), appdata.throttle(),))
+                for params in appdata.traces()]
+        dumpHandler = Process(target=dumpengine.run, args=(appdata.dump(), appdata.absDumpDbPath(), appdata.absDumpDbScriptPath(), self._comm, self._jobs,
+            appdata.liveStats(), appdata.absStatsFilePath(), appdata.metricsInterval(), appdata.filters(), appdata.dumpDbFiles(),))
+        for dataProvider in dataProviders:
             dataProvider.start()
         dumpHandler.start()
-        self.runMessagesHandling()
+        self.runMessagesHandling(dataProviders)
         self._comm.stop()
-        if dataProvider:
-            dataProvider.join()
-        dumpHandler.join()
+        if dataProviders:
+            for dataProvider in dataProviders:
+                self.waitForProcess(dataProvider)
+            self._comm.endOfData()
+        self.waitForProcess(dumpHandler)
+        self.reportMetrics(force=True)
+        self._comm.close()
         self._logger.debug('All tasks done, finishing!')
 
     def LoadParametersFromConfFile(self):
@@ -66,22 +85,81 @@ class FDBTracer:
             logPath=        config.get(SYS_SECTION, "logPath", fallback=''),
             logLevel=       config.getint(SYS_SECTION, "logLevel", fallback=1),
             consoleDebug=   config.getboolean(SYS_SECTION, "consoleDebug", fallback=False),
-            maxErrors=      config.getint(SYS_SECTION, "maxErrors", fallback=50)
+            maxErrors=      config.getint(SYS_SECTION, "maxErrors", fallback=50),
+            chunkSize=      config.getint(SYS_SECTION, "chunkSize", fallback=256),
+            chunkTimeout=   config.getfloat(SYS_SECTION, "chunkTimeout", fallback=0.1),
+            queueSize=      config.getint(SYS_SECTION, "queueSize", fallback=256),
+            spillDir=       config.get(SYS_SECTION, "spillDir", fallback='')
         )
         TRACE_SECTION = "traced_db"
-        appdata.initTraceParams(
-            host=       config.get(TRACE_SECTION, "host", fallback=''),
-            login=      config.get(TRACE_SECTION, "login", fallback=''),
-            password=   config.get(TRACE_SECTION, "password", fallback=''),
-            traceConf=  config.get(TRACE_SECTION, "traceConf", fallback='')
-        )
+        for section in config.sections():
+            # [traced_db], [traced_db.<any name>] - one section per traced host
+            if section == TRACE_SECTION or section.startswith(TRACE_SECTION + '.'):
+                appdata.addTraceParams(
+                    host=       config.get(section, "host", fallback=''),
+                    login=      config.get(section, "login", fallback=''),
+                    password=   config.get(section, "password", fallback=''),
+                    traceConf=  config.get(section, "traceConf", fallback=''),
+                    readTimeout=config.getint(section, "readTimeout", fallback=1)
+                )
         DUMP_SECTION = "dump_db"
         appdata.initDumpParams(
+            sink=           config.get(DUMP_SECTION, "sink", fallback='firebird'),
             databasePath=   config.get(DUMP_SECTION, "databasePath", fallback=''),
             databaseName=   config.get(DUMP_SECTION, "databaseName", fallback=''),
-            addDateToName=  config.getboolean(DUMP_SECTION, "addDateToName", fallback=False)
+            addDateToName=  config.getboolean(DUMP_SECTION, "addDateToName", fallback=False),
+            batchSize=      config.getint(DUMP_SECTION, "batchSize", fallback=500),
+            batchTimeout=   config.getfloat(DUMP_SECTION, "batchTimeout", fallback=1.0),
+            statementCacheSize= config.getint(DUMP_SECTION, "statementCacheSize", fallback=10000),
+            rawOutput=      config.get(DUMP_SECTION, "rawOutput", fallback='full'),
+            rawOutputPrefix=config.getint(DUMP_SECTION, "rawOutputPrefix", fallback=1024),
+            workers=        config.getint(DUMP_SECTION, "workers", fallback=1),
+            pairEvents=     config.getboolean(DUMP_SECTION, "pairEvents", fallback=False),
+            pairIndexSize=  config.getint(DUMP_SECTION, "pairIndexSize", fallback=100000),
+            pairMaxAge=     config.getfloat(DUMP_SECTION, "pairMaxAge", fallback=0),
+            maxDatabaseSize=config.getint(DUMP_SECTION, "maxDatabaseSize", fallback=0)
+        )
+        STATS_SECTION = "live_stats"
+        appdata.initLiveStatsParams(
+            enabled=    config.getboolean(STATS_SECTION, "enabled", fallback=True),
+            interval=   config.getfloat(STATS_SECTION, "interval", fallback=60.0),
+            statsFile=  config.get(STATS_SECTION, "statsFile", fallback=''),
+            topSize=    config.getint(STATS_SECTION, "topSize", fallback=20),
+            maxKeys=    config.getint(STATS_SECTION, "maxKeys", fallback=1000)
+        )
+        FILTERS_SECTION = "filters"
+        appdata.initFiltersParams(
+            excludeEvents=  self._listValue(config.get(FILTERS_SECTION, "excludeEvents", fallback='')),
+            excludeUsers=   self._listValue(config.get(FILTERS_SECTION, "excludeUsers", fallback='')),
+            excludeAddresses=self._listValue(config.get(FILTERS_SECTION, "excludeAddresses", fallback='')),
+            excludeModules= self._listValue(config.get(FILTERS_SECTION, "excludeModules", fallback='')),
+            minDuration=    config.getint(FILTERS_SECTION, "minDuration", fallback=0),
+            sampleBacklog=  config.getint(FILTERS_SECTION, "sampleBacklog", fallback=0),
+            minSampleRate=  config.getfloat(FILTERS_SECTION, "minSampleRate", fallback=0.1)
+        )
+        THROTTLE_SECTION = "throttle"
+        # [throttle.1], [throttle.2]... - trace config options of the levels, in order
+        levelSections = sorted((section for section in config.sections() if section.startswith(THROTTLE_SECTION + '.')
+            and section[len(THROTTLE_SECTION) + 1:].isdigit()), key=lambda section: int(section[len(THROTTLE_SECTION) + 1:]))
+        appdata.initThrottleParams(
+            enabled=        config.getboolean(THROTTLE_SECTION, "enabled", fallback=False),
+            checkInterval=  config.getfloat(THROTTLE_SECTION, "checkInterval", fallback=10.0),
+            maxBacklog=     config.getint(THROTTLE_SECTION, "maxBacklog", fallback=1000000),
+            resumeBacklog=  config.getint(THROTTLE_SECTION, "resumeBacklog", fallback=100000),
+            holdTime=       config.getfloat(THROTTLE_SECTION, "holdTime", fallback=60.0),
+            levels=         [config.items(section) for section in levelSections]
+        )
+        METRICS_SECTION = "metrics"
+        appdata.initMetricsParams(
+            enabled=    config.getboolean(METRICS_SECTION, "enabled", fallback=True),
+            interval=   config.getfloat(METRICS_SECTION, "interval", fallback=10.0),
+            metricsFile=config.get(METRICS_SECTION, "metricsFile", fallback='')
         )
 
+    def _listValue(self, value):
+        '''Comma-separated list of the config file value.'''
+        return [item.strip() for item in value.split(',') if item.strip()]
+
     def saveParametersToLogFile(self):
         self._logger.debug("FDBTracer started...")
         self._logger.debug("System Parameters Listing:")
@@ -89,30 +167,115 @@ class FDBTracer:
         self._logger.debug("Log Path: {}".format(appdata.common().logPath))
         self._logger.debug("Log Level: {}".format(appdata.common().logLevel))
         self._logger.debug("Console Debug: {}".format(appdata.common().consoleDebug))
+        self._logger.debug("Transport Chunk Size: {}".format(appdata.common().chunkSize))
+        self._logger.debug("Transport Chunk Timeout: {}".format(appdata.common().chunkTimeout))
+        self._logger.debug("Transport Queue Size: {}".format(appdata.common().queueSize))
+        self._logger.debug("Spill Dir: {}".format(appdata.common().spillDir))
 
         self._logger.debug("Traced Database Parameters Listing:")
-        self._logger.debug("DB Host: {}".format(appdata.trace().host))
-        self._logger.debug("DB Login: {}".format(appdata.trace().login))
+        for params in appdata.traces():
+            self._logger.debug("DB Host: {}".format(params.host))
+            self._logger.debug("DB Login: {}".format(params.login))
+            self._logger.debug("Read Timeout: {}".format(params.readTimeout))
 
         self._logger.debug("Dump Database Parameters Listing:")
+        self._logger.debug("Sink: {}".format(appdata.dump().sink))
         self._logger.debug("DB Path: {}".format(appdata.absDumpDbPath()))
+        self._logger.debug("Max DB Size: {}".format(appdata.dump().maxDatabaseSize))
+        self._logger.debug("Batch Size: {}".format(appdata.dump().batchSize))
+        self._logger.debug("Batch Timeout: {}".format(appdata.dump().batchTimeout))
+        self._logger.debug("Statement Cache Size: {}".format(appdata.dump().statementCacheSize))
+        self._logger.debug("Raw Output: {}".format(appdata.dump().rawOutput))
+        self._logger.debug("Workers: {}".format(appdata.dump().workers))
+        self._logger.debug("Pair Events: {}".format(appdata.dump().pairEvents))
+
+        self._logger.debug("Live Stats Parameters Listing:")
+        self._logger.debug("Enabled: {}".format(appdata.liveStats().enabled))
+        self._logger.debug("Interval: {}".format(appdata.liveStats().interval))
+        self._logger.debug("Stats File: {}".format(appdata.absStatsFilePath()))
+
+        self._logger.debug("Filters Parameters Listing:")
+        self._logger.debug("Exclude Events: {}".format(', '.join(appdata.filters().excludeEvents)))
+        self._logger.debug("Exclude Users: {}".format(', '.join(appdata.filters().excludeUsers)))
+        self._logger.debug("Exclude Addresses: {}".format(', '.join(appdata.filters().excludeAddresses)))
+        self._logger.debug("Exclude Modules: {}".format(', '.join(appdata.filters().excludeModules)))
+        self._logger.debug("Min Duration: {}".format(appdata.filters().minDuration))
+        self._logger.debug("Sample Backlog: {}".format(appdata.filters().sampleBacklog))
+
+        self._logger.debug("Throttle Parameters Listing:")
+        self._logger.debug("Enabled: {}".format(appdata.throttle().enabled))
+        self._logger.debug("Max Backlog: {}".format(appdata.throttle().maxBacklog))
+        self._logger.debug("Resume Backlog: {}".format(appdata.throttle().resumeBacklog))
+        self._logger.debug("Levels: {}".format(len(appdata.throttle().levels)))
+
+        self._logger.debug("Metrics Parameters Listing:")
+        self._logger.debug("Enabled: {}".format(appdata.metrics().enabled))
+        self._logger.debug("Interval: {}".format(appdata.metrics().interval))
+        self._logger.debug("Metrics File: {}".format(appdata.absMetricsFilePath()))
 
-    def runMessagesHandling(self):
+    def runMessagesHandling(self, dataProviders=()):
+        '''Runs until stop is requested, or until all trace processes have finished (no traced host left).'''
         while True:
-            message = self._comm.popMessage()
+            message = self._comm.popMessage(timeout=_MESSAGE_WAIT)
             if message:
-                if message.iserror:
-                    self._logger.critical('Got error from {}, text: {}'.format(message.source, message.text))
-                    self._errorsCount += 1
-                    if self._errorsCount > appdata.common().maxErrors:
-                        self._logger.critical('Maximum errors reached, stopping.')
-                        print('\nMaximum errors reached. see log for details. Exiting...')
-                        break
-                else:       
-                    self._logger.debug(message.text)
-                    self._errorsCount = 0
+                if not self.handleMessage(message):
+                    self._logger.critical('Maximum errors reached, stopping.')
+                    print('\nMaximum errors reached. see log for details. Exiting...')
+                    break
+            self.reportMetrics()
             if self._signal.stop or self._comm.stopped():
                 break
+            if dataProviders and not any(dataProvider.is_alive() for dataProvider in dataProviders):
+                self._logger.debug('No traced host left, stopping.')
+                break
+
+    def handleMessage(self, message):
+        '''Logs the message (or collects the metrics). Returns False if maximum errors count is exceeded.'''
+        if isinstance(message, TracerMetrics):
+            self._metrics.update(message)
+            return True
+        if message.iserror:
+            self._logger.critical('Got error from {}, text: {}'.format(message.source, message.text))
+            self._metrics.own().inc('errors_total{{source="{}"}}'.format(getattr(message.source, '__name__', message.source)))
+            self._errorsCount += 1
+            if self._errorsCount > appdata.common().maxErrors:
+                return False
+        else:       
+            self._logger.debug(message.text)
+            self._errorsCount = 0
+        return True
+
+    def waitForProcess(self, process):
+        '''Keeps logging messages while the process is finishing its work.'''
+        while process.is_alive():
+            message = self._comm.popMessage(timeout=_MESSAGE_WAIT)
+            if message:
+                self.handleMessage(message)
+            self.reportMetrics()
+        process.join()
+        message = self._comm.popMessage()
+        while message:
+            self.handleMessage(message)
+            message = self._comm.popMessage()
+
+
+    def reportMetrics(self, force=False):
+        '''Every metrics interval the metrics of all processes are combined, written to Prometheus text file and logged.'''
+        interval = appdata.metricsInterval()
+        now = time.monotonic()
+        if interval <= 0 or not force and now - self._metricsTime < interval:
+            return
+        self._metricsTime = now
+        linesLeft = self._comm.linesLeft()
+        if linesLeft >= 0:
+            self._metrics.own().set('queue_lines', linesLeft)
+            self._metrics.own().set('spill_bytes', self._comm.spilledBytes())
+        (counters, gauges, histograms) = self._metrics.combined()
+        self._logger.debug(self._metrics.summaryText(counters, gauges, histograms, self._metrics.rates(counters)))
+        try:
+            self._metrics.writePrometheus(appdata.absMetricsFilePath(), counters, gauges, histograms)
+        except Exception as e:
+            self._logger.critical('Can not write metrics file: {}'.format(e))
 
 
 def waitForInterrupt(signal, msg):
@@ -126,6 +289,9 @@ if __name__ == '__main__':
     argsp = argparse.ArgumentParser()
     argsp.add_argument('-f', '--file', help='If specified, parse FB Trace and Audit log file with given name and exit')
     argsp.add_argument('-d', '--database', help='If specified, use DB file with given name for parsed data')
+    argsp.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes parsing the log file in --file mode')
+    argsp.add_argument('--follow', action='store_true', help='With --file, keep reading the log file as it grows and is rotated, '
+        'until \'q\' is typed (one parsing process)')
     args = argsp.parse_args()
 
     if args.database:
@@ -137,8 +303,14 @@ if __name__ == '__main__':
         if not os.path.exists(args.file):
             print('File {} does not exist! Exiting.'.format(args.file))
             exit()
-        msg = 'Parsing file {}. Type \'q\' to quit or wait for finish: '.format(args.file)
-        tracer = FDBTracer(signal, args.file)
+        if args.follow:
+            msg = 'Following file {}. Type \'q\' to quit: '.format(args.file)
+        else:
+            msg = 'Parsing file {}. Type \'q\' to quit or wait for finish: '.format(args.file)
+        tracer = FDBTracer(signal, args.file, args.jobs, args.follow)
+    elif args.follow:
+        print('--follow needs --file. Exiting.')
+        exit()
     else:
         msg = 'Trace started. Type \'q\' to quit: '
         tracer = FDBTracer(signal)
@@ -0,0 +1,194 @@
+import os
+import json
+import math
+import heapq
+from collections import OrderedDict
+from eventdata import normalizeSql
+
+_ACCURACY = 0.01
+_GAMMA = (1 + _ACCURACY) / (1 - _ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+_MAX_BINS = 1024
+_QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+_STATEMENT_EVENTS = ('EXECUTE_STATEMENT_FINISH',)
+_STATEMENT_LABEL_SIZE = 200
+_SUMMARY_SIZE = 3
+
+
+class DurationSketch:
+    '''Streaming percentiles of durations with bounded memory: values are counted in logarithmic bins,
+    so any quantile is known within _ACCURACY relative error. If there are more than _MAX_BINS bins
+    (which needs durations spread over more than 10 orders), the lowest ones are merged.'''
+    __slots__ = ('_bins', '_zeros', 'count', 'total', 'max')
+
+    def __init__(self):
+        self._bins = dict()
+        self._zeros = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value <= 0:
+            self._zeros += 1
+            return
+        index = math.ceil(math.log(value) / _LOG_GAMMA)
+        self._bins[index] = self._bins.get(index, 0) + 1
+        if len(self._bins) > _MAX_BINS:
+            self._collapse()
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self._zeros += other._zeros
+        for (index, count) in other._bins.items():
+            self._bins[index] = self._bins.get(index, 0) + count
+        if len(self._bins) > _MAX_BINS:
+            self._collapse()
+
+    def _collapse(self):
+        indices = sorted(self._bins)
+        excess = len(indices) - _MAX_BINS
+        self._bins[indices[excess]] += sum(self._bins.pop(index) for index in indices[:excess])
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self._zeros
+        if rank < seen:
+            return 0
+        for index in sorted(self._bins):
+            seen += self._bins[index]
+            if rank < seen:
+                return min(self.max, 2 * _GAMMA ** index / (_GAMMA + 1))
+        return self.max
+
+    def summary(self):
+        summary = {name: round(self.quantile(q), 1) for (name, q) in _QUANTILES}
+        summary.update(count=self.count, avg=round(self.total / self.count, 1), max=self.max)
+        return summary
+
+
+class _Sketches:
+    '''Sketches by key; at most maxKeys of them, least recently updated key goes first.'''
+    def __init__(self, maxKeys):
+        self._maxKeys = maxKeys
+        self._sketches = OrderedDict()
+        self.labels = dict()
+
+    def add(self, key, value):
+        sketch = self._sketch(key)
+        sketch.add(value)
+        return sketch
+
+    def merge(self, other):
+        for (key, sketch) in other._sketches.items():
+            self._sketch(key).merge(sketch)
+        for (key, label) in other.labels.items():
+            if key in self._sketches:
+                self.labels.setdefault(key, label)
+
+    def _sketch(self, key):
+        sketch = self._sketches.get(key)
+        if sketch is None:
+            sketch = self._sketches[key] = DurationSketch()
+            if len(self._sketches) > self._maxKeys:
+                (evicted, _) = self._sketches.popitem(last=False)
+                self.labels.pop(evicted, None)
+        else:
+            self._sketches.move_to_end(key)
+        return sketch
+
+    def summaries(self):
+        '''(key, summary) pairs, slowest (by p99) first.'''
+        summaries = [(key, sketch.summary()) for (key, sketch) in self._sketches.items()]
+        summaries.sort(key=lambda item: item[1]['p99'], reverse=True)
+        return summaries
+
+
+class LiveStats:
+    '''Aggregates of statement durations (EXECUTE_STATEMENT_FINISH events) kept while the events are dumped:
+    percentiles by client module line (MODULE_NAME/MODULE_LINE) and by statement (SQL_ID),
+    and topSize slowest executions. Memory is bounded by maxKeys modules and maxKeys statements.'''
+    def __init__(self, topSize, maxKeys):
+        self._topSize = topSize
+        self._total = DurationSketch()
+        self._modules = _Sketches(maxKeys)
+        self._statements = _Sketches(maxKeys)
+        self._slowest = list()
+        self._added = 0
+
+    def add(self, event):
+        if event.DURATION_MS is None or event.EVENT_NAME not in _STATEMENT_EVENTS:
+            return
+        duration = event.DURATION_MS
+        self._added += 1
+        self._total.add(duration)
+        if event.MODULE_NAME:
+            self._modules.add((event.MODULE_NAME, event.MODULE_LINE), duration)
+        if event.SQL_ID is not None:
+            self._statements.add(event.SQL_ID, duration)
+            if event.SQL_ID not in self._statements.labels and event.sqlText:
+                self._statements.labels[event.SQL_ID] = normalizeSql(event.sqlText)[:_STATEMENT_LABEL_SIZE]
+        if len(self._slowest) < self._topSize:
+            heapq.heappush(self._slowest, (duration, self._added, self._execution(event)))
+        elif self._slowest and duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (duration, self._added, self._execution(event)))
+
+    def merge(self, other):
+        '''Adds the aggregates of other LiveStats (kept by another dump worker).'''
+        self._total.merge(other._total)
+        self._modules.merge(other._modules)
+        self._statements.merge(other._statements)
+        slowest = heapq.nlargest(self._topSize, self._slowest + other._slowest, key=lambda item: item[0])
+        # the second item only keeps the order of equal durations, it has to be unique
+        self._slowest = [(duration, index, execution) for (index, (duration, _, execution)) in enumerate(slowest)]
+        heapq.heapify(self._slowest)
+        self._added += other._added
+
+    def snapshot(self):
+        '''Current aggregates as JSON-serializable dict.'''
+        return {
+            'statements': self._total.summary() if self._total.count else {'count': 0},
+            'byModule': [dict(module=name, line=line, **summary) for ((name, line), summary) in self._modules.summaries()],
+            'byStatement': [dict(sqlId=sqlId, sql=self._statements.labels.get(sqlId), **summary)
+                for (sqlId, summary) in self._statements.summaries()],
+            'slowest': [execution for (_, _, execution) in sorted(self._slowest, reverse=True)],
+        }
+
+    def summaryText(self, snapshot):
+        '''Short text of the snapshot for the log.'''
+        total = snapshot['statements']
+        if not total['count']:
+            return 'Live stats: no statements executed.'
+        lines = ['Live stats: {count} statements, p50/p95/p99 {p50}/{p95}/{p99} ms, max {max} ms.'.format(**total)]
+        for module in snapshot['byModule'][:_SUMMARY_SIZE]:
+            lines.append('  module {module}:{line} - {count} executions, p99 {p99} ms'.format(**module))
+        for statement in snapshot['byStatement'][:_SUMMARY_SIZE]:
+            lines.append('  statement {sqlId} - {count} executions, p99 {p99} ms'.format(**statement))
+        return '\n'.join(lines)
+
+    def _execution(self, event):
+        return {
+            'dateTime': event.DATE_TIME.isoformat(sep=' ') if event.DATE_TIME else None,
+            'durationMs': event.DURATION_MS,
+            'attachmentId': event.ATTACHMENTID,
+            'transactionId': event.TRANSACTIONID,
+            'module': event.MODULE_NAME,
+            'line': event.MODULE_LINE,
+            'sqlId': event.SQL_ID,
+        }
+
+
+def writeSnapshot(path, snapshot):
+    '''The file is replaced at once, so readers never see it half-written.'''
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'w', encoding='utf8') as f:
+        json.dump(snapshot, f, indent=1, ensure_ascii=False)
+    os.replace(tmpPath, path)
@@ -0,0 +1,305 @@
+import os
+import re
+import hashlib
+import mmap
+import time
+from eventdata import EventParser
+
+_ENCODING = 'utf8'
+_HEADER_MIN_LENGTH = 24
+_BLOCK_SIZE = 256 * 1024
+_IDENTITY_SIZE = 4096
+# polling interval of the followed file grows from _POLL_MIN to _POLL_MAX seconds while nothing new arrives
+_POLL_MIN = 0.02
+_POLL_MAX = 0.5
+_HEADER_PATTERN = re.compile(rb'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{4} ', re.MULTILINE)
+
+
+def isEventHeader(line):
+    '''Byte-level check for 1234-12-12T12:12:12.1234 <...> EVENT_TYPE line, same as EventParser._findEventInfo does.'''
+    return (len(line) > _HEADER_MIN_LENGTH and line[4:5] == line[7:8] == b'-' and line[10:11] == b'T'
+            and line[13:14] == line[16:17] == b':' and line[19:20] == b'.' and line[0:4].isdigit())
+
+
+def _nextEventStart(f, offset, limit):
+    '''Returns offset of first event header line starting at or after offset (or limit if there is none).'''
+    f.seek(offset)
+    if offset:
+        # we are likely in the middle of a line, so the first header may start only after next line break
+        f.seek(offset - 1)
+        offset += len(f.readline()) - 1
+    while offset < limit:
+        line = f.readline()
+        if not line or isEventHeader(line):
+            break
+        offset += len(line)
+    return min(offset, limit)
+
+
+def fileIdentity(path, growing=False):
+    '''Hash of the first _IDENTITY_SIZE bytes of the file: the log file keeps its identity when it is renamed, copied
+    or has grown, unlike inode or size. Trace logs start with timestamps and session ids, so different logs differ.
+    A growing file (--follow mode) has no identity (None) until it has _IDENTITY_SIZE bytes, as its head still changes.'''
+    with open(path, 'rb') as f:
+        return _headIdentity(f.read(_IDENTITY_SIZE), growing)
+
+
+def _headIdentity(head, growing):
+    if growing and len(head) < _IDENTITY_SIZE:
+        return None
+    return hashlib.sha1(head).hexdigest()
+
+
+def _lastEventStart(data):
+    '''Returns offset of the last event header line in data (not counting one at offset 0), 0 if there is none.'''
+    position = len(data)
+    while True:
+        position = data.rfind(b'\n', 0, position)
+        if position < 0:
+            return 0
+        if isEventHeader(data[position + 1:position + _HEADER_MIN_LENGTH + 2]):
+            return position + 1
+
+
+def _blockLines(data):
+    '''Lines of the block, split at '\n' only, the same way as the trace session output (traceengine), and without
+    the '\r' of '\r\n'. str.splitlines() would split statement texts at \x0b, \x0c, \x1c-\x1e, \x85, \u2028 and \u2029 too.'''
+    text = data.decode(_ENCODING, errors='replace')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n')
+    lines = text.split('\n')
+    if not lines[-1]:
+        lines.pop()
+    elif lines[-1].endswith('\r'):
+        lines[-1] = lines[-1][:-1]
+    return lines
+
+
+def splitByEvents(path, rangeSize, start=0):
+    '''Splits the log file (from start offset on) into (start, end) byte ranges of about rangeSize bytes.
+    Every range except the first one begins with an event header line, so the ranges can be parsed independently.'''
+    size = os.path.getsize(path)
+    ranges = list()
+    with open(path, 'rb') as f:
+        while start < size:
+            end = _nextEventStart(f, start + rangeSize, size) if start + rangeSize < size else size
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parseRange(path, start, end, rawOutput, rawOutputPrefix, eventFilter=None):
+    '''Parses the byte range of the log file, returns (list of its events, seconds spent, number of events filtered out).'''
+    started = time.perf_counter()
+    parser = EventParser(rawOutput, rawOutputPrefix, eventFilter)
+    events = list()
+    with FileSource(path, start, end) as source:
+        block = source.readBlock()
+        while block is not None:
+            for line in block:
+                parser.parse(line)
+                event = parser.popEvent()
+                if event:
+                    events.append(event)
+            block = source.readBlock()
+    parser.finish()
+    event = parser.popEvent()
+    if event:
+        events.append(event)
+    return (events, time.perf_counter() - started, parser.filtered)
+
+
+class FileSource:
+    '''Memory-mapped reader of the log file (or of its [start, end) byte range).
+    Event header lines are searched for in raw bytes, and the file is returned in blocks of whole events:
+    each block is about blockSize bytes, decoded at once and split to lines. Data before the first event
+    header is skipped without decoding, because the parser ignores it anyway.'''
+    def __init__(self, path, start=0, end=None, blockSize=_BLOCK_SIZE):
+        self.name = path
+        self.blockStart = start
+        self._identity = None
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._end = self._size if end is None else min(end, self._size)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._size else None
+        self._blockSize = blockSize
+        self._offset = start
+        self._skipToFirstEvent()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def offset(self):
+        return self._offset
+
+    def size(self):
+        return self._end
+
+    def identity(self):
+        if self._identity is None:
+            self._identity = fileIdentity(self.name)
+        return self._identity
+
+    def readBlock(self, timeout=None):
+        '''Returns list of lines of the next block, or None at the end of the file (range).
+        timeout is not used: the file is read as it is.'''
+        if self._offset >= self._end:
+            return None
+        start = self.blockStart = self._offset
+        self._offset = self._eventStart(start + self._blockSize)
+        return _blockLines(self._map[start:self._offset])
+
+    def _skipToFirstEvent(self):
+        if self._offset < self._end and not isEventHeader(self._map[self._offset:self._offset + _HEADER_MIN_LENGTH + 1]):
+            self._offset = self._eventStart(self._offset)
+
+    def _eventStart(self, offset):
+        '''Returns offset of the first event header line starting at or after offset (or end of range).'''
+        if offset >= self._end:
+            return self._end
+        header = _HEADER_PATTERN.search(self._map, offset, self._end)
+        return header.start() if header else self._end
+
+
+class FollowSource:
+    '''Reader of the log file that is still being written (--follow mode), with the interface of FileSource.
+    Blocks are whole events: the last event of the file is held back until the next event header shows up
+    (the parser could not complete it before that anyway), so blocks never end in the middle of an event or a line.
+    While nothing new arrives, the file is polled with growing intervals, waiting with sleep(seconds),
+    which returns True when the reading should stop (as Event.wait does).
+    Rotation is noticed when the path leads to another file, or the file gets shorter than the offset read:
+    the rest of the old file is read first (found in the same dir by its inode, if it has been renamed),
+    then the new file from its start. The file is not kept open between reads, so the server can rename it.'''
+    def __init__(self, path, start=0, blockSize=_BLOCK_SIZE, sleep=time.sleep):
+        self.name = path
+        self.blockStart = start
+        self._blockSize = blockSize
+        self._sleep = sleep
+        self._path = path
+        self._draining = False
+        self._stat = None
+        self._offset = start
+        self._identity = None
+        self._poll = _POLL_MIN
+
+    def close(self):
+        pass
+
+    def offset(self):
+        return self._offset
+
+    def size(self):
+        try:
+            return os.path.getsize(self._path)
+        except OSError:
+            return self._offset
+
+    def identity(self):
+        return self._identity
+
+    def readBlock(self, timeout=None):
+        '''Returns list of lines of the next block, or empty list if no whole event has arrived during timeout seconds
+        (None - until one arrives or sleep() tells to stop).'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            lines = self._read()
+            if lines:
+                self._poll = _POLL_MIN
+                return lines
+            if self._draining:
+                # the old file is read to the end
+                self._switch()
+                continue
+            if lines is None:
+                self._rotate()
+                continue
+            wait = self._poll if deadline is None else min(self._poll, deadline - time.monotonic())
+            if wait <= 0 or self._sleep(wait):
+                return list()
+            self._poll = min(self._poll * 2, _POLL_MAX)
+
+    def _read(self):
+        '''Returns the lines of the next block, or None if the file has been rotated.'''
+        try:
+            f = open(self._path, 'rb')
+        except FileNotFoundError:
+            # renamed (the new file is not created yet), or not created yet
+            return None if self._stat is not None and not self._draining else list()
+        with f:
+            stat = os.fstat(f.fileno())
+            if self._stat is None:
+                self._stat = stat
+            elif not self._draining and (not os.path.samestat(stat, self._stat) or stat.st_size < self._offset):
+                return None
+            if self._identity is None and (stat.st_size >= _IDENTITY_SIZE or self._draining):
+                self._identity = _headIdentity(f.read(_IDENTITY_SIZE), not self._draining)
+            return self._readEvents(f)
+
+    def _readEvents(self, f):
+        '''Returns the lines of whole events from the offset on, of about blockSize bytes (more, if an event is bigger).
+        Data before the first event header is skipped, like FileSource does.'''
+        readSize = self._blockSize
+        while True:
+            f.seek(self._offset)
+            data = f.read(readSize)
+            if not data:
+                return list()
+            if not isEventHeader(data[:_HEADER_MIN_LENGTH + 1]):
+                header = _HEADER_PATTERN.search(data)
+                skipped = header.start() if header else data.rfind(b'\n') + 1
+                if not skipped:
+                    return list()
+                self._offset += skipped
+                continue
+            if self._draining and len(data) < readSize:
+                # the old file is not written anymore, so its last event is whole
+                end = len(data)
+            else:
+                end = _lastEventStart(data)
+                if not end:
+                    if len(data) < readSize:
+                        return list()
+                    readSize *= 2
+                    continue
+            self.blockStart = self._offset
+            self._offset += end
+            return _blockLines(data[:end])
+
+    def _rotate(self):
+        renamed = self._findRenamed()
+        if renamed:
+            self._path = renamed
+            self._draining = True
+        else:
+            # truncated, or the old file is gone
+            self._switch()
+
+    def _findRenamed(self):
+        '''Returns the path the file being read has been renamed to, if it is in the same dir.'''
+        directory = os.path.dirname(os.path.abspath(self.name))
+        for entry in os.scandir(directory):
+            if entry.path == os.path.join(directory, os.path.basename(self.name)):
+                continue
+            try:
+                # stat() of DirEntry has no inode on Windows
+                if entry.is_file() and os.path.samestat(os.stat(entry.path), self._stat):
+                    return entry.path
+            except OSError:
+                pass
+        return None
+
+    def _switch(self):
+        self._path = self.name
+        self._draining = False
+        self._stat = None
+        self._offset = 0
+        self._identity = None
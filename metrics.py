@@ -0,0 +1,163 @@
+import os
+import time
+from bisect import bisect_left
+
+from appdata import PROGRAM_NAME, TracerMetrics
+
+# histogram bucket bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PARSE_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+# counters shown as per second rates in the log
+_RATES = ('trace_lines_read_total', 'dump_lines_processed_total', 'dump_rows_written_total')
+
+
+class Histogram:
+    '''Counts of observed values by bucket (value <= bound), as Prometheus histogram.'''
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value, count=1):
+        self.counts[bisect_left(self.buckets, value)] += count
+        self.sum += value * count
+        self.count += count
+
+    def merge(self, other):
+        for (index, count) in enumerate(other.counts):
+            self.counts[index] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.merge(self)
+        return histogram
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+
+class ProcessMetrics:
+    '''Metrics of one process. Counters and histograms are totals since the process start, gauges are current values.
+    They are sent to the main process as TracerMetrics message at most every interval seconds (0 - never).'''
+    def __init__(self, source, interval):
+        self._source = source
+        self._interval = interval
+        self._sent = time.monotonic()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def total(self, name, value):
+        '''Sets the counter the process counts by itself.'''
+        self.counters[name] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, count=1):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(value, count)
+
+    def due(self):
+        return self._interval > 0 and time.monotonic() - self._sent >= self._interval
+
+    def send(self, communicator):
+        '''The message gets copies: it is pickled by the queue later, while the process goes on updating the metrics.'''
+        if self._interval <= 0:
+            return
+        self._sent = time.monotonic()
+        communicator.pushMessage(TracerMetrics(self._source, dict(self.counters), dict(self.gauges),
+            {name: histogram.copy() for (name, histogram) in self.histograms.items()}))
+
+
+class MetricsCollector:
+    '''Latest metrics of every process, combined by the main process: counters and histograms of all processes are summed,
+    gauges are taken from the process that sent them last. Metric names may have Prometheus labels: 'name{label="value"}'.'''
+    def __init__(self):
+        self._processes = dict()
+        self._own = ProcessMetrics(PROGRAM_NAME, 0)
+        self._previousCounters = dict()
+        self._previousTime = time.monotonic()
+
+    def own(self):
+        '''Metrics of the main process.'''
+        return self._own
+
+    def update(self, message):
+        self._processes[message.source] = message
+
+    def combined(self):
+        '''(counters, gauges, histograms) of all processes.'''
+        counters = dict()
+        gauges = dict()
+        histograms = dict()
+        for message in list(self._processes.values()) + [self._own]:
+            for (name, value) in message.counters.items():
+                counters[name] = counters.get(name, 0) + value
+            gauges.update(message.gauges)
+            for (name, histogram) in message.histograms.items():
+                if name in histograms:
+                    histograms[name].merge(histogram)
+                else:
+                    histograms[name] = histogram.copy()
+        return (counters, gauges, histograms)
+
+    def rates(self, counters):
+        '''Per second rates of _RATES counters since the previous call.'''
+        now = time.monotonic()
+        elapsed = now - self._previousTime
+        rates = {name: (counters.get(name, 0) - self._previousCounters.get(name, 0)) / elapsed if elapsed > 0 else 0.0
+            for name in _RATES}
+        self._previousCounters = counters
+        self._previousTime = now
+        return rates
+
+    def writePrometheus(self, path, counters, gauges, histograms):
+        '''Prometheus text exposition format; the file is replaced at once, so scrapers never see it half-written.'''
+        lines = list()
+        self._appendFamilies(lines, counters, 'counter')
+        self._appendFamilies(lines, gauges, 'gauge')
+        for name in sorted(histograms):
+            histogram = histograms[name]
+            metricName = '{}_{}'.format(PROGRAM_NAME, name)
+            lines.append('# TYPE {} histogram'.format(metricName))
+            cumulative = 0
+            for (bound, count) in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metricName, bound, cumulative))
+            lines.append('{}_sum {}'.format(metricName, histogram.sum))
+            lines.append('{}_count {}'.format(metricName, histogram.count))
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w', encoding='utf8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmpPath, path)
+
+    def summaryText(self, counters, gauges, histograms, rates):
+        '''Short text for the log.'''
+        parse = histograms.get('dump_parse_seconds')
+        flush = histograms.get('dump_flush_seconds')
+        return ('Metrics: read {:.0f} lines/s, processed {:.0f} lines/s, written {:.0f} rows/s; queue {} lines, {:.1f} MB spilled, '
+            'oldest unprocessed {:.1f} s; parse {:.1f} us/event, flush {:.1f} ms avg; {} errors.'.format(
+                rates['trace_lines_read_total'], rates['dump_lines_processed_total'], rates['dump_rows_written_total'],
+                gauges.get('queue_lines', 0), gauges.get('spill_bytes', 0) / 2**20, gauges.get('oldest_unprocessed_age_seconds', 0),
+                parse.mean() * 10**6 if parse else 0, flush.mean() * 1000 if flush else 0,
+                sum(value for (name, value) in counters.items() if name.startswith('errors_total'))
+            )
+        )
+
+    def _appendFamilies(self, lines, values, metricType):
+        typed = set()
+        for name in sorted(values):
+            family = name.split('{')[0]
+            if family not in typed:
+                typed.add(family)
+                lines.append('# TYPE {}_{} {}'.format(PROGRAM_NAME, family, metricType))
+            lines.append('{}_{} {}'.format(PROGRAM_NAME, name, values[name]))
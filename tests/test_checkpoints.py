@@ -0,0 +1,144 @@
+'''File checkpoints: a log file is known by the hash of its head, so a --file run over the same log (grown, renamed
+or copied) goes on from where the previous one stopped.
+
+    python -m pytest tests'''
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import appdata  # noqa: E402
+import logfile  # noqa: E402
+import tracegen  # noqa: E402
+from appdata import Communicator  # noqa: E402
+from dumpengine import DumpEngine  # noqa: E402
+
+_SCRIPT = os.path.join(ROOT, 'db', 'create_db.sql')
+# more than one block (logfile._BLOCK_SIZE) of trace output
+_EVENTS = 1200
+_ROW_KEY = 'EVENT_NAME, DATE_TIME, ATTACHMENTID, TRANSACTIONID, STATEMENT_ID'
+
+
+def dumpParams(pairEvents=False, pairIndexSize=100000):
+    return appdata._DumpParameters('sqlite', '', '', False, 50, 1.0, 10000, 'none', 0, 1, pairEvents, pairIndexSize, 0, 0)
+
+
+def dumpFile(logPath, dbPath, params=None):
+    '''One --file run, the way dumpengine.run() does it.'''
+    engine = DumpEngine(params or dumpParams(), dbPath, _SCRIPT, Communicator(datastore=logPath))
+    engine.createDb()
+    engine.connect()
+    engine.loadCheckpoint()
+    engine.runDump()
+
+
+def dumpedRows(dbPath):
+    with sqlite3.connect(dbPath) as connection:
+        return connection.execute('SELECT {} FROM TRACE_DATA_PARSED ORDER BY ID'.format(_ROW_KEY)).fetchall()
+
+
+def checkpointOffset(dbPath):
+    with sqlite3.connect(dbPath) as connection:
+        return connection.execute('SELECT FILE_OFFSET FROM FILE_CHECKPOINTS').fetchone()[0]
+
+
+def writeEvents(path, generator, events, mode='w'):
+    with open(path, mode, encoding='utf8', newline='\n') as f:
+        for _ in range(events):
+            f.write(generator.event())
+
+
+class CheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = self.path('trace.log')
+        self.db = self.path('dump.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def referenceRows(self, log):
+        '''Rows of the log dumped by one run.'''
+        dbPath = self.path('reference.sqlite')
+        dumpFile(log, dbPath)
+        rows = dumpedRows(dbPath)
+        os.remove(dbPath)
+        return rows
+
+
+class FileIdentityTest(CheckpointTestCase):
+    def testIdentityIsKeptWhenFileIsRenamedCopiedOrGrown(self):
+        generator = tracegen.TraceGenerator(seed=1)
+        writeEvents(self.log, generator, 20)
+        identity = logfile.fileIdentity(self.log)
+        copy = shutil.copy(self.log, self.path('copy.log'))
+        self.assertEqual(logfile.fileIdentity(copy), identity)
+        os.rename(self.log, self.path('renamed.log'))
+        writeEvents(self.path('renamed.log'), generator, 20, mode='a')
+        self.assertEqual(logfile.fileIdentity(self.path('renamed.log')), identity)
+
+    def testOtherLogHasOtherIdentity(self):
+        writeEvents(self.log, tracegen.TraceGenerator(seed=1), 20)
+        writeEvents(self.path('other.log'), tracegen.TraceGenerator(seed=2), 20)
+        self.assertNotEqual(logfile.fileIdentity(self.log), logfile.fileIdentity(self.path('other.log')))
+
+    def testGrowingFileHasNoIdentityUntilItsHeadIsComplete(self):
+        with open(self.log, 'wb') as f:
+            f.write(b'x' * (logfile._IDENTITY_SIZE - 1))
+        self.assertIsNone(logfile.fileIdentity(self.log, growing=True))
+        self.assertIsNotNone(logfile.fileIdentity(self.log))
+        with open(self.log, 'ab') as f:
+            f.write(b'x')
+        self.assertEqual(logfile.fileIdentity(self.log, growing=True), logfile.fileIdentity(self.log))
+
+
+class ResumeTest(CheckpointTestCase):
+    def testGrownLogIsDumpedFromCheckpoint(self):
+        generator = tracegen.TraceGenerator(seed=1)
+        writeEvents(self.log, generator, _EVENTS // 2)
+        dumpFile(self.log, self.db)
+        # the last block read is not the first one
+        self.assertGreater(checkpointOffset(self.db), 0)
+        writeEvents(self.log, generator, _EVENTS - _EVENTS // 2, mode='a')
+        dumpFile(self.log, self.db)
+        self.assertEqual(dumpedRows(self.db), self.referenceRows(self.log))
+
+    def testCopyOfDumpedLogIsNotDumpedAgain(self):
+        writeEvents(self.log, tracegen.TraceGenerator(seed=1), _EVENTS)
+        dumpFile(self.log, self.db)
+        rows = dumpedRows(self.db)
+        dumpFile(shutil.copy(self.log, self.path('copy.log')), self.db)
+        self.assertEqual(dumpedRows(self.db), rows)
+
+    def testOtherLogIsDumpedFromStart(self):
+        writeEvents(self.log, tracegen.TraceGenerator(seed=1), _EVENTS)
+        other = self.path('other.log')
+        writeEvents(other, tracegen.TraceGenerator(seed=2), _EVENTS // 2)
+        dumpFile(self.log, self.db)
+        dumpFile(other, self.db)
+        self.assertEqual(dumpedRows(self.db), self.referenceRows(self.log) + self.referenceRows(other))
+
+    def testCheckpointBeyondEndOfFileIsIgnored(self):
+        generator = tracegen.TraceGenerator(seed=1)
+        writeEvents(self.log, generator, _EVENTS)
+        identity = logfile.fileIdentity(self.log)
+        dumpFile(self.log, self.db)
+        # the same head, but shorter than the dumped log: dumped from the start once more
+        writeEvents(self.log, tracegen.TraceGenerator(seed=1), 20)
+        self.assertEqual(logfile.fileIdentity(self.log), identity)
+        rows = dumpedRows(self.db)
+        dumpFile(self.log, self.db)
+        self.assertEqual(dumpedRows(self.db), rows + self.referenceRows(self.log))
+
+
+if __name__ == '__main__':
+    unittest.main()
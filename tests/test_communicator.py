@@ -0,0 +1,83 @@
+'''Communicator spill file: blocks that do not fit into the queue come back in order, and the file starts over
+once it is read to the end.
+
+    python -m pytest tests'''
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from appdata import Communicator, EOFReached  # noqa: E402
+
+_TIMEOUT = 5
+
+
+class SpillFileTest(unittest.TestCase):
+    def setUp(self):
+        self.spillDir = tempfile.mkdtemp()
+        # every line is a block, two of them fit into the queue
+        self.comm = Communicator(chunkSize=1, queueSize=2, spillDir=self.spillDir)
+
+    def tearDown(self):
+        self.comm.close()
+        shutil.rmtree(self.spillDir)
+
+    def push(self, lines):
+        for line in lines:
+            self.comm.pushLine(line)
+
+    def pop(self, count):
+        return [self.comm.popLine(timeout=_TIMEOUT) for _ in range(count)]
+
+    def spillFileSize(self):
+        (path,) = glob.glob(os.path.join(self.spillDir, '*.spill'))
+        return os.path.getsize(path)
+
+    def testBlocksComeInOrder(self):
+        lines = ['line {}'.format(i) for i in range(20)]
+        self.push(lines)
+        self.assertGreater(self.comm.spilledBytes(), 0)
+        self.assertEqual(self.pop(len(lines)), lines)
+
+    def testBlocksGoToSpillFileUntilItIsRead(self):
+        self.push(['a', 'b', 'c'])
+        spilled = self.comm.spilledBytes()
+        self.assertEqual(self.pop(1), ['a'])
+        # the queue has room now, but 'c' waits in the spill file, so 'd' must follow it there
+        self.push(['d'])
+        self.assertGreater(self.comm.spilledBytes(), spilled)
+        self.assertEqual(self.pop(3), ['b', 'c', 'd'])
+
+    def testSpillFileIsTruncatedWhenRead(self):
+        self.push(['line {}'.format(i) for i in range(10)])
+        self.assertGreater(self.spillFileSize(), 0)
+        self.pop(10)
+        self.assertEqual(self.comm.spilledBytes(), 0)
+        self.assertEqual(self.spillFileSize(), 0)
+        # and is written and read from its start again
+        lines = ['again {}'.format(i) for i in range(10)]
+        self.push(lines)
+        self.assertGreater(self.comm.spilledBytes(), 0)
+        self.assertEqual(self.pop(10), lines)
+        self.assertEqual(self.spillFileSize(), 0)
+
+    def testEndOfDataAfterSpilledBlocks(self):
+        self.push(['a', 'b', 'c', 'd'])
+        self.comm.endOfData()
+        self.assertEqual(self.pop(4), ['a', 'b', 'c', 'd'])
+        with self.assertRaises(EOFReached):
+            self.comm.popLine(timeout=_TIMEOUT)
+
+    def testCloseRemovesSpillFile(self):
+        self.push(['a', 'b', 'c'])
+        self.comm.close()
+        self.assertEqual(glob.glob(os.path.join(self.spillDir, '*.spill')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+'''Dump sinks: rows written to SQLite and read back, and the schema of an existing dump database checked against
+db/create_db.sql.
+
+    python -m pytest tests'''
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import appdata  # noqa: E402
+from appdata import Communicator, TracerError  # noqa: E402
+from dumpengine import DumpEngine  # noqa: E402
+from dumpsinks import DbScript, DumpFiles, SQLiteSink  # noqa: E402
+from eventdata import EventData, EventParser, RAWOUTPUT_ZLIB, TABLESTATS_FIELDS, decompressRawOutput, normalizeSql  # noqa: E402
+
+_SCRIPT = os.path.join(ROOT, 'db', 'create_db.sql')
+# TRACE_DATA_PARSED of the tracer before the parsed counters, fingerprints and checkpoints
+_OLD_SCHEMA = ('CREATE TABLE TRACE_DATA_PARSED (ID INTEGER NOT NULL, CREATED TIMESTAMP, DATE_TIME TIMESTAMP, EVENT_NAME TEXT, '
+    'ATTACHMENTID INTEGER, SQL_TEXT TEXT, RAW_OUTPUT TEXT)')
+
+_EVENTS = '''2024-01-01T10:00:00.1234 (4076:000000000220B040) EXECUTE_STATEMENT_FINISH
+\tD:\\DB\\PROD.FDB (ATT_1001, SUPUSER:NONE, UTF8, TCPv4:10.1.0.2/50000)
+\tC:\\APP\\SUPCLIENT.EXE:1234
+\t\t(TRA_50001, READ_COMMITTED | REC_VERSION | WAIT | READ_WRITE)
+
+Statement 9001:
+-------------------------------------------------------------------------------
+/*__SUPSQL__/UORDERS.pas/120*/
+update orders set state = 2 where id = 15
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+PLAN (ORDERS INDEX (PK_ORDERS))
+
+1 records fetched
+     12 ms, 4 read(s), 40 fetch(es), 2 mark(s)
+
+Table                             Natural     Index    Update    Insert    Delete   Backout     Purge   Expunge
+***************************************************************************************************************
+ORDERS                                          1         1
+RDB$DATABASE                        1
+
+2024-01-01T10:00:01.0000 (4076:000000000220B040) COMMIT_TRANSACTION
+\tD:\\DB\\PROD.FDB (ATT_1001, SUPUSER:NONE, UTF8, TCPv4:10.1.0.2/50000)
+\tC:\\APP\\SUPCLIENT.EXE:1234
+\t\t(TRA_50001, READ_COMMITTED | REC_VERSION | WAIT | READ_WRITE)
+      3 ms, 1 write(s), 9 fetch(es)
+'''
+
+
+def parsedEvents():
+    parser = EventParser(RAWOUTPUT_ZLIB)
+    events = list()
+    for line in _EVENTS.split('\n'):
+        parser.parse(line)
+        event = parser.popEvent()
+        if event:
+            events.append(event)
+    parser.finish()
+    events.append(parser.popEvent())
+    return events
+
+
+def dumpParams():
+    return appdata._DumpParameters('sqlite', '', '', False, 50, 1.0, 10000, 'none', 0, 1, False, 100000, 0, 0)
+
+
+def messages(comm):
+    result = list()
+    while True:
+        message = comm.popMessage(timeout=0.1)
+        if not message:
+            return result
+        result.append(message)
+
+
+class SinkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, 'dump.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def createOld(self, path):
+        with sqlite3.connect(path) as connection:
+            connection.execute(_OLD_SCHEMA)
+        connection.close()
+
+
+class SQLiteSinkTest(SinkTestCase):
+    def setUp(self):
+        super().setUp()
+        EventData.setFields(['ID'] + DbScript(_SCRIPT).parsedFields())
+        self.sink = SQLiteSink(self.db, _SCRIPT)
+        # as a rotated file is created: indices are built when the dump leaves it
+        self.sink.create(deferred=False)
+        self.sink.connect()
+
+    def tearDown(self):
+        self.sink.disconnect()
+        super().tearDown()
+
+    def write(self, rows):
+        '''The way DumpEngine._write() does it.'''
+        for (row, rowId) in zip(rows, range(self.sink.reserveIds(len(rows)), 10**9)):
+            row.ID = rowId
+        self.sink.writeStatements([(row.SQL_ID, normalizeSql(row.sqlText), row.sqlText) for row in rows if row.SQL_ID])
+        self.sink.writeEvents(rows)
+        self.sink.writeTableStats([(row.ID,) + stats for row in rows if row.tableStats for stats in row.tableStats])
+
+    def query(self, sql):
+        with sqlite3.connect(self.db) as connection:
+            return connection.execute(sql).fetchall()
+
+    def testRowsReadBack(self):
+        rows = parsedEvents()
+        rows[0].SOURCE_HOST = 'host1'
+        self.write(rows)
+        self.sink.writeCheckpoint('abc', 'trace.log', (1000, 2, 0, 0))
+        self.sink.commit()
+        dumped = self.query('SELECT ID, SOURCE_HOST, DATE_TIME, EVENT_NAME, ATTACHMENTID, TRANSACTIONID, STATEMENT_ID, MODULE_NAME, '
+            'MODULE_LINE, DURATION_MS, RECORDS_FETCHED, READS, WRITES, FETCHES, MARKS, SQL_ID, RAW_OUTPUT, RAW_OUTPUT_ZLIB '
+            'FROM TRACE_DATA_PARSED ORDER BY ID')
+        self.assertEqual([row[:16] for row in dumped], [
+            (1, 'host1', '2024-01-01 10:00:00.123400', 'EXECUTE_STATEMENT_FINISH', 1001, 50001, 9001, 'UORDERS', 120,
+                12, 1, 4, 0, 40, 2, rows[0].SQL_ID),
+            (2, None, '2024-01-01 10:00:01', 'COMMIT_TRANSACTION', 1001, 50001, None, None, None, 3, None, 0, 1, 9, 0, None)])
+        self.assertIsNone(dumped[0][16])
+        self.assertEqual(decompressRawOutput(dumped[0][17]), _EVENTS[:_EVENTS.index('2024', 10) - 1])
+        self.assertEqual(self.query('SELECT TRACE_DATA_ID, {} FROM TRACE_TABLE_STATS ORDER BY TABLE_NAME'.format(
+            ', '.join(TABLESTATS_FIELDS))), [(1, 'ORDERS', 0, 1, 1, 0, 0, 0, 0, 0), (1, 'RDB$DATABASE', 1, 0, 0, 0, 0, 0, 0, 0)])
+        self.assertEqual(self.query('SELECT ID, SQL_NORMALIZED FROM SQL_STATEMENTS'),
+            [(rows[0].SQL_ID, 'UPDATE ORDERS SET STATE=? WHERE ID=?')])
+        self.assertEqual(self.sink.readCheckpoint('abc'), (1000, 2, 0, 0))
+        self.assertIsNone(self.sink.readCheckpoint('other'))
+
+    def testStatementIsWrittenOnce(self):
+        self.write(parsedEvents())
+        self.sink.commit()
+        self.write(parsedEvents())
+        self.sink.commit()
+        self.assertEqual(self.query('SELECT COUNT(*) FROM SQL_STATEMENTS'), [(1,)])
+        self.assertEqual(self.query('SELECT MIN(ID), MAX(ID), COUNT(*) FROM TRACE_DATA_PARSED'), [(1, 4, 4)])
+
+    def testRollback(self):
+        self.write(parsedEvents())
+        self.sink.rollback()
+        self.assertEqual(self.query('SELECT COUNT(*) FROM TRACE_DATA_PARSED'), [(0,)])
+        self.assertEqual(self.query('SELECT COUNT(*) FROM TRACE_TABLE_STATS'), [(0,)])
+        # IDs are not given back
+        self.assertEqual(self.sink.reserveIds(5), 3)
+
+    def testDeferredIndices(self):
+        indices = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite%'"
+        self.assertEqual(self.query(indices), [(0,)])
+        self.sink.createDeferred()
+        # the dump may be restarted on a file indexed before
+        self.sink.createDeferred()
+        self.assertEqual(self.query(indices), [(len(DbScript(_SCRIPT).deferredOperations()),)])
+
+
+class SchemaTest(SinkTestCase):
+    def testScriptTables(self):
+        tables = DbScript(_SCRIPT).tables()
+        self.assertEqual(set(tables), {'TRACE_DATA_PARSED', 'SQL_STATEMENTS', 'TRACE_TABLE_STATS', 'FILE_CHECKPOINTS'})
+        self.assertEqual(tables['SQL_STATEMENTS'], ['ID', 'SQL_NORMALIZED', 'SQL_TEXT'])
+        self.assertIn('RAW_OUTPUT_ZLIB', tables['TRACE_DATA_PARSED'])
+
+    def testNewDatabaseIsUpToDate(self):
+        sink = SQLiteSink(self.db, _SCRIPT)
+        sink.create()
+        self.assertEqual(sink.missingSchema(), [])
+
+    def testOldDatabaseIsOutdated(self):
+        self.createOld(self.db)
+        missing = SQLiteSink(self.db, _SCRIPT).missingSchema()
+        self.assertIn('TRACE_DATA_PARSED.DURATION_MS', missing)
+        self.assertIn('TRACE_DATA_PARSED.SQL_ID', missing)
+        self.assertIn('FILE_CHECKPOINTS', missing)
+        self.assertNotIn('TRACE_DATA_PARSED.EVENT_NAME', missing)
+
+    def testOutdatedDatabaseStopsTheDump(self):
+        self.createOld(self.db)
+        comm = Communicator()
+        self.assertFalse(DumpEngine(dumpParams(), self.db, _SCRIPT, comm).createDb())
+        errors = [message.text for message in messages(comm) if isinstance(message, TracerError)]
+        self.assertEqual(len(errors), 1)
+        self.assertIn('schema is outdated', errors[0])
+        # the file is left as it is
+        self.assertIn('TRACE_DATA_PARSED.DURATION_MS', SQLiteSink(self.db, _SCRIPT).missingSchema())
+
+    def testOutdatedRotatedDatabaseStartsNewFile(self):
+        dbFiles = DumpFiles(os.path.join(self.dir, 'dump'), SQLiteSink.EXTENSION, False, 2**30)
+        self.createOld(self.db)
+        engine = DumpEngine(dumpParams(), self.db, _SCRIPT, Communicator(), dbFiles=dbFiles)
+        self.assertTrue(engine.createDb())
+        newFile = os.path.join(self.dir, 'dump-2.sqlite')
+        self.assertEqual(SQLiteSink(newFile, _SCRIPT).missingSchema(), [])
+        engine.connect()
+        engine.disconnect()
+
+
+if __name__ == '__main__':
+    unittest.main()
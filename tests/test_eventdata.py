@@ -0,0 +1,189 @@
+'''SQL fingerprints, and EventParser: fields parsed from the trace events (performance counters, client module, table stats), and the raw event text kept.
+
+    python -m pytest tests'''
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from dumpsinks import DbScript  # noqa: E402
+from eventdata import (EventData, EventParser, RAWOUTPUT_FULL, RAWOUTPUT_NONE, RAWOUTPUT_PREFIX,  # noqa: E402
+    RAWOUTPUT_ZLIB, decompressRawOutput, normalizeSql, sqlFingerprint)
+
+_SCRIPT = os.path.join(ROOT, 'db', 'create_db.sql')
+
+_STATEMENT_FINISH = '''2024-01-01T10:00:00.1234 (4076:000000000220B040) EXECUTE_STATEMENT_FINISH
+\tD:\\DB\\PROD.FDB (ATT_1001, SUPUSER:NONE, UTF8, TCPv4:10.1.0.2/50000)
+\tC:\\APP\\SUPCLIENT.EXE:1234
+\t\t(TRA_50001, READ_COMMITTED | REC_VERSION | WAIT | READ_WRITE)
+
+Statement 9001:
+-------------------------------------------------------------------------------
+/*__SUPSQL__/UORDERS.pas/120*/
+update orders set state = 2, comment = 'готово' where id = 15
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+PLAN (ORDERS INDEX (PK_ORDERS))
+
+3 records fetched
+     12 ms, 4 read(s), 1 write(s), 40 fetch(es), 2 mark(s)
+
+Table                             Natural     Index    Update    Insert    Delete   Backout     Purge   Expunge
+***************************************************************************************************************
+ORDERS                                          1         1
+RDB$DATABASE                        1
+'''
+
+
+def parseEvents(text, rawOutput=RAWOUTPUT_FULL, rawOutputPrefix=0):
+    parser = EventParser(rawOutput, rawOutputPrefix)
+    events = list()
+    for line in text.split('\n'):
+        parser.parse(line)
+        event = parser.popEvent()
+        if event:
+            events.append(event)
+    parser.finish()
+    event = parser.popEvent()
+    if event:
+        events.append(event)
+    return events
+
+
+def parseEvent(text, rawOutput=RAWOUTPUT_FULL, rawOutputPrefix=0):
+    (event,) = parseEvents(text, rawOutput, rawOutputPrefix)
+    return event
+
+
+def fingerprint(sqlText):
+    return sqlFingerprint(normalizeSql(sqlText))
+
+
+class FingerprintTest(unittest.TestCase):
+    def testLiteralsAndWhitespaceDoNotMatter(self):
+        self.assertEqual(normalizeSql('select * from t where id = 5'), 'SELECT*FROM T WHERE ID=?')
+        self.assertEqual(fingerprint('select * from t where id = 5'), fingerprint('SELECT *\n  FROM t\tWHERE id=7'))
+        self.assertEqual(fingerprint("select a from t where s = 'x' and f = 1.5"),
+            fingerprint("select a from t where s = 'it''s'   and f = 2E10"))
+        self.assertEqual(fingerprint('select a from t where b in (1, 2, 3)'), fingerprint('select a from t where b in (4)'))
+
+    def testCommentsDoNotMatter(self):
+        self.assertEqual(fingerprint('/*__SUPSQL__/UORDERS.pas/120*/\nselect a from t -- all of them'),
+            fingerprint('select a from t'))
+
+    def testStatementsDiffer(self):
+        self.assertNotEqual(fingerprint('select a from t1'), fingerprint('select a from t2'))
+        self.assertNotEqual(fingerprint('select a from t where id = 1'), fingerprint('select a from t where id > 1'))
+        self.assertNotEqual(fingerprint("select a from t where s = '1'"), fingerprint('select a from t where s = "1"'))
+
+    def testFingerprintIsStable(self):
+        # SQL_ID values of the dump databases written before must stay valid
+        self.assertEqual(fingerprint('select * from t where id = 5'), -5214513270416150665)
+        self.assertLess(abs(fingerprint('select a from t')), 2**63)
+
+    def testParsedEventFingerprint(self):
+        EventData.setFields(['ID'] + DbScript(_SCRIPT).parsedFields())
+        event = parseEvent(_STATEMENT_FINISH)
+        self.assertEqual(event.SQL_ID, fingerprint(event.sqlText))
+        other = parseEvent(_STATEMENT_FINISH.replace("comment = 'готово' where id = 15", "comment = 'x' where id = 7"))
+        self.assertEqual(other.SQL_ID, event.SQL_ID)
+
+
+class ParserTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        EventData.setFields(['ID'] + DbScript(_SCRIPT).parsedFields())
+
+
+class CountersTest(ParserTestCase):
+    def withPerformance(self, line):
+        return _STATEMENT_FINISH.replace('     12 ms, 4 read(s), 1 write(s), 40 fetch(es), 2 mark(s)', line)
+
+    def counters(self, event):
+        return (event.DURATION_MS, event.READS, event.WRITES, event.FETCHES, event.MARKS)
+
+    def testAllCounters(self):
+        event = parseEvent(_STATEMENT_FINISH)
+        self.assertEqual(self.counters(event), (12, 4, 1, 40, 2))
+        self.assertEqual(event.RECORDS_FETCHED, 3)
+
+    def testOmittedCountersAreZero(self):
+        self.assertEqual(self.counters(parseEvent(self.withPerformance('      5 ms, 7 fetch(es)'))), (5, 0, 0, 7, 0))
+        self.assertEqual(self.counters(parseEvent(self.withPerformance('      0 ms'))), (0, 0, 0, 0, 0))
+        self.assertEqual(self.counters(parseEvent(self.withPerformance('   1234 ms, 3 write(s), 1 mark(s)'))),
+            (1234, 0, 3, 0, 1))
+
+    def testOtherLinesAreNotCounters(self):
+        self.assertEqual(self.counters(parseEvent(self.withPerformance('      5 ms, 7 apples'))), (None,) * 5)
+        self.assertEqual(self.counters(parseEvent(self.withPerformance('      5 read(s), 7 fetch(es)'))), (None,) * 5)
+
+    def testEventWithoutPerformanceInfo(self):
+        event = parseEvent(_STATEMENT_FINISH.replace('EXECUTE_STATEMENT_FINISH', 'EXECUTE_STATEMENT_START')
+            .split('\n3 records fetched')[0] + '\n')
+        self.assertEqual(self.counters(event), (None,) * 5)
+        self.assertIsNone(event.RECORDS_FETCHED)
+
+    def testModuleFromStatementComment(self):
+        event = parseEvent(_STATEMENT_FINISH)
+        self.assertEqual((event.MODULE_NAME, event.MODULE_LINE), ('UORDERS', '120'))
+        self.assertEqual(event.STATEMENT_ID, 9001)
+        self.assertIn("comment = 'готово'", event.sqlText)
+        self.assertIsNone(parseEvent(_STATEMENT_FINISH.replace('/*__SUPSQL__/UORDERS.pas/120*/', '/* other */')).MODULE_NAME)
+
+
+class TableStatsTest(ParserTestCase):
+    def testTableStatsBlock(self):
+        event = parseEvent(_STATEMENT_FINISH)
+        self.assertEqual(event.tableStats, [('ORDERS', 0, 1, 1, 0, 0, 0, 0, 0), ('RDB$DATABASE', 1, 0, 0, 0, 0, 0, 0, 0)])
+
+    def testCountersFillingTheirColumns(self):
+        line = '{:<31}'.format('ORDER_LINES') + ''.join('{:>10}'.format(value) for value in (1234567890, 22, 3, 4, 5, 6, 7, 8))
+        event = parseEvent(_STATEMENT_FINISH + line + '\n')
+        self.assertEqual(event.tableStats[-1], ('ORDER_LINES', 1234567890, 22, 3, 4, 5, 6, 7, 8))
+
+    def testBlockEndsWithEmptyLine(self):
+        event = parseEvent(_STATEMENT_FINISH + '\nSTOCK                               1\n')
+        self.assertEqual([stats[0] for stats in event.tableStats], ['ORDERS', 'RDB$DATABASE'])
+
+    def testEventWithoutTableStats(self):
+        self.assertIsNone(parseEvent(_STATEMENT_FINISH.split('\nTable ')[0] + '\n').tableStats)
+
+    def testStatsOfEveryEvent(self):
+        (first, second) = parseEvents(_STATEMENT_FINISH + _STATEMENT_FINISH.replace('RDB$DATABASE', 'CLIENTS     '))
+        self.assertEqual([stats[0] for stats in first.tableStats], ['ORDERS', 'RDB$DATABASE'])
+        self.assertEqual([stats[0] for stats in second.tableStats], ['ORDERS', 'CLIENTS'])
+
+
+class RawOutputTest(ParserTestCase):
+    def testFull(self):
+        event = parseEvent(_STATEMENT_FINISH)
+        self.assertEqual(event.RAW_OUTPUT, _STATEMENT_FINISH)
+        self.assertIsNone(event.RAW_OUTPUT_ZLIB)
+
+    def testNone(self):
+        event = parseEvent(_STATEMENT_FINISH, RAWOUTPUT_NONE)
+        self.assertIsNone(event.RAW_OUTPUT)
+        self.assertIsNone(event.RAW_OUTPUT_ZLIB)
+
+    def testPrefixIsCutInBytes(self):
+        text = _STATEMENT_FINISH
+        # 'готово' is 12 bytes: the prefix ends in the middle of its 'в'
+        size = len(text[:text.index('в')].encode('utf8')) + 1
+        prefix = parseEvent(_STATEMENT_FINISH, RAWOUTPUT_PREFIX, size).RAW_OUTPUT
+        self.assertEqual(prefix, text[:text.index('в')])
+        self.assertLessEqual(len(prefix.encode('utf8')), size)
+        self.assertEqual(parseEvent(_STATEMENT_FINISH, RAWOUTPUT_PREFIX, 10).RAW_OUTPUT, '2024-01-01')
+
+    def testZlibRoundTrip(self):
+        event = parseEvent(_STATEMENT_FINISH, RAWOUTPUT_ZLIB)
+        self.assertIsNone(event.RAW_OUTPUT)
+        self.assertIsInstance(event.RAW_OUTPUT_ZLIB, bytes)
+        self.assertEqual(decompressRawOutput(event.RAW_OUTPUT_ZLIB), _STATEMENT_FINISH)
+        # as read back from a BLOB column
+        self.assertEqual(decompressRawOutput(memoryview(event.RAW_OUTPUT_ZLIB)), _STATEMENT_FINISH)
+        self.assertIsNone(decompressRawOutput(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
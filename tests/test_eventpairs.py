@@ -0,0 +1,183 @@
+'''EventPairs: opening and closing events merged into one row, the index of open events limited by size and age,
+and the open events kept over a --file run resumed from its checkpoint.
+
+    python -m pytest tests'''
+import os
+import sys
+import sqlite3
+import datetime
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import tracegen  # noqa: E402
+from eventdata import EventData  # noqa: E402
+from eventpairs import EventPairs  # noqa: E402
+from dumpsinks import DbScript  # noqa: E402
+from test_checkpoints import CheckpointTestCase, dumpParams, dumpedRows, writeEvents  # noqa: E402
+from dumpengine import DumpEngine  # noqa: E402
+from appdata import Communicator  # noqa: E402
+
+_SCRIPT = os.path.join(ROOT, 'db', 'create_db.sql')
+_START = datetime.datetime(2024, 1, 1)
+
+
+def event(name, seconds, attachment=1, statement=None, transaction=None):
+    data = EventData()
+    data.EVENT_NAME = name
+    data.DATE_TIME = _START + datetime.timedelta(seconds=seconds)
+    data.ATTACHMENTID = attachment
+    data.STATEMENT_ID = statement
+    data.TRANSACTIONID = transaction
+    return data
+
+
+def statementStart(seconds, statement, attachment=1):
+    return event('EXECUTE_STATEMENT_START', seconds, attachment, statement=statement)
+
+
+def statementFinish(seconds, statement, attachment=1):
+    return event('EXECUTE_STATEMENT_FINISH', seconds, attachment, statement=statement)
+
+
+class EventPairsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        EventData.setFields(['ID'] + DbScript(_SCRIPT).parsedFields())
+
+    def testClosingEventGetsOpeningOne(self):
+        pairs = EventPairs(10)
+        self.assertEqual(pairs.add(statementStart(0, 7)), [])
+        finish = statementFinish(2.5, 7)
+        self.assertEqual(pairs.add(finish), [finish])
+        self.assertEqual(finish.START_TIME, _START)
+        self.assertEqual(finish.ELAPSED_MS, 2500)
+        self.assertEqual((pairs.paired, pairs.count()), (1, 0))
+
+    def testEventsOfOtherAttachmentsDoNotPair(self):
+        pairs = EventPairs(10)
+        pairs.add(statementStart(0, 7, attachment=1))
+        finish = statementFinish(1, 7, attachment=2)
+        self.assertEqual(pairs.add(finish), [finish])
+        self.assertIsNone(finish.START_TIME)
+        self.assertEqual(pairs.count(), 1)
+
+    def testOldestEventsAreEvictedOverCapacity(self):
+        pairs = EventPairs(3)
+        starts = [statementStart(i, i) for i in range(5)]
+        rows = list()
+        for start in starts:
+            rows.extend(pairs.add(start))
+        self.assertEqual(rows, starts[:2])
+        self.assertEqual((pairs.evicted, pairs.count()), (2, 3))
+        # the evicted ones are not paired any more
+        finish = statementFinish(10, 0)
+        pairs.add(finish)
+        self.assertIsNone(finish.START_TIME)
+
+    def testEventsOlderThanMaxAgeAreEvicted(self):
+        pairs = EventPairs(100, maxAge=10)
+        old = statementStart(0, 1)
+        pairs.add(old)
+        young = statementStart(5, 2)
+        self.assertEqual(pairs.add(young), [])
+        # 10 seconds after the first one: it may still wait
+        self.assertEqual(pairs.add(statementStart(10, 3)), [])
+        self.assertEqual(pairs.add(statementStart(11, 4)), [old])
+        self.assertEqual(pairs.add(statementStart(16, 5)), [young])
+        self.assertEqual((pairs.evicted, pairs.count()), (2, 3))
+
+    def testAgeIsCountedFromLatestEvent(self):
+        '''An event that arrives late (from another traced host) does not make the others young again;
+        it is evicted when the events opened before it are gone.'''
+        pairs = EventPairs(100, maxAge=10)
+        old = statementStart(0, 1)
+        pairs.add(old)
+        second = statementStart(20, 2)
+        self.assertEqual(pairs.add(second), [old])
+        late = statementStart(3, 3)
+        self.assertEqual(pairs.add(late), [])
+        self.assertEqual(pairs.add(statementStart(25, 4)), [])
+        self.assertEqual(pairs.add(statementStart(31, 5)), [second, late])
+
+    def testReopenedEventEvictsPreviousOne(self):
+        pairs = EventPairs(10)
+        first = statementStart(0, 7)
+        pairs.add(first)
+        self.assertEqual(pairs.add(statementStart(1, 7)), [first])
+        self.assertEqual(pairs.evicted, 1)
+
+    def testFlushReturnsOpenEventsInOrder(self):
+        pairs = EventPairs(10)
+        starts = [statementStart(i, i) for i in range(3)]
+        for start in starts:
+            pairs.add(start)
+        self.assertEqual(pairs.flush(), starts)
+        self.assertEqual(pairs.count(), 0)
+
+    def testTagsAndTrim(self):
+        pairs = EventPairs(10)
+        self.assertIsNone(pairs.oldestTag())
+        for i in range(4):
+            pairs.add(statementStart(i, i), tag=i)
+        pairs.add(statementFinish(5, 0))
+        self.assertEqual(pairs.oldestTag(), 1)
+        pairs.trim(2)
+        self.assertEqual([tag for (_, tag) in pairs.held()], [2, 3])
+
+
+class PairedResumeTest(CheckpointTestCase):
+    '''The run is cut off after its last batch, as if it was killed: the events waiting for their pairs are not dumped.'''
+    def dumpKilled(self, params):
+        engine = DumpEngine(params, self.db, _SCRIPT, Communicator(datastore=self.log))
+        engine._dumpOpenEvents = lambda: None
+        engine.createDb()
+        engine.connect()
+        engine.loadCheckpoint()
+        engine.runDump()
+
+    def dumpResumed(self, params):
+        engine = DumpEngine(params, self.db, _SCRIPT, Communicator(datastore=self.log))
+        engine.connect()
+        engine.loadCheckpoint()
+        engine.runDump()
+
+    def dumpTwice(self, killedParams, resumedParams):
+        '''The killed run gets the first half of the log, the resumed one the whole log.'''
+        generator = tracegen.TraceGenerator(seed=1)
+        writeEvents(self.log, generator, 400)
+        self.dumpKilled(killedParams)
+        writeEvents(self.log, generator, 400, mode='a')
+        self.dumpResumed(resumedParams)
+
+    def assertDumpedAsByOneRun(self, params):
+        reference = self.path('reference.sqlite')
+        engine = DumpEngine(params, reference, _SCRIPT, Communicator(datastore=self.log))
+        engine.createDb()
+        engine.connect()
+        engine.runDump()
+        self.assertEqual(sorted(dumpedRows(self.db)), sorted(dumpedRows(reference)))
+
+    def testWaitingEventsArePairedInResumedRun(self):
+        params = dumpParams(pairEvents=True)
+        self.dumpTwice(params, params)
+        self.assertDumpedAsByOneRun(params)
+
+    def testEvictionsAreRepeatedInResumedRun(self):
+        params = dumpParams(pairEvents=True, pairIndexSize=20)
+        self.dumpTwice(params, params)
+        self.assertDumpedAsByOneRun(params)
+
+    def testWaitingEventsAreDumpedIfPairingIsOffInResumedRun(self):
+        '''Every event is dumped: the ones the killed run has paired as one row, the rest as they are.'''
+        self.dumpTwice(dumpParams(pairEvents=True), dumpParams())
+        with sqlite3.connect(self.db) as connection:
+            (rows, paired) = connection.execute('SELECT COUNT(*), COUNT(START_TIME) FROM TRACE_DATA_PARSED').fetchone()
+        self.assertGreater(paired, 0)
+        self.assertEqual(rows + paired, len(self.referenceRows(self.log)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+'''FileSource (--file mode): the log file read in blocks of lines split the same way as the trace session output.
+
+    python -m pytest tests'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from logfile import FileSource, FollowSource  # noqa: E402
+
+# statement text with characters str.splitlines() would break the line at
+_SQL = 'select 1 from rdb$database where 1 = 1\x0b and 2 = 2\x0c and\x1c\x1d\x1e 3\x85 = 3   '
+_EVENT = ('2024-01-01T00:00:00.0000 (1:0x1) EXECUTE_STATEMENT_FINISH\n'
+    '\tdb (ATT_1, SYSDBA:NONE, NONE, TCPv4:127.0.0.1/1)\n\n'
+    'Statement 1:\n-------------------------------------------------------------------------------\n'
+    + _SQL + '\n\n')
+
+
+def lines(source):
+    result = list()
+    block = source.readBlock(timeout=0)
+    while block:
+        result.extend(block)
+        block = source.readBlock(timeout=0)
+    return result
+
+
+class BlockLinesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'trace.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text, newline='\n'):
+        with open(self.log, 'w', encoding='utf8', newline=newline) as f:
+            f.write(text)
+
+    def testLinesAreSplitAtLineFeedOnly(self):
+        self.write(_EVENT * 2)
+        with FileSource(self.log) as source:
+            self.assertEqual(lines(source), (_EVENT * 2).split('\n')[:-1])
+
+    def testCarriageReturnIsStripped(self):
+        self.write(_EVENT * 2, newline='\r\n')
+        with FileSource(self.log) as source:
+            self.assertEqual(lines(source), (_EVENT * 2).split('\n')[:-1])
+
+    def testLastLineWithoutLineBreak(self):
+        self.write(_EVENT + 'last\r')
+        with FileSource(self.log) as source:
+            self.assertEqual(lines(source)[-2:], ['', 'last'])
+
+    def testFollowedFileLinesAreSplitAtLineFeedOnly(self):
+        self.write(_EVENT * 3)
+        source = FollowSource(self.log, sleep=lambda seconds: True)
+        try:
+            # the last event is held back until the next one starts
+            self.assertEqual(lines(source), (_EVENT * 2).split('\n')[:-1])
+        finally:
+            source.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
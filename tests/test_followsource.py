@@ -0,0 +1,106 @@
+'''FollowSource (--follow mode): blocks of whole events, and rotation of the log by rename, replacement or truncation.
+
+    python -m pytest tests'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from logfile import FollowSource  # noqa: E402
+
+
+def event(name, number):
+    return '2024-01-01T00:00:{:02}.0000 (1:0x1) {}_{}\n\tline of {}_{}\n\n'.format(number % 60, name, number, name, number)
+
+
+def eventNames(lines):
+    return [line.split()[-1] for line in lines if line.startswith('2024-')]
+
+
+class FollowSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'trace.log')
+        self.stopped = False
+        self.source = FollowSource(self.log, sleep=self.sleep)
+
+    def tearDown(self):
+        self.source.close()
+        shutil.rmtree(self.dir)
+
+    def sleep(self, seconds):
+        return self.stopped
+
+    def write(self, path, name, numbers, mode='a'):
+        with open(path, mode, encoding='utf8', newline='\n') as f:
+            for number in numbers:
+                f.write(event(name, number))
+
+    def read(self):
+        '''Names of the events read until nothing new is there.'''
+        names = list()
+        while True:
+            lines = self.source.readBlock(timeout=0)
+            if not lines:
+                return names
+            names.extend(eventNames(lines))
+
+    def testLastEventIsHeldBackUntilNextOneStarts(self):
+        self.write(self.log, 'A', range(3))
+        self.assertEqual(self.read(), ['A_0', 'A_1'])
+        self.write(self.log, 'A', [3])
+        self.assertEqual(self.read(), ['A_2'])
+
+    def testFileIsWaitedForUntilItIsCreated(self):
+        self.assertEqual(self.read(), [])
+        self.write(self.log, 'A', range(2))
+        self.assertEqual(self.read(), ['A_0'])
+
+    def testRenamedFileIsReadToItsEndBeforeNewOne(self):
+        self.write(self.log, 'A', range(3))
+        self.assertEqual(self.read(), ['A_0', 'A_1'])
+        os.rename(self.log, os.path.join(self.dir, 'trace.log.1'))
+        # written to the old file after the last read
+        self.write(os.path.join(self.dir, 'trace.log.1'), 'A', [3])
+        self.write(self.log, 'B', range(3), mode='w')
+        self.assertEqual(self.read(), ['A_2', 'A_3', 'B_0', 'B_1'])
+
+    def testRenamedFileIsReadToItsEndBeforeNewOneIsCreated(self):
+        self.write(self.log, 'A', range(3))
+        self.assertEqual(self.read(), ['A_0', 'A_1'])
+        os.rename(self.log, os.path.join(self.dir, 'trace.log.1'))
+        self.assertEqual(self.read(), ['A_2'])
+        self.write(self.log, 'B', range(2), mode='w')
+        self.assertEqual(self.read(), ['B_0'])
+
+    def testReplacedFileIsReadFromItsStart(self):
+        self.write(self.log, 'A', range(3))
+        self.assertEqual(self.read(), ['A_0', 'A_1'])
+        replacement = os.path.join(self.dir, 'new.log')
+        self.write(replacement, 'B', range(5), mode='w')
+        os.replace(replacement, self.log)
+        self.assertEqual(self.read(), ['B_0', 'B_1', 'B_2', 'B_3'])
+
+    def testTruncatedFileIsReadFromItsStart(self):
+        self.write(self.log, 'A', range(10))
+        self.assertEqual(len(self.read()), 9)
+        self.write(self.log, 'B', range(2), mode='w')
+        self.assertEqual(self.read(), ['B_0'])
+
+    def testBlockStartIsOffsetOfItsFirstEvent(self):
+        self.write(self.log, 'A', range(3))
+        self.source.readBlock(timeout=0)
+        self.assertEqual(self.source.blockStart, 0)
+        self.assertEqual(self.source.offset(), len(event('A', 0)) + len(event('A', 1)))
+
+    def testStopEndsTheWait(self):
+        self.stopped = True
+        self.assertEqual(self.source.readBlock(timeout=None), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
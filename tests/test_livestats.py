@@ -0,0 +1,122 @@
+'''LiveStats: duration percentiles within the sketch accuracy, by module and statement, slowest executions,
+and the stats of sharded dump workers merged.
+
+    python -m pytest tests'''
+import os
+import sys
+import json
+import datetime
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from dumpsinks import DbScript  # noqa: E402
+from eventdata import EventData, normalizeSql, sqlFingerprint  # noqa: E402
+from livestats import DurationSketch, LiveStats  # noqa: E402
+
+_SCRIPT = os.path.join(ROOT, 'db', 'create_db.sql')
+_ACCURACY = 0.01
+
+
+def statement(duration, module=None, line=None, sqlText='select a from t where id = 1', name='EXECUTE_STATEMENT_FINISH'):
+    event = EventData()
+    event.EVENT_NAME = name
+    event.DATE_TIME = datetime.datetime(2024, 1, 1, 10, 0)
+    event.DURATION_MS = duration
+    event.MODULE_NAME = module
+    event.MODULE_LINE = line
+    event.sqlText = sqlText
+    event.SQL_ID = sqlFingerprint(normalizeSql(sqlText)) if sqlText else None
+    return event
+
+
+class DurationSketchTest(unittest.TestCase):
+    def assertNear(self, value, expected):
+        self.assertLessEqual(abs(value - expected), expected * _ACCURACY)
+
+    def testQuantilesWithinAccuracy(self):
+        sketch = DurationSketch()
+        for value in range(1, 10001):
+            sketch.add(value)
+        self.assertNear(sketch.quantile(0.5), 5000)
+        self.assertNear(sketch.quantile(0.95), 9500)
+        self.assertNear(sketch.quantile(0.99), 9900)
+        self.assertNear(sketch.quantile(1), 10000)
+        self.assertEqual((sketch.count, sketch.max), (10000, 10000))
+
+    def testZeros(self):
+        sketch = DurationSketch()
+        for value in (0, 0, 0, 10):
+            sketch.add(value)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        self.assertEqual(sketch.summary()['avg'], 2.5)
+        self.assertIsNone(DurationSketch().quantile(0.5))
+
+    def testMergedIsTheSameAsOne(self):
+        (one, first, second) = (DurationSketch(), DurationSketch(), DurationSketch())
+        for value in range(1, 2001):
+            one.add(value)
+            (first if value % 3 else second).add(value)
+        first.merge(second)
+        self.assertEqual(first.summary(), one.summary())
+
+
+class LiveStatsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        EventData.setFields(['ID'] + DbScript(_SCRIPT).parsedFields())
+
+    def testOnlyFinishedStatementsWithDuration(self):
+        stats = LiveStats(10, 100)
+        stats.add(statement(10))
+        stats.add(statement(None))
+        stats.add(statement(20, name='EXECUTE_STATEMENT_START'))
+        stats.add(statement(30, name='EXECUTE_PROCEDURE_FINISH'))
+        self.assertEqual(stats.snapshot()['statements']['count'], 1)
+        self.assertEqual(LiveStats(10, 100).snapshot()['statements'], {'count': 0})
+
+    def testByModuleAndStatement(self):
+        stats = LiveStats(10, 100)
+        for duration in range(1, 101):
+            stats.add(statement(duration, 'UORDERS', '120', 'select a from t where id = {}'.format(duration)))
+        stats.add(statement(5000, 'UCLIENTS', '7', 'select b from c'))
+        snapshot = stats.snapshot()
+        self.assertEqual([(module['module'], module['line'], module['count']) for module in snapshot['byModule']],
+            [('UCLIENTS', '7', 1), ('UORDERS', '120', 100)])
+        byStatement = {item['sql']: item['count'] for item in snapshot['byStatement']}
+        self.assertEqual(byStatement, {'SELECT B FROM C': 1, 'SELECT A FROM T WHERE ID=?': 100})
+        json.dumps(snapshot)
+
+    def testSlowestExecutions(self):
+        stats = LiveStats(3, 100)
+        for duration in (5, 50, 1, 500, 20, 100):
+            stats.add(statement(duration))
+        self.assertEqual([execution['durationMs'] for execution in stats.snapshot()['slowest']], [500, 100, 50])
+
+    def testKeysAreLimited(self):
+        stats = LiveStats(3, 2)
+        for number in range(5):
+            stats.add(statement(10, 'U{}'.format(number), '1', 'select a from t{}'.format(number)))
+        snapshot = stats.snapshot()
+        self.assertEqual(sorted(module['module'] for module in snapshot['byModule']), ['U3', 'U4'])
+        self.assertEqual(len(snapshot['byStatement']), 2)
+        self.assertEqual(snapshot['statements']['count'], 5)
+
+    def testMergedWorkers(self):
+        (one, first, second) = (LiveStats(3, 100), LiveStats(3, 100), LiveStats(3, 100))
+        for duration in range(1, 301):
+            event = statement(duration, 'U{}'.format(duration % 4), '1')
+            one.add(event)
+            (first if duration % 2 else second).add(event)
+        first.merge(second)
+        (merged, expected) = (first.snapshot(), one.snapshot())
+        self.assertEqual(merged['statements'], expected['statements'])
+        # modules of equal p99 may come in any order
+        self.assertEqual(sorted(merged['byModule'], key=lambda module: module['module']),
+            sorted(expected['byModule'], key=lambda module: module['module']))
+        self.assertEqual([execution['durationMs'] for execution in merged['slowest']], [300, 299, 298])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+'''throttledConf in the trace config formats of Firebird 3 and 2.5, the levels of Throttle and their gauge per host.
+
+    python -m pytest tests'''
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import appdata  # noqa: E402
+from appdata import Communicator, TracerMetrics, _ThrottleParameters  # noqa: E402
+from metrics import MetricsCollector  # noqa: E402
+from throttle import Throttle, throttledConf  # noqa: E402
+from traceengine import TraceEngine  # noqa: E402
+
+_OPTIONS = {'time_threshold': '1000', 'log_statement_free': 'false', 'log_errors': 'true'}
+
+_CONF25 = '''# trace config of 2.5
+<database>
+\tenabled true
+\ttime_threshold 100
+\t# log_errors false
+\tlog_statement_free true
+</database>
+<database %[\\\\/]test.fdb>
+\tenabled true
+</database>
+<services>
+\tenabled false
+\tlog_errors false
+</services>
+'''
+
+
+def section(conf, start, end):
+    '''Lines of the first section whose opening line starts with start.'''
+    lines = conf.splitlines()
+    first = next(n for (n, line) in enumerate(lines) if line.strip().startswith(start))
+    last = next(n for n in range(first + 1, len(lines)) if lines[n].strip() == end)
+    return lines[first:last + 1]
+
+
+class Firebird3ConfTest(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(ROOT, 'trace3.conf')) as confFile:
+            self.conf = confFile.read()
+        self.throttled = throttledConf(self.conf, _OPTIONS)
+
+    def testValuesReplaced(self):
+        lines = section(self.throttled, 'database', '}')
+        self.assertIn('\ttime_threshold = 1000', lines)
+        self.assertIn('\tlog_statement_free = false', lines)
+        self.assertNotIn('\ttime_threshold = 100', lines)
+
+    def testMissingAddedAtSectionEnd(self):
+        lines = section(self.throttled, 'database', '}')
+        self.assertEqual(lines[-2:], ['\tlog_errors = true', '}'])
+        # the commented out option stays a comment
+        self.assertIn('\t#log_errors true', lines)
+
+    def testEveryDatabaseSection(self):
+        lines = section(self.throttled, 'database =', '}')
+        self.assertEqual(lines[2:], ['    enabled = true', '\ttime_threshold = 1000', '\tlog_statement_free = false',
+            '\tlog_errors = true', '}'])
+
+    def testServicesAsTheyAre(self):
+        self.assertEqual(section(self.throttled, 'services', '}'), section(self.conf, 'services', '}'))
+
+    def testOtherLinesAsTheyAre(self):
+        original = self.conf.splitlines()
+        changed = [line for line in self.throttled.splitlines() if line not in original]
+        # two database sections, each with the three options
+        self.assertEqual(sorted(changed), 2 * ['\tlog_errors = true'] + 2 * ['\tlog_statement_free = false']
+            + 2 * ['\ttime_threshold = 1000'])
+        self.assertEqual(len(self.throttled.splitlines()), len(original) + 4)
+
+
+class Firebird25ConfTest(unittest.TestCase):
+    def setUp(self):
+        self.throttled = throttledConf(_CONF25, _OPTIONS)
+
+    def testDefaultSection(self):
+        self.assertEqual(section(self.throttled, '<database>', '</database>'), ['<database>', '\tenabled true',
+            '\ttime_threshold 1000', '\t# log_errors false', '\tlog_statement_free false', '\tlog_errors true',
+            '</database>'])
+
+    def testPatternSection(self):
+        self.assertEqual(section(self.throttled, '<database %', '</database>')[1:], ['\tenabled true',
+            '\ttime_threshold 1000', '\tlog_statement_free false', '\tlog_errors true', '</database>'])
+
+    def testServicesAsTheyAre(self):
+        self.assertEqual(section(self.throttled, '<services>', '</services>'),
+            section(_CONF25, '<services>', '</services>'))
+        self.assertTrue(self.throttled.startswith('# trace config of 2.5\n'))
+
+    def testNoOptions(self):
+        self.assertEqual(throttledConf(_CONF25, {}), _CONF25)
+
+
+class ThrottleTest(unittest.TestCase):
+    def setUp(self):
+        levels = ((('time_threshold', '1000'),), (('log_transactions', 'false'), ('time_threshold', '5000')))
+        self.throttle = Throttle(_ThrottleParameters(True, 0, 3000, 1000, 0, levels), _CONF25)
+
+    def testLevelUpWhileBacklogGrows(self):
+        self.assertEqual(self.throttle.check(5000, 100), 1)
+        self.throttle.setLevel(1)
+        self.assertIsNone(self.throttle.check(4000, 200))
+        self.assertEqual(self.throttle.check(4500, 300), 2)
+        self.throttle.setLevel(2)
+        self.assertIsNone(self.throttle.check(9000, 400))
+
+    def testLevelDown(self):
+        self.throttle.setLevel(2)
+        self.assertIsNone(self.throttle.check(2000, 100))
+        self.assertEqual(self.throttle.check(500, 200), 1)
+        self.throttle.setLevel(0)
+        self.assertIsNone(self.throttle.check(0, 300))
+
+    def testHoldTime(self):
+        throttle = Throttle(self.throttle._params._replace(holdTime=3600), _CONF25)
+        throttle.setLevel(1)
+        self.assertIsNone(throttle.check(0, 100))
+
+    def testConfOfLevel(self):
+        self.assertEqual(self.throttle.conf(), _CONF25)
+        self.throttle.setLevel(2)
+        self.assertEqual(self.throttle.options(), {'time_threshold': '5000', 'log_transactions': 'false'})
+        lines = section(self.throttle.conf(), '<database>', '</database>')
+        self.assertIn('\ttime_threshold 5000', lines)
+        self.assertEqual(lines[-2:], ['\tlog_transactions false', '</database>'])
+
+
+class ThrottleMetricsTest(unittest.TestCase):
+    def testLevelOfEveryHost(self):
+        throttleParams = _ThrottleParameters(True, 0, 3000, 1000, 0, ((('time_threshold', '1000'),),))
+        comm = Communicator()
+        collector = MetricsCollector()
+        for (host, level) in (('host1', 1), ('host2', 0)):
+            engine = TraceEngine(appdata._TraceParameters(host, 'u', 'p', _CONF25, 1), comm, 1, throttleParams)
+            engine._throttle.setLevel(level)
+            engine._sendMetrics()
+            message = comm.popMessage(timeout=1)
+            self.assertIsInstance(message, TracerMetrics)
+            collector.update(message)
+        gauges = collector.combined()[1]
+        self.assertEqual(gauges['trace_throttle_level{host="host1"}'], 1)
+        self.assertEqual(gauges['trace_throttle_level{host="host2"}'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
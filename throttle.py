@@ -0,0 +1,82 @@
+import re
+import time
+
+# name = value (Firebird 3 trace config) or name value (2.5)
+_OPTION = re.compile(r'^(\s*)(\w+)(\s*=\s*|\s+)\S')
+_SECTION_ENDS = ('}', '</database>')
+
+
+def throttledConf(conf, options):
+    '''Trace config with options (name -> value) set in every database section: they replace the values there,
+    or are added at the end of the section. Both formats are known: database { name = value } of Firebird 3
+    and <database> name value </database> of 2.5. Services sections are left as they are.'''
+    lines = list()
+    missing = None
+    for line in conf.splitlines():
+        stripped = line.strip()
+        if missing is None:
+            if stripped.startswith(('database', '<database')):
+                missing = dict(options)
+                xml = stripped.startswith('<')
+        elif stripped in _SECTION_ENDS:
+            for (name, value) in missing.items():
+                lines.append('\t{} {}'.format(name, value) if xml else '\t{} = {}'.format(name, value))
+            missing = None
+        else:
+            match = _OPTION.match(line)
+            if match and not stripped.startswith('#'):
+                (indent, name, separator) = match.groups()
+                if name in options:
+                    line = '{}{}{}{}'.format(indent, name, separator, options[name])
+                    missing.pop(name, None)
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+class Throttle:
+    '''Level of the trace session: 0 - its config as it is, N - with the options of levels 1..N set.
+    Every checkInterval seconds the lines waiting for the dump are counted. The level goes up while more than
+    maxBacklog lines wait and their number grows (the sessions produce lines faster than the dump takes them),
+    and down when less than resumeBacklog lines wait. A level is kept at least holdTime seconds.'''
+    def __init__(self, params, conf):
+        self._params = params
+        self._conf = conf
+        self._checked = time.monotonic()
+        self._changed = self._checked
+        self._linesRead = 0
+        self.maxLevel = len(params.levels)
+        self.level = 0
+        self.backlog = 0
+        self.readRate = 0.0
+
+    def due(self):
+        return time.monotonic() - self._checked >= self._params.checkInterval
+
+    def check(self, backlog, linesRead):
+        '''backlog - lines waiting for the dump now, linesRead - lines read from the session so far.
+        Returns the level the session should be restarted with, None if it stays as it is.'''
+        now = time.monotonic()
+        growing = backlog > self.backlog
+        self.readRate = (linesRead - self._linesRead) / max(now - self._checked, 1e-3)
+        self._linesRead = linesRead
+        self._checked = now
+        self.backlog = backlog
+        if now - self._changed < self._params.holdTime:
+            return None
+        if backlog > self._params.maxBacklog and growing and self.level < self.maxLevel:
+            return self.level + 1
+        if backlog < self._params.resumeBacklog and self.level > 0:
+            return self.level - 1
+        return None
+
+    def setLevel(self, level):
+        self.level = level
+        self._changed = time.monotonic()
+
+    def conf(self):
+        '''Session config of the current level.'''
+        return throttledConf(self._conf, self.options()) if self.level else self._conf
+
+    def options(self):
+        '''Options of the current level, the later levels overriding the earlier ones.'''
+        return dict(option for levelOptions in self._params.levels[:self.level] for option in levelOptions)
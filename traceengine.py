@@ -1,26 +1,111 @@
+import os
+import ctypes
+import datetime
+import threading
 import fdb
+import fdb.ibase as ibase
 import appdata
-from appdata import Communicator, TracerMessage, TracerError
+from appdata import TracerMessage, TracerError
+from metrics import ProcessMetrics
+from throttle import Throttle
 
+_SESSION_NAME = 'test_trace1'
+# marker event of trace session throttle level changes
+_THROTTLE_EVENT = 'TRACE_THROTTLE'
 _traceEngine = None
 
 
-def run(params, communicator):
+class _ServiceOutput:
+    '''Output of the trace session read in blocks: one isc_service_query (isc_info_svc_to_eof) returns as much
+    of the output as fits into the 64 KB buffer, instead of one line per call as Connection.readline() does.
+    The query returns when the buffer is full, so a busy session is read without waits, or when timeout seconds
+    have passed. Lines are split here; the bytes of the line not complete yet are kept for the next block.
+    The query is made with the handles of the fdb services connection, that are not public: supported() tells
+    if the fdb version in use has them.'''
+    @staticmethod
+    def supported(svc):
+        api = getattr(fdb.services, 'api', None)
+        return hasattr(svc, '_isc_status') and hasattr(svc, '_svc_handle') and hasattr(api, 'isc_service_query')
+
+    def __init__(self, svc, timeout):
+        self._svc = svc
+        self._request = fdb.bs([ibase.isc_info_svc_to_eof])
+        self._spb = fdb.bs([ibase.isc_info_svc_timeout]) + fdb.uint_to_bytes(4, 2) + fdb.uint_to_bytes(timeout, 4) \
+            + fdb.bs([ibase.isc_info_end])
+        self._buffer = ctypes.create_string_buffer(ibase.USHRT_MAX)
+        self._encoding = ibase.charset_map.get(svc.charset, svc.charset) or 'utf8'
+        self._tail = b''
+        self._eof = False
+        self.bytesRead = 0
+
+    def readLines(self):
+        '''Complete lines read, maybe none (on timeout). None when the session has ended.'''
+        if self._eof:
+            return None
+        fdb.services.api.isc_service_query(self._svc._isc_status, self._svc._svc_handle, None, len(self._spb), self._spb,
+            len(self._request), self._request, ibase.USHRT_MAX, self._buffer)
+        if fdb.db_api_error(self._svc._isc_status):
+            raise fdb.exception_from_status(fdb.DatabaseError, self._svc._isc_status, 'Services/isc_service_query:')
+        raw = self._buffer.raw
+        if raw[0] != ibase.isc_info_svc_to_eof:
+            raise fdb.DatabaseError('Services/isc_service_query: unexpected result item {}.'.format(raw[0]))
+        size = fdb.bytes_to_uint(raw[1:3])
+        data = self._tail + raw[3:3 + size]
+        self.bytesRead += size
+        # the output ends with the data followed by isc_info_end, otherwise there is a timeout or truncation item
+        self._eof = raw[3 + size] == ibase.isc_info_end
+        lines = data.split(b'\n')
+        self._tail = b'' if self._eof else lines.pop()
+        if self._eof and not lines[-1]:
+            lines.pop()
+        return [line.decode(self._encoding, errors='replace') for line in lines]
+
+
+class _LineOutput:
+    '''Output of the trace session read with Connection.readline(), one line per call, when _ServiceOutput is not
+    supported. bytesRead counts the characters, the lines are decoded by fdb already.'''
+    def __init__(self, svc):
+        self._svc = svc
+        self.bytesRead = 0
+
+    def readLines(self):
+        line = self._svc.readline()
+        if line is None:
+            return None
+        self.bytesRead += len(line) + 1
+        return [line]
+
+
+def run(params, communicator, metricsInterval=0, throttleParams=None):
     global _traceEngine
     if not _traceEngine:
-        _traceEngine = TraceEngine(params, communicator)
+        _traceEngine = TraceEngine(params, communicator, metricsInterval, throttleParams)
     _traceEngine.connect()
     _traceEngine.runTrace()
 
 
 class TraceEngine:
-    def __init__(self, params, communicator):
+    '''With throttleParams enabled, the trace session is restarted with a stricter config when the dump falls behind,
+    and with the previous one when it catches up (see throttle.Throttle).'''
+    def __init__(self, params, communicator, metricsInterval=0, throttleParams=None):
         self._traceParams = None
         self._svc = None
         self._svcAux = None
         self._traceId = 0
-        self._traceParams = appdata._TraceParameters(params.host, params.login, params.password, params.traceConf)
-        self._comm = Communicator(datastore=communicator._datastore, stop=communicator._stop, messages=communicator._messages)
+        self._output = None
+        # output is read with _ServiceOutput, otherwise with _LineOutput
+        self._blockReads = True
+        self._linesRead = 0
+        # one process per traced host, so the host tells them apart in errors and metrics
+        self._source = '{}[{}]'.format(type(self).__name__, params.host)
+        self._metrics = ProcessMetrics(self._source, metricsInterval)
+        self._stopLock = threading.Lock()
+        self._traceParams = appdata._TraceParameters(params.host, params.login, params.password, params.traceConf, params.readTimeout)
+        self._comm = communicator.clone(source=params.host)
+        self._comm.autoFlush()
+        self._throttle = Throttle(throttleParams, params.traceConf) if throttleParams and throttleParams.enabled else None
+        # level the session is being restarted with
+        self._nextLevel = None
 
     def connect(self):
         try:
@@ -29,35 +114,129 @@ class TraceEngine:
                 self._svc.charset = 'UTF8'
             # Because trace session blocks the connection, we need another one to stop trace session!
             self._svcAux = fdb.services.connect(host=self._traceParams.host, user=self._traceParams.login, password=self._traceParams.password)
-            self._traceId = self._svc.trace_start(self._traceParams.traceConf, 'test_trace1')
+            self._blockReads = _ServiceOutput.supported(self._svc)
+            if not self._blockReads:
+                self._comm.pushMessage(TracerMessage('Trace session on {} is read line by line: the fdb version in use does not '
+                    'allow block reads.'.format(self._traceParams.host)))
+            self._startTrace(self._traceParams.traceConf)
         except Exception as e:
-            self._comm.pushMessage(TracerError(type(self), e))
+            self._comm.pushMessage(TracerError(self._source, e))
         else:
-            self._comm.pushMessage(TracerMessage("Connected to traced DB."))
+            self._comm.pushMessage(TracerMessage("Connected to traced DB on {}.".format(self._traceParams.host)))
 
     def disconnect(self):    
         try:
-            self._svcAux.trace_stop(self._traceId)
+            self._stopTrace()
             self._svcAux.close()
             self._svc.close()
-            self._traceId = 0
         except Exception as e:
-            self._comm.pushMessage(TracerError(type(self), e))
+            self._comm.pushMessage(TracerError(self._source, e))
         else:    
-            self._comm.pushMessage(TracerMessage("Disconnected from traced DB."))
+            self._comm.pushMessage(TracerMessage("Disconnected from traced DB on {}.".format(self._traceParams.host)))
 
     def connected(self):
         return self._traceId != 0
 
     def runTrace(self):
+        '''Reads the trace session output until it ends. On stop request the session is stopped from
+        another thread, so the output Firebird has already produced is still read and sent.
+        The process just ends if the session cannot be started or is finished by the server:
+        the main process stops the others when no traced host is left.
+        Lines of every read go to the transport at once; the block collected is sent after chunkTimeout
+        even if the session is idle (see Communicator.autoFlush()).
+        The session stopped to change its throttle level is read to the end and started again.'''
+        if not self.connected():
+            return
+        stopWatcher = threading.Thread(target=self._stopTraceOnRequest, daemon=True)
+        stopWatcher.start()
         while True:
             try:
-                line = self._svc.readline()
-                while not self._comm.pushLine(line):
-                    if self._comm.stopped():
-                        break
+                lines = self._output.readLines()
+                if lines is None:
+                    if self._nextLevel is not None and self._restartTrace():
+                        continue
+                    break
+                if lines:
+                    self._comm.pushLines(lines)
+                    self._linesRead += len(lines)
+                if self._throttle and self._throttle.due():
+                    self._checkThrottle()
+                if self._metrics.due():
+                    self._sendMetrics()
             except Exception as e:
-                self._comm.pushMessage(TracerError(type(self), e))
-            if self._comm.stopped():
-                break
+                self._comm.pushMessage(TracerError(self._source, e))
+                if self._comm.stopped():
+                    break
+        self._comm.flushLines()
+        self._sendMetrics()
+        if not self._comm.stopped() and self._traceId:
+            self._comm.pushMessage(TracerMessage("Trace session on {} finished by server.".format(self._traceParams.host)))
         self.disconnect()
+
+    def _sendMetrics(self):
+        self._metrics.total('trace_lines_read_total', self._linesRead)
+        if self._output:
+            self._metrics.total('trace_bytes_read_total', self._output.bytesRead)
+        if self._throttle:
+            self._metrics.set('trace_throttle_level{{host="{}"}}'.format(self._traceParams.host), self._throttle.level)
+        self._metrics.send(self._comm)
+
+    def _stopTraceOnRequest(self):
+        self._comm.waitStopped()
+        try:
+            self._stopTrace()
+        except Exception as e:
+            self._comm.pushMessage(TracerError(self._source, e))
+
+    def _stopTrace(self):
+        with self._stopLock:
+            if self._traceId:
+                self._svcAux.trace_stop(self._traceId)
+                self._traceId = 0
+
+    def _startTrace(self, conf):
+        '''Not started once stop is requested: the stop watcher has stopped the session already, or will stop this one.'''
+        with self._stopLock:
+            if self._comm.stopped():
+                return False
+            self._traceId = self._svc.trace_start(conf, _SESSION_NAME)
+            bytesRead = self._output.bytesRead if self._output else 0
+            self._output = _ServiceOutput(self._svc, self._traceParams.readTimeout) if self._blockReads else _LineOutput(self._svc)
+            self._output.bytesRead = bytesRead
+            return True
+
+    def _checkThrottle(self):
+        '''The session is stopped here; runTrace() reads the rest of its output and restarts it.'''
+        level = self._throttle.check(self._comm.linesLeft(), self._linesRead)
+        if level is None or self._nextLevel is not None:
+            return
+        self._nextLevel = level
+        self._comm.pushMessage(TracerMessage('{} lines are waiting for the dump ({:.0f} lines/s read), restarting trace session on {} '
+            'with throttle level {}.'.format(self._throttle.backlog, self._throttle.readRate, self._traceParams.host, level)))
+        self._stopTrace()
+
+    def _restartTrace(self):
+        level = self._nextLevel
+        self._nextLevel = None
+        previous = self._throttle.level
+        self._throttle.setLevel(level)
+        try:
+            if not self._startTrace(self._throttle.conf()):
+                return False
+        except Exception:
+            self._throttle.setLevel(previous)
+            raise
+        self._pushThrottleEvent()
+        return True
+
+    def _pushThrottleEvent(self):
+        '''Marker of the level change, in trace output format, so that it is dumped as an event of this host:
+        the header, the session line, the level and backlog line and the options of the level.'''
+        now = datetime.datetime.now()
+        lines = ['{}.{:04} ({}:0x0) {}'.format(now.strftime('%Y-%m-%dT%H:%M:%S'), now.microsecond // 100, os.getpid(), _THROTTLE_EVENT),
+            '\tSESSION_{} {}'.format(self._traceId, _SESSION_NAME),
+            '\tlevel {} of {}: {} lines waiting for the dump, {:.0f} lines/s read'.format(self._throttle.level,
+                self._throttle.maxLevel, self._throttle.backlog, self._throttle.readRate)]
+        lines.extend('\t{} = {}'.format(name, value) for (name, value) in self._throttle.options().items())
+        self._comm.pushLines(lines)
+        self._comm.flushLines()